@@ -0,0 +1,75 @@
+""" bench_analytics.py - Time wrangling_scripts.analytics.portfolio_statistics on many portfolios
+
+Evaluates random long-only portfolios (dense weights summing to 1) over
+synthetic daily returns, and times the per-symbol statistics too.
+
+    python benchmarks/bench_analytics.py --portfolios 100000 --symbols 3000 --days 252
+
+The weight matrix alone is portfolios x symbols float32: 1.2 GB for 100,000
+portfolios of 3,000 symbols."""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from wrangling_scripts.analytics import portfolio_statistics, symbol_statistics
+
+#=========================================================================================
+
+def make_returns(n_days, n_symbols, seed=0):
+    """ daily returns with a common market factor, a few missing days and late listings """
+    rng = np.random.default_rng(seed)
+    market = rng.normal(0.0003, 0.01, n_days)
+    betas = rng.uniform(0.5, 1.5, n_symbols)
+    returns = market[:, None] * betas + rng.normal(0.0002, 0.015, (n_days, n_symbols))
+    returns[rng.random((n_days, n_symbols)) < 0.01] = np.nan
+    listed = rng.integers(0, n_days // 4, n_symbols)
+    returns[np.arange(n_days)[:, None] < listed] = np.nan
+    columns = [f"SYM{i:05d}" for i in range(n_symbols)]
+    returns = pd.DataFrame(returns, columns=columns)
+    returns.insert(0, "MARKET", market)
+    return returns
+
+
+def make_weights(n_portfolios, n_symbols, seed=1, chunk_size=10000):
+    """ random long-only weights, each row summing to 1 """
+    rng = np.random.default_rng(seed)
+    weights = np.empty((n_portfolios, n_symbols), dtype=np.float32)
+    for start in range(0, n_portfolios, chunk_size):
+        chunk = rng.random((min(chunk_size, n_portfolios - start), n_symbols), dtype=np.float32)
+        weights[start:start + len(chunk)] = chunk / chunk.sum(axis=1, keepdims=True)
+    return weights
+
+#=========================================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--portfolios", type=int, default=100000, help="number of portfolios")
+    parser.add_argument("--symbols", type=int, default=3000, help="number of symbols")
+    parser.add_argument("--days", type=int, default=252, help="number of daily returns")
+    parser.add_argument("--chunk-size", type=int, default=4096, help="portfolios per matrix product")
+    parser.add_argument("--float64", action="store_true", help="do the matrix products in float64")
+    args = parser.parse_args()
+
+    returns = make_returns(args.days, args.symbols)
+    weights = make_weights(args.portfolios, args.symbols + 1)
+
+    start = time.perf_counter()
+    symbol_statistics(returns, benchmark="MARKET")
+    print(f"symbol statistics:    {args.symbols} symbols x {args.days} days in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    df_statistics = portfolio_statistics(returns, weights, benchmark="MARKET", chunk_size=args.chunk_size,
+                                         dtype=np.float64 if args.float64 else np.float32)
+    elapsed = time.perf_counter() - start
+    print(f"portfolio statistics: {args.portfolios} portfolios x {args.symbols} symbols x {args.days} days in {elapsed:.2f}s"
+          f" ({args.portfolios / elapsed:,.0f} portfolios/s)")
+    print(df_statistics.describe().loc[['mean', 'min', 'max']].to_string())
+
+
+if __name__ == "__main__":
+    main()
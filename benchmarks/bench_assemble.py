@@ -0,0 +1,109 @@
+""" bench_assemble.py - Compare the join loop with pipeline.assemble.align_frames
+
+Times the two ways of building the one-column-per-symbol dataframe from the
+downloaded series, and measures their peak memory with tracemalloc, on
+synthetic price series (random IPO dates, weekdays only, a few gaps).
+
+    python benchmarks/bench_assemble.py --symbols 5000 20000 --days 2500
+
+The join loop is quadratic in the number of symbols: at 5,000 symbols it takes
+tens of minutes, and it is only run up to --legacy-max-symbols symbols (reported
+as skipped above that). Each method is run twice, once for the timing and once
+under tracemalloc for the peak memory, unless --no-memory is given."""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline.assemble import align_frames
+
+#=========================================================================================
+
+def make_series(n_symbols, idx_dates, seed=0):
+    """ generate single-column price dataframes, keyed by symbol, like the ones parsed from Yahoo
+    :param n_symbols: number of symbols
+    :param idx_dates: DatetimeIndex of calendar dates covered
+    :param seed: random seed
+    :return: dictionary of symbol -> dataframe indexed by Date
+    """
+    rng = np.random.default_rng(seed)
+    trading_dates = idx_dates[idx_dates.dayofweek < 5]
+    dict_frames = {}
+    for i in range(n_symbols):
+        first = rng.integers(0, len(trading_dates) // 2)
+        dates = trading_dates[first:]
+        dates = dates[rng.random(len(dates)) > 0.01] # a few missing days
+        prices = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, len(dates))))
+        symbol = f"SYM{i:05d}"
+        df = pd.DataFrame({symbol: prices}, index=pd.DatetimeIndex(dates, name="Date"))
+        dict_frames[symbol] = df
+    return dict_frames
+
+
+def join_loop(idx_dates, dict_frames):
+    """ the original assembly code from update_data_db.py and load_data_db.py """
+    dfAllDates = pd.DataFrame(index=idx_dates)
+    dfAllDates.index.name = "Date"
+    for df in dict_frames.values():
+        dfAllDates = dfAllDates.join(df)
+    return dfAllDates
+
+
+def measure(function, *args, memory=True):
+    """ time function(*args), then run it again under tracemalloc to get its peak memory
+    :param memory: set to False to skip the tracemalloc run
+    :return: (result, seconds, peak MiB allocated during the call or None)
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    if not memory:
+        return result, elapsed, None
+
+    del result
+    tracemalloc.start()
+    result = function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 2**20
+
+
+def report(n_symbols, method, seconds, peak):
+    peak = '' if peak is None else f"{peak:.1f}"
+    print(f"{n_symbols:>8} {method:>12} {seconds:>10.2f} {peak:>10}", flush=True)
+
+#=========================================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--symbols", type=int, nargs="+", default=[5000, 20000], help="symbol counts to benchmark")
+    parser.add_argument("--days", type=int, default=2500, help="number of calendar days in the date index")
+    parser.add_argument("--legacy-max-symbols", type=int, default=5000, help="largest symbol count the join loop is run for")
+    parser.add_argument("--no-memory", action="store_true", help="only time the methods, skip the peak memory runs")
+    args = parser.parse_args()
+
+    idx_dates = pd.date_range(start="2010-01-01", periods=args.days, name="Date")
+
+    print(f"{'symbols':>8} {'method':>12} {'seconds':>10} {'peak MiB':>10}")
+    for n_symbols in args.symbols:
+        dict_frames = make_series(n_symbols, idx_dates)
+
+        aligned, seconds, peak = measure(align_frames, idx_dates, dict_frames, memory=not args.no_memory)
+        report(n_symbols, 'align_frames', seconds, peak)
+
+        if n_symbols > args.legacy_max_symbols:
+            print(f"{n_symbols:>8} {'join loop':>12} {'skipped':>10} {'':>10}", flush=True)
+            continue
+        joined, seconds, peak = measure(join_loop, idx_dates, dict_frames, memory=not args.no_memory)
+        report(n_symbols, 'join loop', seconds, peak)
+
+        pd.testing.assert_frame_equal(joined, aligned, check_freq=False)
+
+
+if __name__ == "__main__":
+    main()
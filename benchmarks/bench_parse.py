@@ -0,0 +1,108 @@
+""" bench_parse.py - Compare the per-symbol pandas parse with pipeline.parse.parse_price_payloads
+
+Generates Yahoo-like download payloads (Date,Open,High,Low,Close,Adj Close,Volume
+CSV bytes, a few "null" prices) and times the two ways of getting from the
+payloads to the aligned one-column-per-symbol dataframe:
+
+  * pandas:  read_csv + to_datetime + rename + set_index per symbol, then align_frames
+  * batch:   parse_price_payloads on the whole batch, then align_arrays
+
+    python benchmarks/bench_parse.py --symbols 1000 5000 --days 750 --workers 1 4 16
+
+The parse alone and the parse followed by the alignment are reported
+separately, and the two dataframes are checked to be identical. With
+--workers, the parse is also timed on a ParsePool of each size given."""
+import argparse
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_assemble import measure, report
+from pipeline.assemble import align_arrays, align_frames
+from pipeline.parse import ParsePool, parse_price_payloads
+
+#=========================================================================================
+
+def make_payloads(n_symbols, idx_dates, seed=0):
+    """ generate download payloads like the ones Yahoo returns
+    :param n_symbols: number of symbols
+    :param idx_dates: DatetimeIndex of calendar dates covered
+    :param seed: random seed
+    :return: list of (symbol, CSV bytes)
+    """
+    rng = np.random.default_rng(seed)
+    trading_dates = idx_dates[idx_dates.dayofweek < 5]
+    payloads = []
+    for i in range(n_symbols):
+        first = rng.integers(0, len(trading_dates) // 2)
+        dates = trading_dates[first:].strftime('%Y-%m-%d')
+        close = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, len(dates))))
+        adj_close = [f"{price:.6f}" for price in close * 0.98]
+        for missing in rng.choice(len(dates), size=len(dates) // 200, replace=False):
+            adj_close[missing] = "null"
+        volume = rng.integers(1000, 10**7, len(dates))
+        lines = ["Date,Open,High,Low,Close,Adj Close,Volume"]
+        lines.extend(f"{d},{c:.6f},{c * 1.01:.6f},{c * 0.99:.6f},{c:.6f},{a},{v}" for d, c, a, v in zip(dates, close, adj_close, volume))
+        payloads.append((f"SYM{i:05d}", ("\n".join(lines) + "\n").encode('utf-8')))
+    return payloads
+
+
+def pandas_parse(payloads):
+    """ the original parsing code from update_data_db.py and load_data_db.py """
+    dict_dfYahooSecurities = {}
+    for symbol, content in payloads:
+        dict_dfYahooSecurities[symbol] = pd.read_csv(io.BytesIO(content), usecols=["Date", "Adj Close"])
+        dict_dfYahooSecurities[symbol]['Date'] = pd.to_datetime(dict_dfYahooSecurities[symbol]['Date'], utc=False)
+        dict_dfYahooSecurities[symbol].columns = ["Date", symbol]
+        dict_dfYahooSecurities[symbol].set_index('Date', drop=True, inplace=True)
+    return dict_dfYahooSecurities
+
+
+def pandas_parse_and_align(idx_dates, payloads):
+    return align_frames(idx_dates, pandas_parse(payloads))
+
+
+def batch_parse_and_align(idx_dates, payloads):
+    return align_arrays(idx_dates, parse_price_payloads(payloads).series())
+
+#=========================================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--symbols", type=int, nargs="+", default=[1000, 5000], help="symbol counts to benchmark")
+    parser.add_argument("--days", type=int, default=750, help="number of calendar days covered by the payloads")
+    parser.add_argument("--no-memory", action="store_true", help="only time the methods, skip the peak memory runs")
+    parser.add_argument("--workers", type=int, nargs="*", default=[], help="ParsePool sizes to time the parse with")
+    args = parser.parse_args()
+
+    idx_dates = pd.date_range(start="2020-01-01", periods=args.days, name="Date")
+
+    print(f"{'symbols':>8} {'method':>12} {'seconds':>10} {'peak MiB':>10}")
+    for n_symbols in args.symbols:
+        payloads = make_payloads(n_symbols, idx_dates)
+        print(f"{n_symbols:>8} {'payload MiB':>12} {sum(len(c) for _, c in payloads) / 2**20:>10.1f}", flush=True)
+
+        _, seconds, peak = measure(pandas_parse, payloads, memory=not args.no_memory)
+        report(n_symbols, 'pandas', seconds, peak)
+        _, seconds, peak = measure(parse_price_payloads, payloads, memory=not args.no_memory)
+        report(n_symbols, 'batch', seconds, peak)
+
+        expected, seconds, peak = measure(pandas_parse_and_align, idx_dates, payloads, memory=not args.no_memory)
+        report(n_symbols, 'pandas+align', seconds, peak)
+        aligned, seconds, peak = measure(batch_parse_and_align, idx_dates, payloads, memory=not args.no_memory)
+        report(n_symbols, 'batch+align', seconds, peak)
+
+        pd.testing.assert_frame_equal(expected, aligned, check_freq=False)
+
+        for workers in args.workers:
+            with ParsePool(workers) as pool:
+                _, seconds, _ = measure(pool.parse, payloads, memory=False)
+            report(n_symbols, f"pool x{workers}", seconds, None)
+
+
+if __name__ == "__main__":
+    main()
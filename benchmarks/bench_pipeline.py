@@ -0,0 +1,243 @@
+""" bench_pipeline.py - Time every stage of the ingestion and serving paths on synthetic data
+
+Runs offline: for each symbol count, a fake yahoo_links registry, Yahoo-like
+payloads of --days trading days and a local stand-in for the Yahoo download
+endpoint (pipeline/stub_server.py) are generated in a temporary directory, and
+the stages of a nightly update and of the Flask app are timed one by one:
+
+    registry_full      the whole yahoo_links table read into pandas and filtered there
+    registry_read      the stale symbols read through the last_update index (pipeline/registry.py)
+    download           every payload downloaded from the stub server through a FetchEngine
+    parse              the payloads parsed by a ParsePool
+    assemble           the parsed series aligned into the dates x symbols dataframe
+    drop_empty_rows    the rows without any price dropped
+    csv_write          the dataframe written as a CSV piece
+    store_append       the dataframe appended to the price store
+    compaction         the piece appended to a master CSV holding all but the last week
+    snapshot_publish   the memory-mapped snapshot written from the price store
+    index_cold         first render of the Flask index, mapping the table
+    index_warm         later renders of the Flask index (median)
+    api_prices_warm    /api/prices for 50 symbols over the whole range (median)
+
+    python benchmarks/bench_pipeline.py --symbols 500 2000 5000 20000 --days 252 --output results.json
+    python benchmarks/bench_pipeline.py --symbols 500 2000 --compare results.json
+
+The results are written to a JSON file (one record per symbol count and
+stage), and --compare prints each stage's time against an earlier run."""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_parse import make_payloads
+from pipeline.assemble import align_arrays
+from pipeline.compaction import compact_pieces
+from pipeline.fetch import FetchEngine
+from pipeline.parse import ParsePool
+from pipeline.price_store import PriceStore
+from pipeline.registry import REGISTRY_COLUMNS, configure_connection, ensure_indexes, read_registry
+from pipeline.snapshot import open_snapshot, publish_snapshot
+from pipeline.stub_server import StubYahooServer
+
+#=========================================================================================
+
+SECTORS = ['Energy', 'Banks', 'Utilities', 'Materials', 'Health Care', 'Industrials', 'Information Technology']
+EXCHANGES = ['UA', 'UN', 'UQ', 'UR', 'UW', 'UV']
+
+#=========================================================================================
+
+def make_registry(conn, symbols, link_template, seed=0):
+    """ write a fake yahoo_links table, a third of it updated recently
+    :param conn: sqlite3 Connection
+    :param symbols: list of Yahoo symbols
+    :param link_template: function(symbol) returning the symbol's link template
+    :param seed: random seed
+    :return: dataframe written
+    """
+    rng = np.random.default_rng(seed)
+    n = len(symbols)
+    df_registry = pd.DataFrame({column: '' for column in REGISTRY_COLUMNS}, index=range(n))
+    df_registry['Country'] = 'USA'
+    df_registry['Exchange_ID'] = rng.choice(EXCHANGES, n)
+    df_registry['Symbol'] = df_registry['Local_Symbol'] = df_registry['Yahoo_Symbol'] = symbols
+    df_registry['Description'] = [f"{symbol} Corp." for symbol in symbols]
+    df_registry['IPO_Date'] = (pd.Timestamp('1980-01-01') + pd.to_timedelta(rng.integers(0, 10000, n), 'D')).astype(str)
+    df_registry['Category2'] = 'Common stocks'
+    df_registry['GICS_Sector'] = rng.choice(SECTORS, n)
+    df_registry['ISIN'] = [f"US{i:010d}" for i in range(n)]
+    df_registry['Market_Cap'] = np.exp(rng.uniform(15, 27, n)).astype(np.int64)
+    df_registry['Currency'] = 'USD'
+    df_registry['Yahoo_Listings_Link'] = [link_template(symbol) for symbol in symbols]
+    df_registry['last_update'] = np.where(rng.random(n) < 1 / 3, '2100-01-01 00:00:00', '1970-01-01 00:00:00')
+    df_registry.to_sql('yahoo_links', conn, if_exists='replace', index=False)
+    ensure_indexes(conn)
+    return df_registry
+
+
+def timed(results, n_symbols, stage, function, *args, **counts):
+    """ run function(*args), record its time as a result of the stage, and return its result """
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    results.append(dict({'symbols': n_symbols, 'stage': stage, 'seconds': seconds}, **counts))
+    print(f"{n_symbols:>8} {stage:>18} {seconds:>10.3f}", flush=True)
+    return result
+
+
+def median_time(function, repeat):
+    """ median time of repeated calls of function() """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+#=========================================================================================
+
+def run(n_symbols, n_days, parse_workers, fetch_workers, repeat):
+    """ time every stage for one symbol count, in a temporary working directory
+    :return: list of result records
+    """
+    results = []
+    # Calendar dates covering n_days weekdays, ending yesterday like a real update
+    idx_dates = pd.date_range(end=pd.Timestamp.today().normalize() - pd.Timedelta(days=1), periods=n_days * 7 // 5 + 1, name="Date")
+    payloads = dict(make_payloads(n_symbols, idx_dates))
+    symbols = list(payloads)
+
+    work_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    os.makedirs("output")
+    try:
+        with StubYahooServer(payloads) as server:
+            conn = configure_connection(sqlite3.connect("output/team122project.sqlite3"))
+            make_registry(conn, symbols, server.link_template)
+            now = datetime.utcnow().isoformat(sep=" ", timespec="seconds")
+
+            # Registry: the whole table filtered in pandas, as the scripts did, then the indexed read
+            def registry_full():
+                df = pd.read_sql('select * from yahoo_links', con=conn)
+                return df[df['last_update'] < now]
+            timed(results, n_symbols, 'registry_full', registry_full)
+            timed(results, n_symbols, 'registry_read', lambda: read_registry(
+                conn, columns=['Yahoo_Symbol', 'Yahoo_Listings_Link'], updated_before=now))
+
+            # Every symbol is downloaded, not only the stale ones, so the stages scale with n_symbols
+            jobs = [(symbol, server.link_template(symbol).format(timestmp1=0, timestmp2=0)) for symbol in symbols]
+            def download():
+                with FetchEngine(max_workers=fetch_workers, rate=1e6) as engine:
+                    return [(r.key, r.content) for r in engine.fetch_all(jobs) if r.status_code == 200]
+            downloaded = timed(results, n_symbols, 'download', download,
+                               bytes=sum(len(content) for content in payloads.values()))
+
+            idx_series = pd.Series(idx_dates)
+            with ParsePool(parse_workers) as parse_pool:
+                parse_pool.parse(downloaded[:10], idx_series.iloc[0], idx_series.iloc[-1]) # start the workers
+                parsed = timed(results, n_symbols, 'parse', parse_pool.parse, downloaded, idx_series.iloc[0], idx_series.iloc[-1])
+            dfAllDates = timed(results, n_symbols, 'assemble', align_arrays, idx_series, parsed.series())
+            df_trading_dates = timed(results, n_symbols, 'drop_empty_rows',
+                                     lambda: dfAllDates.drop(dfAllDates[dfAllDates.any(axis=1) == False].index, axis=0))
+
+            piece_file = "output/database_piece.csv"
+            def csv_write():
+                with open(piece_file, "w") as filehandle:
+                    df_trading_dates.to_csv(filehandle, index=True, lineterminator='\n', encoding='utf-8')
+            timed(results, n_symbols, 'csv_write', csv_write, rows=len(df_trading_dates))
+            price_store = PriceStore()
+            timed(results, n_symbols, 'store_append', price_store.append, df_trading_dates)
+
+            master_file = "output/historical_ticker_data.csv"
+            with open(master_file, "w") as filehandle:
+                df_trading_dates.iloc[:-5].to_csv(filehandle, index=True, lineterminator='\n', encoding='utf-8')
+            timed(results, n_symbols, 'compaction', compact_pieces, master_file, [piece_file])
+            timed(results, n_symbols, 'snapshot_publish', publish_snapshot, price_store)
+            conn.close()
+
+        # Serving: the Flask index over a templates table of the registry, and the price API
+        df_templates = pd.read_sql('select * from yahoo_links', con=sqlite3.connect("output/team122project.sqlite3"))
+        df_templates.to_csv("output/combined_securities_good_sectors_templates.csv", index=False)
+        from flaskapp import app, routes
+        from wrangling_scripts.dataset_cache import DatasetCache, file_marker
+        from wrangling_scripts.example_wrangler import TEMPLATES_FILE
+        from wrangling_scripts.price_api import snapshot_marker
+        from wrangling_scripts.shared_table import attach_table
+        # Fresh caches, bound to this working directory's files
+        routes.table_cache = DatasetCache(attach_table, lambda: file_marker(TEMPLATES_FILE))
+        routes.snapshot_cache = DatasetCache(lambda version: open_snapshot(version=version), snapshot_marker)
+        client = app.test_client()
+        timed(results, n_symbols, 'index_cold', client.get, '/')
+        seconds = median_time(lambda: client.get('/?page=1'), repeat)
+        results.append({'symbols': n_symbols, 'stage': 'index_warm', 'seconds': seconds})
+        print(f"{n_symbols:>8} {'index_warm':>18} {seconds:>10.3f}", flush=True)
+        prices_url = f"/api/prices?symbols={','.join(symbols[:50])}&limit=5000"
+        client.get(prices_url)
+        seconds = median_time(lambda: client.get(prices_url), repeat)
+        results.append({'symbols': n_symbols, 'stage': 'api_prices_warm', 'seconds': seconds})
+        print(f"{n_symbols:>8} {'api_prices_warm':>18} {seconds:>10.3f}", flush=True)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    for result in results:
+        result['days'] = n_days
+    return results
+
+
+def compare(results, baseline_file):
+    """ print the time of every stage against the same stage of an earlier run """
+    with open(baseline_file, encoding='utf-8') as filehandle:
+        baseline = {(r['symbols'], r['stage']): r['seconds'] for r in json.load(filehandle)['results']}
+    print(f"\n{'symbols':>8} {'stage':>18} {'seconds':>10} {'baseline':>10} {'ratio':>8}")
+    for result in results:
+        before = baseline.get((result['symbols'], result['stage']))
+        if before is None:
+            continue
+        print(f"{result['symbols']:>8} {result['stage']:>18} {result['seconds']:>10.3f} {before:>10.3f} {result['seconds'] / before:>8.2f}")
+
+#=========================================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--symbols", type=int, nargs="+", default=[500, 2000, 5000, 20000], help="symbol counts to benchmark")
+    parser.add_argument("--days", type=int, default=252, help="number of trading days downloaded per symbol")
+    parser.add_argument("--parse-workers", type=int, default=None, help="parsing processes (default one per CPU)")
+    parser.add_argument("--fetch-workers", type=int, default=8, help="downloads in flight at once")
+    parser.add_argument("--repeat", type=int, default=20, help="requests timed for the warm serving stages")
+    parser.add_argument("--output", default=f"bench_pipeline_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json", help="JSON file of the results")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    print(f"{'symbols':>8} {'stage':>18} {'seconds':>10}")
+    results = []
+    for n_symbols in args.symbols:
+        results.extend(run(n_symbols, args.days, args.parse_workers, args.fetch_workers, args.repeat))
+
+    run_info = {
+          'created'   : datetime.now().isoformat(sep=" ", timespec="seconds")
+        , 'python'    : platform.python_version()
+        , 'platform'  : platform.platform()
+        , 'cpu_count' : os.cpu_count()
+        , 'args'      : vars(args)
+        , 'results'   : results
+    }
+    with open(args.output, 'w', encoding='utf-8') as filehandle:
+        json.dump(run_info, filehandle, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
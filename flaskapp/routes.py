@@ -3,11 +3,25 @@
 Flask requires routes to be defined to know what data to provide for a given
 URL. The routes provided are relative to the base hostname of the website, and
 must begin with a slash."""
+import sqlite3
+
 from flaskapp import app
-from flask import render_template
-from wrangling_scripts.example_wrangler import data_wrangling, username
+from flask import jsonify, make_response, render_template, request
+from wrangling_scripts.chart_api import chart_page
+from wrangling_scripts.dataset_cache import DatasetCache, file_marker
+from wrangling_scripts.example_wrangler import TEMPLATES_FILE, username
+from wrangling_scripts.optimizer import frontier_page
+from wrangling_scripts.price_api import price_page, snapshot_cache, symbol_page
+from wrangling_scripts.screen_api import screen_page
+from wrangling_scripts.shared_table import attach_table, table_rows
+
+# The table is mapped on the first request, and mapped again in the background
+# whenever its file changes - no restart is needed after an update. It is a
+# memory map shared by all the worker processes, not a per-worker parsed copy.
+table_cache = DatasetCache(attach_table, lambda: file_marker(TEMPLATES_FILE))
 
-header, table = data_wrangling()
+# Rows of the table rendered per page of the index
+INDEX_PAGE_SIZE = 100
 
 # The following two lines define two routes for the Flask app, one for just
 # '/', which is the default route for a host, and one for '/index', which is
@@ -19,8 +33,93 @@ header, table = data_wrangling()
 @app.route('/index')
 def index():
     """Renders the index.html template"""
+    # Only one page of the table is rendered: the page size and render time no
+    # longer grow with the whole dataset. ?page=N selects the page.
+    page = max(request.args.get('page', 0, type=int), 0)
+    dataset = table_cache.get()
+    header, table = dataset.data
+    page_rows = table_rows(table, page * INDEX_PAGE_SIZE, (page + 1) * INDEX_PAGE_SIZE)
     # Renders the template (see the index.html template file for details). The
     # additional defines at the end (table, header, username) are the variables
     # handed to Jinja while it is processing the template.
-    return render_template('index.html', table=table, header=header,
-                           username=username())
+    return _conditional(dataset, render_template('index.html', table=page_rows, header=header,
+                                                 username=username(), page=page,
+                                                 has_next=(page + 1) * INDEX_PAGE_SIZE < len(table)))
+
+
+# The JSON API: the dashboard fetches the slices of the price history it shows,
+# instead of receiving the whole dataset with the page.
+#
+#   /api/prices?symbols=MSFT,AAPL&start=2020-01-01&end=2020-12-31&limit=250&cursor=...
+#   /api/symbols?prefix=MS&limit=250&cursor=...
+#   /api/frontier?symbols=MSFT,AAPL,...&start=2021-01-01&end=2023-12-31&estimator=ledoit_wolf&points=50&risk_free=0.02&long_only=0
+#   /api/chart?symbols=MSFT,AAPL&start=2010-01-01&end=2024-12-31&points=300&resolution=auto&ohlc=0
+#   /api/screen?sectors=Energy,Utilities&exchanges=UN&min_market_cap=1000000000&ipo_before=2005-01-01&stale_hours=22&limit=250
+#
+# A page holds at most `limit` dates (or symbols); when there is more, the
+# response's `next_cursor` is passed as `cursor` to get the next page.
+@app.route('/api/prices')
+def api_prices():
+    """Returns one page of prices for the requested symbols and date range"""
+    return _api_response(price_page, request.args.get('symbols'), request.args.get('start'),
+                         request.args.get('end'), request.args.get('cursor'), request.args.get('limit'))
+
+
+@app.route('/api/symbols')
+def api_symbols():
+    """Returns one page of the symbols held, alphabetically"""
+    return _api_response(symbol_page, request.args.get('prefix'), request.args.get('cursor'),
+                         request.args.get('limit'))
+
+
+@app.route('/api/frontier')
+def api_frontier():
+    """Returns the efficient frontier, minimum variance and maximum Sharpe
+    portfolios of the requested symbols over the requested window"""
+    return _api_response(frontier_page, request.args.get('symbols'), request.args.get('start'),
+                         request.args.get('end'), request.args.get('estimator'), request.args.get('points'),
+                         request.args.get('risk_free'), request.args.get('long_only'))
+
+
+@app.route('/api/chart')
+def api_chart():
+    """Returns the price lines of the requested symbols with at most `points`
+    points each: daily, weekly or monthly, or downsampled daily prices"""
+    return _api_response(chart_page, request.args.get('symbols'), request.args.get('start'),
+                         request.args.get('end'), request.args.get('points'), request.args.get('resolution'),
+                         request.args.get('ohlc'))
+
+
+@app.route('/api/screen')
+def api_screen():
+    """Returns the symbols of the registry matching the requested screen"""
+    try:
+        return jsonify(screen_page(request.args.get('sectors'), request.args.get('exchanges'),
+                                   request.args.get('min_market_cap'), request.args.get('max_market_cap'),
+                                   request.args.get('ipo_after'), request.args.get('ipo_before'),
+                                   request.args.get('stale_hours'), request.args.get('limit')))
+    except sqlite3.OperationalError as e: # no registry yet
+        return jsonify(error=str(e)), 503
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+
+def _api_response(page_function, *args):
+    try:
+        dataset = snapshot_cache.get()
+    except FileNotFoundError as e:
+        return jsonify(error=str(e)), 503
+    try:
+        return _conditional(dataset, jsonify(page_function(dataset.data, *args)))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+
+def _conditional(dataset, body):
+    """Tags a response with the version of the data it was made from, and
+    answers 304 Not Modified when the client already has that version"""
+    response = make_response(body)
+    response.set_etag(dataset.version)
+    response.last_modified = dataset.last_modified
+    response.cache_control.no_cache = True # always revalidate - the data changes every night
+    return response.make_conditional(request)
@@ -0,0 +1,23 @@
+""" gunicorn.conf.py - Serve the Flask app with several worker processes
+
+    gunicorn -c gunicorn.conf.py flaskapp:app
+
+The workers do not load any data of their own: the prices are the memory-mapped
+snapshot published by the update scripts, and the index table is converted
+into a shared memory map by the master process below, before the workers start.
+Memory therefore stays flat as workers are added, and a new worker starts
+without parsing anything."""
+import logging
+import multiprocessing
+
+bind = "127.0.0.1:3001"
+workers = min(multiprocessing.cpu_count() * 2 + 1, 8)
+
+
+def on_starting(server):
+    """Publish the shared index table once, in the master process"""
+    from wrangling_scripts.shared_table import publish_table
+    try:
+        publish_table()
+    except FileNotFoundError as e:
+        logging.warning(f"Index table not published, the workers will publish it once it exists: {e}")
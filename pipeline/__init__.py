@@ -0,0 +1,12 @@
+""" pipeline - Reusable building blocks for the Yahoo! Finance data pipeline
+
+The modules in this package hold the pieces of the pipeline (downloading,
+parsing, storage) and the runs built from them: universe.py and history.py
+for the initial load, update.py for the nightly update. Importing them has no
+side effects - no logging set up, no database opened - so the Flask app and
+tests can call them directly. The command line interface is in cli.py:
+
+    python -m pipeline --help
+
+load_data_db.py and update_data_db.py are kept as shortcuts for
+`python -m pipeline init-universe` and `python -m pipeline update`."""
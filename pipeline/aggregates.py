@@ -0,0 +1,97 @@
+""" aggregates.py - Weekly and monthly open/high/low/close of the adjusted closes
+
+Charts of a long range need a few hundred points per line, not every daily
+row. The update scripts write, with every snapshot version, the weekly and
+monthly aggregates of the dates x symbols price matrix:
+
+    output/snapshot/<version>/weekly.npy          4 x weeks x symbols float32: open, high, low, close
+    output/snapshot/<version>/weekly_dates.npy    datetime64[D] last trading date of each week
+    output/snapshot/<version>/monthly.npy         same, per calendar month
+    output/snapshot/<version>/monthly_dates.npy
+
+open and close are the first and last prices of the symbol in the period,
+high and low its highest and lowest; NaN where the symbol has no price in the
+period. The arrays are stored in Fortran order, so the four series of a symbol
+are contiguous, and are opened memory-mapped like the snapshot itself, by
+snapshot.open_aggregate:
+
+    aggregate = open_aggregate('monthly', version=snapshot.version)
+    aggregate.ohlc[3, :, snapshot.column('MSFT')]   # monthly closes of one symbol"""
+import os
+
+import numpy as np
+
+#=========================================================================================
+
+FREQUENCIES = ['weekly', 'monthly']
+FIELDS = ['open', 'high', 'low', 'close']
+
+#=========================================================================================
+
+def period_starts(dates, frequency):
+    """ find where each period starts in a sorted array of dates
+    :param dates: sorted datetime64[D] array
+    :param frequency: 'weekly' (Monday to Sunday) or 'monthly'
+    :return: array of the row positions where a new period starts
+    """
+    if frequency == 'weekly':
+        # 1970-01-01 was a Thursday: shifting by 3 days makes the weeks start on Mondays
+        periods = (dates.astype(np.int64) + 3) // 7
+    elif frequency == 'monthly':
+        periods = dates.astype('datetime64[M]').astype(np.int64)
+    else:
+        raise ValueError(f"frequency must be one of {FREQUENCIES}, not {frequency!r}")
+    if len(periods) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate([[True], periods[1:] != periods[:-1]]))
+
+
+def aggregate_prices(dates, prices, frequency, symbol_chunk=256):
+    """ compute the open, high, low and close of every symbol in every period
+    :param dates: sorted datetime64[D] date of each row
+    :param prices: dates x symbols matrix (NaN for no price) - may be a memory map, read a chunk of symbols at a time
+    :param frequency: 'weekly' or 'monthly'
+    :param symbol_chunk: number of symbols aggregated at a time
+    :return: (datetime64[D] last date of each period, 4 x periods x symbols float32 array in Fortran order)
+    """
+    starts = period_starts(dates, frequency)
+    n_dates, n_symbols = prices.shape
+    ohlc = np.full((4, len(starts), n_symbols), np.nan, dtype=np.float32, order='F')
+    if len(starts) == 0:
+        return np.zeros(0, dtype='datetime64[D]'), ohlc
+    rows = np.arange(n_dates)[:, None]
+
+    for start in range(0, n_symbols, symbol_chunk):
+        values = np.asarray(prices[:, start:start + symbol_chunk], dtype=np.float32)
+        valid = ~np.isnan(values)
+        # Row of the first and of the last price of each period: a reduction over row numbers,
+        # with the rows without a price pushed out of the way
+        first = np.minimum.reduceat(np.where(valid, rows, n_dates), starts, axis=0)
+        last = np.maximum.reduceat(np.where(valid, rows, -1), starts, axis=0)
+        has_price = last >= 0
+        cols = np.broadcast_to(np.arange(values.shape[1]), first.shape)
+        block = ohlc[:, :, start:start + symbol_chunk]
+        block[0] = np.where(has_price, values[np.minimum(first, n_dates - 1), cols], np.nan)
+        with np.errstate(invalid='ignore'):
+            block[1] = np.fmax.reduceat(values, starts, axis=0)
+            block[2] = np.fmin.reduceat(values, starts, axis=0)
+        block[3] = np.where(has_price, values[np.maximum(last, 0), cols], np.nan)
+
+    period_ends = np.concatenate([starts[1:], [n_dates]]) - 1
+    return dates[period_ends], ohlc
+
+
+def write_aggregates(directory, dates, prices):
+    """ write the weekly and monthly aggregates of a price matrix into a snapshot version directory
+    :param directory: directory of the snapshot version
+    :param dates: sorted datetime64[D] date of each row
+    :param prices: dates x symbols matrix
+    :return: dictionary of frequency -> number of periods
+    """
+    periods = {}
+    for frequency in FREQUENCIES:
+        period_dates, ohlc = aggregate_prices(dates, prices, frequency)
+        np.save(os.path.join(directory, f"{frequency}.npy"), ohlc)
+        np.save(os.path.join(directory, f"{frequency}_dates.npy"), period_dates)
+        periods[frequency] = len(period_dates)
+    return periods
@@ -0,0 +1,49 @@
+""" assemble.py - Align many downloaded price series onto one date index
+
+The scripts used to build their result with
+
+    for df in dict_dfYahooSecurities.values():
+        dfAllDates = dfAllDates.join(df)
+
+which copies the growing dataframe once per symbol - quadratic in the number
+of symbols. Here the result matrix is allocated once, each series is scattered
+into its column with numpy.searchsorted, and the dataframe is built at the end.
+The output is the same as the join loop: the date index is kept as is, dates a
+series has no price for are NaN, and dates outside the index are dropped."""
+import numpy as np
+import pandas as pd
+
+#=========================================================================================
+
+def align_arrays(idx_dates, series):
+    """ align (dates, values) arrays onto a sorted date index in a single pass
+    :param idx_dates: sorted dates of the result (DatetimeIndex, Series or array of datetime64)
+    :param series: iterable of (symbol, dates, values) with dates as datetime64 arrays
+    :return: dataframe indexed by Date with one float64 column per symbol, in the order given
+    """
+    index = pd.DatetimeIndex(idx_dates, name="Date")
+    keys = index.values
+    series = list(series)
+
+    matrix = np.full((len(index), len(series)), np.nan, dtype=np.float64)
+    for col, (_, dates, values) in enumerate(series):
+        dates = np.asarray(dates, dtype=keys.dtype)
+        positions = np.searchsorted(keys, dates)
+        # Keep only the dates that are actually in the index (the join drops the others)
+        found = positions < len(keys)
+        found[found] = keys[positions[found]] == dates[found]
+        matrix[positions[found], col] = np.asarray(values, dtype=np.float64)[found]
+
+    return pd.DataFrame(matrix, index=index, columns=[symbol for symbol, _, _ in series], copy=False)
+
+
+def align_frames(idx_dates, dict_frames):
+    """ drop-in replacement for joining every single-column dataframe onto an empty dataframe of dates
+    :param idx_dates: sorted dates of the result (DatetimeIndex, Series or array of datetime64)
+    :param dict_frames: dictionary of symbol -> dataframe indexed by date with the prices in its only column
+    :return: dataframe indexed by Date with one column per symbol, in dictionary order
+    """
+    return align_arrays(idx_dates, (
+        (df.columns[0], df.index.values, df.to_numpy()[:, 0])
+        for df in dict_frames.values()
+    ))
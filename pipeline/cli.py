@@ -0,0 +1,308 @@
+""" cli.py - Command line interface of the pipeline
+
+    python -m pipeline init-universe [--rebuild] [--no-history]   build yahoo_links, then load the price history
+    python -m pipeline update                                     nightly update of the prices
+    python -m pipeline compact [--date YYYY-MM-DD]                append a day's CSV pieces to the master data file
+    python -m pipeline daemon [--schedule "30 22 * * 1-5"]       resident update, on a cron schedule, until SIGTERM
+    python -m pipeline serve [--host H] [--port P]                run the Flask app
+    python -m pipeline bench [pipeline|parse|assemble|analytics] [benchmark arguments]
+    python -m pipeline status                                     registry, queue, watermark and snapshot at a glance
+
+Only the standard library is imported up front: pandas, numpy, requests,
+lxml and Flask are imported by the commands that use them, so --help and
+status answer in a few tens of milliseconds. Every command configures the
+logging and the run metrics itself; the functions it calls (update_prices,
+init_universe, load_history, compact_day) do neither, and can be called from
+the Flask app or from tests.
+
+The commands that download (init-universe, update, daemon) keep every
+response in the on-disk cache of pipeline/http_cache.py: --http-cache replay
+reruns them offline from it, refresh downloads everything again, off leaves
+it out."""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+from datetime import date, datetime
+
+#=========================================================================================
+
+OUTPUT_DIR = "output"
+
+# Kept in step with pipeline/registry.py, pipeline/price_store.py and pipeline/snapshot.py, which import pandas and
+# numpy - status reads these files directly so that it starts without them
+REGISTRY_FILE = "output/team122project.sqlite3"
+PRICE_STORE_FILE = "output/price_store.sqlite3"
+SNAPSHOT_DIR = "output/snapshot"
+
+LOG_FORMAT = '%(asctime)s %(levelname)-8s %(message)s'
+
+# Job name of each command's run metrics - the two scripts' names are kept so their metric series carry on
+METRICS_JOBS = {
+      'init-universe' : 'load_data_db'
+    , 'update'        : 'update_data_db'
+    , 'compact'       : 'compact'
+}
+
+BENCHMARKS = ['pipeline', 'parse', 'assemble', 'analytics']
+
+# Kept in step with pipeline/http_cache.py
+HTTP_CACHE_DIR = "output/http_cache"
+HTTP_CACHE_MODES = ['off', 'use', 'refresh', 'replay']
+
+#=========================================================================================
+
+def _default_log_file(command):
+    """ log file of a command, as the scripts named them """
+    if command == 'daemon':
+        return os.path.join(OUTPUT_DIR, "CSE6242_Final_Project_Team_122_daemon.log")
+    if command == 'update':
+        log_timestamp = datetime.utcnow().isoformat(sep="_", timespec="seconds").replace("-", "").replace(":", "")
+        return os.path.join(OUTPUT_DIR, f"CSE6242_Final_Project_Team_122_{log_timestamp}.log")
+    return os.path.join(OUTPUT_DIR, "CSE6242_Final_Project_Team_122.log")
+
+
+def _setup_logging(args):
+    """ create the output directory and configure the logging of a pipeline command """
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    log_file = args.log_file or _default_log_file(args.command)
+    if log_file == '-':
+        logging.basicConfig(stream=sys.stderr, level=logging.INFO, format=LOG_FORMAT)
+    else:
+        logging.basicConfig(filename=log_file, level=logging.INFO, format=LOG_FORMAT)
+
+
+def _print_summary(summary):
+    print(json.dumps(summary, indent=2, default=str))
+
+
+def _open_cache(args):
+    """ ResponseCache of a downloading command, None with --http-cache off """
+    if args.http_cache == 'off':
+        return None
+    from pipeline.http_cache import ResponseCache
+
+    return ResponseCache(args.cache_dir, mode=args.http_cache, ttl=args.cache_ttl_hours * 3600,
+                         max_bytes=int(args.cache_max_mb * 1024 ** 2))
+
+
+def _close_cache(cache):
+    if cache is not None:
+        cache.close()
+
+#=========================================================================================
+
+def cmd_init_universe(args, metrics):
+    from pipeline.history import load_history
+    from pipeline.registry import configure_connection
+    from pipeline.universe import init_universe
+
+    cache = _open_cache(args)
+    try:
+        conn = configure_connection(sqlite3.connect(args.db))
+        try:
+            universe = init_universe(conn, rebuild=args.rebuild, max_workers=args.universe_workers,
+                                     rate=args.universe_rate, metrics=metrics, cache=cache)
+        finally:
+            conn.close()
+        summary = {'universe': universe}
+        if not args.no_history:
+            summary['history'] = load_history(args.db, fetch_max_workers=args.fetch_workers, fetch_requests_per_second=args.rate,
+                                              parse_workers=args.parse_workers, min_gap_days=args.min_gap_days, metrics=metrics,
+                                              cache=cache)
+    finally:
+        _close_cache(cache)
+    _print_summary(summary)
+    return 0
+
+
+def cmd_update(args, metrics):
+    from pipeline.update import update_prices
+
+    cache = _open_cache(args)
+    try:
+        summary = update_prices(args.db, fetch_max_workers=args.fetch_workers, fetch_requests_per_second=args.rate,
+                                parse_workers=args.parse_workers, metrics=metrics, cache=cache)
+    finally:
+        _close_cache(cache)
+    _print_summary(summary)
+    return 0
+
+
+def cmd_compact(args, metrics):
+    from pipeline.price_store import PriceStore
+    from pipeline.update import compact_day
+
+    with PriceStore() as price_store:
+        compaction = compact_day(price_store, args.date or date.today().isoformat(), metrics=metrics)
+    _print_summary(compaction)
+    return 0
+
+
+def cmd_daemon(args):
+    from pipeline.scheduler import CronSchedule, UpdateDaemon
+
+    cache = _open_cache(args)
+    try:
+        daemon = UpdateDaemon(CronSchedule(args.schedule), args.db, fetch_max_workers=args.fetch_workers,
+                              fetch_requests_per_second=args.rate, parse_workers=args.parse_workers,
+                              metrics_dir=None if args.no_metrics else args.metrics_dir, cache=cache)
+        daemon.run(run_now=args.run_now)
+    finally:
+        _close_cache(cache)
+    return 0
+
+
+def cmd_serve(args):
+    from flaskapp import app
+
+    app.run(host=args.host, port=args.port, debug=args.debug)
+    return 0
+
+
+def cmd_bench(args):
+    import runpy
+
+    benchmarks_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks")
+    script = os.path.join(benchmarks_dir, f"bench_{args.benchmark}.py")
+    # The benchmarks import each other as scripts, from their own directory
+    sys.path.insert(0, benchmarks_dir)
+    sys.argv = [script] + args.benchmark_args
+    runpy.run_path(script, run_name="__main__")
+    return 0
+
+
+def _read_only(db_file):
+    """ connect to a SQLite database without creating it, None if it does not exist """
+    if not os.path.exists(db_file):
+        return None
+    return sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+
+
+def _query(conn, sql, *params):
+    """ first row of a query, None if the database or the table does not exist """
+    if conn is None:
+        return None
+    try:
+        return conn.execute(sql, params).fetchone()
+    except sqlite3.OperationalError:
+        return None
+
+
+def cmd_status(args):
+    status = {}
+
+    conn = _read_only(args.db)
+    row = _query(conn, "SELECT COUNT(*), MAX(last_update) FROM yahoo_links")
+    status['registry'] = None if row is None else {'symbols': row[0], 'last_update': row[1]}
+    row = _query(conn, "SELECT MAX(run_date) FROM fetch_queue")
+    if row is not None and row[0] is not None:
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM fetch_queue WHERE run_date = ? GROUP BY status", (row[0],)).fetchall())
+        status['fetch_queue'] = {'run_date': row[0], 'counts': counts}
+    if conn is not None:
+        conn.close()
+
+    conn = _read_only(PRICE_STORE_FILE)
+    row = _query(conn, "SELECT last_date, row_count, col_count, updated_at FROM global_watermark WHERE name = 'master'")
+    status['master_watermark'] = None if row is None else dict(zip(['last_date', 'row_count', 'col_count', 'updated_at'], row))
+    # Last day completed by the update daemon (pipeline/scheduler.py)
+    row = _query(conn, "SELECT last_date FROM global_watermark WHERE name = 'scheduler'")
+    status['daemon_completed'] = None if row is None else row[0]
+    if conn is not None:
+        conn.close()
+
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, "CURRENT"), encoding='utf-8') as filehandle:
+            version = filehandle.read().strip()
+        with open(os.path.join(SNAPSHOT_DIR, version, "manifest.json"), encoding='utf-8') as filehandle:
+            manifest = json.load(filehandle)
+        status['snapshot'] = {key: manifest.get(key) for key in ['version', 'created', 'n_dates', 'n_symbols', 'last_date']}
+    except FileNotFoundError:
+        status['snapshot'] = None
+
+    _print_summary(status)
+    return 0
+
+#=========================================================================================
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m pipeline", description="Yahoo! Finance data pipeline of the Portfolio Analyzer")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+
+    # compact works on the master data file and the price store only, so it takes no --db
+    log_options = argparse.ArgumentParser(add_help=False)
+    log_options.add_argument("--log-file", help="log file, '-' for the terminal (default in output/)")
+    log_options.add_argument("--no-metrics", action="store_true", help="do not write the run metrics")
+    log_options.add_argument("--metrics-dir", default=os.path.join(OUTPUT_DIR, "metrics"), help="directory of the run metrics (default %(default)s)")
+
+    run_options = argparse.ArgumentParser(add_help=False, parents=[log_options])
+    run_options.add_argument("--db", default=REGISTRY_FILE, help="registry database (default %(default)s)")
+
+    fetch_options = argparse.ArgumentParser(add_help=False)
+    fetch_options.add_argument("--fetch-workers", type=int, default=8, help="downloads in flight at once (default %(default)s)")
+    fetch_options.add_argument("--rate", type=float, default=4, help="most requests per second sent to Yahoo (default %(default)s)")
+    fetch_options.add_argument("--parse-workers", type=int, default=None, help="parsing processes (default one per CPU, 1 = in process)")
+    fetch_options.add_argument("--http-cache", choices=HTTP_CACHE_MODES, default="use",
+                               help="response cache: use it, refresh it, replay it offline, or off (default %(default)s)")
+    fetch_options.add_argument("--cache-dir", default=HTTP_CACHE_DIR, help="directory of the response cache (default %(default)s)")
+    fetch_options.add_argument("--cache-ttl-hours", type=float, default=168, help="hours a cached response is used for (default %(default)s)")
+    fetch_options.add_argument("--cache-max-mb", type=float, default=1024, help="most MB of responses kept (default %(default)s)")
+
+    init = subparsers.add_parser("init-universe", parents=[run_options, fetch_options], help="build the symbol universe and load its price history")
+    init.add_argument("--rebuild", action="store_true", help="rebuild yahoo_links even if it exists (e.g. weekly)")
+    init.add_argument("--no-history", action="store_true", help="only build the universe, do not download prices")
+    init.add_argument("--universe-workers", type=int, default=8, help="exchange pages downloaded at once (default %(default)s)")
+    init.add_argument("--universe-rate", type=float, default=2, help="most requests per second sent to stockmarketmba (default %(default)s)")
+    init.add_argument("--min-gap-days", type=int, default=5, help="symbols missing fewer days are left for a later pass (default %(default)s)")
+    init.set_defaults(handler=cmd_init_universe)
+
+    update = subparsers.add_parser("update", parents=[run_options, fetch_options], help="download the new prices of the stale symbols and publish them")
+    update.set_defaults(handler=cmd_update)
+
+    compact = subparsers.add_parser("compact", parents=[log_options], help="append the CSV pieces of a day to the master data file")
+    compact.add_argument("--date", help="run date of the pieces, YYYY-MM-DD (default today)")
+    compact.set_defaults(handler=cmd_compact)
+
+    daemon = subparsers.add_parser("daemon", parents=[run_options, fetch_options], help="stay resident and update on a cron schedule, until SIGTERM")
+    daemon.add_argument("--schedule", default="30 22 * * 1-5", help="cron expression of the updates, in local time (default '%(default)s')")
+    daemon.add_argument("--run-now", action="store_true", help="update once at start, then follow the schedule")
+    daemon.set_defaults(handler=cmd_daemon)
+
+    serve = subparsers.add_parser("serve", help="run the Flask app")
+    serve.add_argument("--host", default="127.0.0.1", help="address to listen on (default %(default)s)")
+    serve.add_argument("--port", type=int, default=3001, help="port to listen on (default %(default)s)")
+    serve.add_argument("--debug", action="store_true", help="run Flask in debug mode")
+    serve.set_defaults(handler=cmd_serve)
+
+    bench = subparsers.add_parser("bench", help="run a benchmark from benchmarks/")
+    bench.add_argument("benchmark", nargs="?", choices=BENCHMARKS, default="pipeline", help="benchmark to run (default %(default)s)")
+    bench.add_argument("benchmark_args", nargs=argparse.REMAINDER, help="arguments of the benchmark, see its --help")
+    bench.set_defaults(handler=cmd_bench)
+
+    status = subparsers.add_parser("status", help="show the registry, download queue, master watermark and snapshot")
+    status.add_argument("--db", default=REGISTRY_FILE, help="registry database (default %(default)s)")
+    status.set_defaults(handler=cmd_status)
+    return parser
+
+
+def main(argv=None):
+    """ run a command
+    :param argv: arguments, sys.argv[1:] if None
+    :return: exit status
+    """
+    args = build_parser().parse_args(argv)
+    if not hasattr(args, 'log_file'):
+        return args.handler(args)
+    _setup_logging(args)
+    if args.command not in METRICS_JOBS:
+        return args.handler(args)
+
+    from pipeline.metrics import NULL_METRICS, RunMetrics
+    metrics = NULL_METRICS if args.no_metrics else RunMetrics(METRICS_JOBS[args.command])
+    try:
+        return args.handler(args, metrics)
+    finally:
+        metrics.write(args.metrics_dir)
@@ -0,0 +1,189 @@
+""" compaction.py - Append the day's database_*.csv pieces to the master data file
+
+The old compaction step concatenated the pieces one by one with pd.concat
+(re-copying the growing frame each time), then concatenated the result onto
+the whole master frame and rewrote historical_ticker_data.csv in place. A crash
+during that write left a truncated master file.
+
+compact_pieces() works on the CSV text instead, in bounded memory:
+
+  * the pieces are sorted by date, so they are merged k-way (heapq.merge),
+    holding one row per piece at a time,
+  * each merged row is laid out in the master file's column order; a piece
+    column the master does not have is an error, not a log line - unless the
+    caller allows new columns, which are then added to the right of the
+    master's header, empty for the rows already in it,
+  * the master is copied block by block into a temporary file next to it, the
+    new rows are appended, and the temporary file is fsync'ed and renamed over
+    the master - readers see either the old file or the new one, never a mix,
+  * the SHA-256 of the new file is computed on the way and returned, for the
+    master watermark."""
+import csv
+import hashlib
+import heapq
+import logging
+import os
+import stat
+import tempfile
+
+#=========================================================================================
+
+class CompactionError(Exception):
+    """ Raised when the pieces cannot be appended to the master file as they are """
+
+#=========================================================================================
+
+def _read_header(file_name):
+    with open(file_name, newline='', encoding='utf-8') as filehandle:
+        return next(csv.reader(filehandle), None)
+
+
+def _last_date(file_name, block_size=1 << 16):
+    """ read the date of the last row of a CSV file without reading the rest of it """
+    with open(file_name, 'rb') as filehandle:
+        filehandle.seek(0, os.SEEK_END)
+        size = filehandle.tell()
+        filehandle.seek(max(0, size - block_size))
+        lines = filehandle.read().rstrip(b'\r\n').splitlines()
+    if len(lines) < 2 and size <= block_size: # header only
+        return None
+    return lines[-1].split(b',', 1)[0].decode('utf-8')
+
+
+def _piece_rows(file_name, column_positions):
+    """ yield (date, [(master position, value), ...]) for each row of a piece """
+    with open(file_name, newline='', encoding='utf-8') as filehandle:
+        reader = csv.reader(filehandle)
+        next(reader) # header
+        for row in reader:
+            yield row[0], [(column_positions[i], value) for i, value in enumerate(row[1:]) if value != '']
+
+
+def _write_and_hash(filehandle, digest, data):
+    filehandle.write(data)
+    digest.update(data)
+
+#=========================================================================================
+
+def compact_pieces(master_file, piece_files, allow_missing_columns=False, allow_new_columns=False):
+    """ append the rows of the piece files to the master file, atomically
+
+    Rows dated on or before the master's last date are already in the master and
+    are skipped, so running the same compaction twice does not duplicate rows.
+    Rows with no price at all (weekends, holidays) are dropped.
+
+    :param master_file: the master CSV file (dates in the first column, one column per symbol); created if missing
+    :param piece_files: list of piece CSV files in the same layout, each sorted by date
+    :param allow_missing_columns: accept master columns that no piece provides (written as empty cells)
+    :param allow_new_columns: accept piece columns the master does not have (added to the master, empty for its existing rows)
+    :return: dictionary with rows_appended, rows_skipped, col_count, last_date, checksum, missing_columns and new_columns
+    """
+    piece_headers = [_read_header(piece) for piece in piece_files]
+    piece_columns = set()
+    for piece, header in zip(piece_files, piece_headers):
+        if header is None:
+            raise CompactionError(f"Piece {piece} is empty")
+        duplicated = piece_columns.intersection(header[1:])
+        if duplicated:
+            logging.info(f"Piece {piece} repeats {len(duplicated)} columns of an earlier piece - the later piece wins")
+        piece_columns.update(header[1:])
+
+    if os.path.exists(master_file):
+        master_header = _read_header(master_file)
+        master_last_date = _last_date(master_file)
+    else:
+        master_header = ['Date'] + sorted(piece_columns)
+        master_last_date = None
+
+    # Check the column sets before touching anything
+    master_columns = master_header[1:]
+    new_columns = sorted(piece_columns.difference(master_columns))
+    if new_columns and not allow_new_columns:
+        raise CompactionError(f"{len(new_columns)} columns of the pieces are not in {master_file}: {new_columns[:10]}")
+    # The existing rows of the master are padded with one empty cell per new column
+    padding = b',' * len(new_columns)
+    master_columns = master_columns + new_columns
+    missing_columns = sorted(set(master_columns).difference(piece_columns))
+    if missing_columns and not allow_missing_columns:
+        raise CompactionError(f"{len(missing_columns)} columns of {master_file} are in none of the pieces: {missing_columns[:10]}")
+
+    positions = {column: position for position, column in enumerate(master_columns)}
+    streams = [
+        ((date, order, values) for date, values in _piece_rows(piece, [positions[c] for c in header[1:]]))
+        for order, (piece, header) in enumerate(zip(piece_files, piece_headers))
+    ]
+
+    directory = os.path.dirname(os.path.abspath(master_file))
+    digest = hashlib.sha256()
+    stats = {'rows_appended': 0, 'rows_skipped': 0, 'last_date': master_last_date}
+
+    def write_row(output, date, row):
+        if master_last_date is not None and date <= master_last_date:
+            stats['rows_skipped'] += 1 # already in the master
+        elif any(row): # rows with no price at all are dropped
+            _write_and_hash(output, digest, (','.join([date] + row) + '\n').encode('utf-8'))
+            stats['rows_appended'] += 1
+            stats['last_date'] = date
+
+    handle, temp_file = tempfile.mkstemp(prefix='.compaction_', suffix='.csv', dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as output:
+            # 1. the existing master, copied block by block - or line by line, with a new header, when columns are added
+            if os.path.exists(master_file) and new_columns:
+                with open(master_file, 'rb') as master:
+                    next(master, None)
+                    _write_and_hash(output, digest, (','.join(master_header[:1] + master_columns) + '\n').encode('utf-8'))
+                    for line in master:
+                        line = line.rstrip(b'\r\n')
+                        if line:
+                            _write_and_hash(output, digest, line + padding + b'\n')
+            elif os.path.exists(master_file):
+                block = b''
+                with open(master_file, 'rb') as master:
+                    for block in iter(lambda: master.read(1 << 20), b''):
+                        _write_and_hash(output, digest, block)
+                if block and not block.endswith(b'\n'):
+                    _write_and_hash(output, digest, b'\n')
+            else:
+                _write_and_hash(output, digest, (','.join(master_header) + '\n').encode('utf-8'))
+
+            # 2. the new rows, merged across the pieces one date at a time
+            row = None
+            current_date = None
+            for date, _, values in heapq.merge(*streams, key=lambda item: (item[0], item[1])):
+                if date != current_date:
+                    if row is not None:
+                        write_row(output, current_date, row)
+                    current_date = date
+                    row = [''] * len(master_columns)
+                for position, value in values:
+                    row[position] = value
+            if row is not None:
+                write_row(output, current_date, row)
+
+            output.flush()
+            os.fsync(output.fileno())
+
+        # mkstemp creates the file readable by its owner only - keep the master's permissions
+        os.chmod(temp_file, stat.S_IMODE(os.stat(master_file).st_mode) if os.path.exists(master_file) else 0o644)
+        os.replace(temp_file, master_file)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+
+    # Make the rename itself durable
+    if hasattr(os, 'O_DIRECTORY'):
+        directory_handle = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory_handle)
+        finally:
+            os.close(directory_handle)
+
+    stats.update({
+          'col_count'      : len(master_columns)
+        , 'checksum'       : digest.hexdigest()
+        , 'missing_columns': missing_columns
+        , 'new_columns'    : new_columns
+    })
+    return stats
+
@@ -0,0 +1,202 @@
+""" fetch.py - Concurrent, rate-limited downloads from Yahoo! Finance
+
+Downloading the price history one symbol at a time, with a brand new TCP/TLS
+connection for every request, makes a nightly refresh take hours. The
+FetchEngine below keeps a single pooled requests.Session (so connections to a
+host are reused), runs a bounded number of downloads in parallel, and spaces
+the requests out with a token bucket per host so that we stay below the rate
+at which Yahoo starts throttling us. Given a ResponseCache (http_cache.py),
+it answers the requests already downloaded from disk, without spending any
+of the host's rate limit."""
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pipeline.http_cache import CacheMiss
+from pipeline.metrics import NULL_METRICS
+
+#=========================================================================================
+
+# Same browser-like headers the scripts have always sent to Yahoo
+
+DEFAULT_HEADERS = {
+    'Connection': 'keep-alive',
+    'Expires': '-1',
+    'Upgrade-Insecure-Requests': '1',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; WOW64) \
+    AppleWebKit/537.36 (KHTML, like Gecko) Chrome/54.0.2840.99 Safari/537.36'
+}
+
+# Result of a single download: status_code is None when the request itself failed
+FetchResult = namedtuple('FetchResult', ['key', 'url', 'status_code', 'content', 'elapsed', 'error'])
+
+#=========================================================================================
+
+class TokenBucket:
+    """ A thread-safe token bucket rate limiter
+
+    Tokens are added continuously at `rate` per second, up to `capacity`.
+    Every request takes one token, waiting for it if the bucket is empty.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: number of tokens added per second
+        :param capacity: maximum number of tokens held (burst size), defaults to max(1, rate)
+        """
+        if rate <= 0:
+            raise ValueError(f"Token bucket rate must be positive, got {rate}")
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def set_rate(self, rate):
+        """ change the refill rate, keeping the tokens accumulated so far
+        :param rate: new number of tokens added per second
+        """
+        if rate <= 0:
+            raise ValueError(f"Token bucket rate must be positive, got {rate}")
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = float(rate)
+
+    def acquire(self, tokens=1):
+        """ block until `tokens` tokens are available, then take them
+        :param tokens: number of tokens to take
+        :return: number of seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+#=========================================================================================
+
+class FetchEngine:
+    """ Download many URLs over a pooled session with bounded concurrency
+
+    Usage:
+        with FetchEngine(max_workers=8, rate=4) as engine:
+            for result in engine.fetch_all([(symbol, link), ...]):
+                ...
+    """
+
+    def __init__(self, max_workers=8, rate=4.0, burst=None, headers=None, timeout=30, metrics=NULL_METRICS, cache=None):
+        """
+        :param max_workers: maximum number of downloads in flight at once
+        :param rate: maximum requests per second sent to any single host
+        :param burst: number of requests a host may receive back-to-back, defaults to max(1, rate)
+        :param headers: HTTP headers sent with every request, defaults to DEFAULT_HEADERS
+        :param timeout: seconds to wait for a response before giving up
+        :param metrics: RunMetrics recording the latency, status and size of every download
+        :param cache: ResponseCache the successful responses are kept in and read from, None for no cache
+        """
+        self.max_workers = max_workers
+        self.metrics = metrics
+        self.cache = cache
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+
+        # One connection pool per host, each large enough for every worker to hold a connection
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update(DEFAULT_HEADERS if headers is None else headers)
+
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ close the pooled connections """
+        self.session.close()
+
+    def set_rate(self, rate):
+        """ change the per-host request rate, for hosts already seen and those to come
+        :param rate: maximum requests per second sent to any single host
+        """
+        with self._buckets_lock:
+            self.rate = rate
+            for bucket in self._buckets.values():
+                bucket.set_rate(rate)
+
+    def bucket_for(self, url):
+        """ get (or create) the token bucket that rate limits the host of `url`
+        :param url: any URL on the host
+        :return: TokenBucket
+        """
+        host = urlsplit(url).netloc
+        with self._buckets_lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self._buckets[host] = bucket
+            return bucket
+
+    def fetch(self, key, url):
+        """ download a single URL, waiting for the host's rate limiter first
+        :param key: caller's identifier for this download (e.g. the Yahoo symbol)
+        :param url: URL to download
+        :return: FetchResult
+        """
+        if self.cache is not None:
+            start = time.perf_counter()
+            content = self.cache.get(url)
+            if content is not None:
+                self.metrics.count('http_cache', result='hit')
+                return FetchResult(key, url, 200, content, time.perf_counter() - start, None)
+            self.metrics.count('http_cache', result='miss')
+            if self.cache.mode == 'replay':
+                # Offline: a request never downloaded is given up, as if it did not exist
+                return FetchResult(key, url, 404, b'', time.perf_counter() - start, CacheMiss(url))
+
+        self.bucket_for(url).acquire()
+        start = time.perf_counter()
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+            result = FetchResult(key, url, response.status_code, response.content, time.perf_counter() - start, None)
+        except requests.RequestException as e:
+            result = FetchResult(key, url, None, b'', time.perf_counter() - start, e)
+        self.metrics.observe('fetch_seconds', result.elapsed)
+        self.metrics.count('http_responses', status=result.status_code or 'error')
+        self.metrics.count('bytes_downloaded', len(result.content))
+        if self.cache is not None and result.status_code == 200:
+            self.cache.put(url, result.content)
+        return result
+
+    def fetch_all(self, jobs):
+        """ download every (key, url) pair, yielding results as they complete
+        :param jobs: iterable of (key, url) tuples
+        :return: generator of FetchResult, in completion order
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='fetch') as executor:
+            futures = [executor.submit(self.fetch, key, url) for key, url in jobs]
+            logging.info(f"Queued {len(futures)} downloads on {self.max_workers} workers at {self.rate} requests/second per host")
+            for future in as_completed(futures):
+                yield future.result()
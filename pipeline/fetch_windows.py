@@ -0,0 +1,90 @@
+""" fetch_windows.py - Download only the dates we do not hold yet
+
+load_data_db.py used to request every symbol's history from 2010-01-01, even
+when most of it had already been downloaded into earlier database_*.csv pieces.
+Here each symbol gets its own window, starting the day after the last date
+held for it in the price store (the per-symbol watermark). Windows shorter
+than a few days are not worth a request of their own: those symbols are
+deferred and picked up by a later pass, once their gap has grown."""
+import glob
+import logging
+import os
+from datetime import date, datetime, timedelta, timezone
+
+from pipeline.watermarks import file_checksum
+
+#=========================================================================================
+
+def import_pieces(price_store, pattern="output/database_*.csv"):
+    """ load database_*.csv pieces written by earlier runs into the price store, once each
+
+    Every imported piece is recorded as a global watermark named "piece:<file name>",
+    so it is skipped by later calls unless its content changed.
+
+    :param price_store: PriceStore to load the pieces into
+    :param pattern: glob pattern of the piece files
+    :return: number of pieces imported
+    """
+    imported = 0
+    for piece in sorted(glob.glob(pattern)):
+        checksum = file_checksum(piece)
+        previous = price_store.watermarks.get_global(f"piece:{os.path.basename(piece)}")
+        if previous is not None and previous['checksum'] == checksum:
+            continue
+        rows_written = price_store.import_wide_csv(piece)
+        mark_piece_imported(price_store, piece, rows_written, checksum)
+        logging.info(f"Imported {rows_written} prices from {piece} into the price store")
+        imported += 1
+    return imported
+
+
+def mark_piece_imported(price_store, piece, rows_written, checksum=None):
+    """ record that the prices of a database_*.csv piece are in the price store, so import_pieces skips it
+    :param price_store: PriceStore holding the prices
+    :param piece: path of the piece file
+    :param rows_written: number of prices the piece held
+    :param checksum: SHA-256 of the piece, computed if None
+    """
+    checksum = file_checksum(piece) if checksum is None else checksum
+    with price_store.conn:
+        price_store.watermarks.set_global(None, rows_written, None, checksum, name=f"piece:{os.path.basename(piece)}")
+
+
+def missing_windows(symbols, symbol_watermarks, default_start, end, min_gap_days=5):
+    """ work out the date range each symbol still needs
+    :param symbols: list of symbols to refresh
+    :param symbol_watermarks: dictionary of symbol -> watermark (with 'last_date'), as returned by Watermarks.get_symbols
+    :param default_start: first date wanted for a symbol we hold nothing for
+    :param end: last date wanted
+    :param min_gap_days: windows of fewer days than this are deferred
+    :return: (windows, deferred, up_to_date) - dictionary of symbol -> (start, end) dates to download,
+             list of symbols deferred to a later pass, list of symbols needing nothing
+    """
+    windows, deferred, up_to_date = {}, [], []
+    for symbol in symbols:
+        watermark = symbol_watermarks.get(symbol)
+        if watermark is None or watermark['last_date'] is None:
+            windows[symbol] = (default_start, end)
+            continue
+
+        start = date.fromisoformat(watermark['last_date']) + timedelta(days=1)
+        gap_days = (end - start).days + 1
+        if gap_days <= 0:
+            up_to_date.append(symbol)
+        elif gap_days < min_gap_days:
+            deferred.append(symbol)
+        else:
+            windows[symbol] = (start, end)
+    return windows, deferred, up_to_date
+
+
+def window_link(link, start, end):
+    """ fill in the {timestmp1}/{timestmp2} placeholders of a yahoo_links template for a date window
+    :param link: link template from yahoo_links
+    :param start: first date wanted
+    :param end: last date wanted (Yahoo's period2 is exclusive, so the link asks up to the next midnight)
+    :return: link
+    """
+    timestmp1 = int(datetime(start.year, start.month, start.day, tzinfo=timezone.utc).timestamp())
+    timestmp2 = int(datetime(end.year, end.month, end.day, tzinfo=timezone.utc).timestamp()) + 86400
+    return link.replace('{timestmp1}', str(timestmp1)).replace('{timestmp2}', str(timestmp2))
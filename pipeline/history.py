@@ -0,0 +1,202 @@
+""" history.py - The initial load of the price history of every symbol
+
+Part 2 of load_data_db.py, as a function: for every symbol of yahoo_links not
+updated in the last 22 hours, download the dates since 2010-01-01 not held in
+the price store yet (see fetch_windows.py), save them as one history_*.csv
+piece and in the price store, and publish a snapshot. Importing the module
+does nothing; the CLI (python -m pipeline init-universe) and load_data_db.py
+call load_history after init_universe.
+
+    summary = load_history(metrics=RunMetrics('load_data_db'))"""
+import logging
+import os
+import sqlite3
+from datetime import date, datetime, timedelta, timezone
+
+import pandas as pd
+
+from pipeline.assemble import align_arrays
+from pipeline.fetch import FetchEngine
+from pipeline.fetch_windows import import_pieces, mark_piece_imported, missing_windows, window_link
+from pipeline.metrics import NULL_METRICS
+from pipeline.parse import ParsePool
+from pipeline.price_store import DEFAULT_PRICE_STORE_FILE, PriceStore
+from pipeline.registry import REGISTRY_FILE, configure_connection, ensure_indexes, mark_updated, read_registry
+from pipeline.snapshot import DEFAULT_SNAPSHOT_DIR, publish_snapshot
+from pipeline.update import OUTPUT_DIR, STALE_AFTER
+
+#=========================================================================================
+
+# First date of the history loaded
+HISTORY_START = date(2010, 1, 1)
+
+# Prefix of the CSV pieces of the history - distinct from the database_<run date>_* pieces of the daily update,
+# so that a full history is never compacted into the master data file as a day's prices
+HISTORY_PIECE_PREFIX = "history"
+
+#=========================================================================================
+
+def ensure_last_update(conn):
+    """ add the last_update column to a yahoo_links table written before it existed
+    :param conn: sqlite3 Connection to the registry database
+    """
+    col_last_update_exists, = conn.execute("SELECT EXISTS (SELECT * FROM sqlite_master WHERE tbl_name = 'yahoo_links' AND sql LIKE '%last_update%');").fetchone()
+    if col_last_update_exists == 0:
+        with conn:
+            conn.execute("ALTER TABLE yahoo_links ADD COLUMN last_update timestamp DEFAULT NULL")
+            conn.execute("UPDATE yahoo_links SET last_update = DATETIME('1970-01-01 00:00:00')")
+
+
+def load_history(db_file=REGISTRY_FILE, price_store_file=DEFAULT_PRICE_STORE_FILE, output_dir=OUTPUT_DIR,
+                 snapshot_dir=DEFAULT_SNAPSHOT_DIR, history_start=HISTORY_START, fetch_max_workers=8,
+                 fetch_requests_per_second=4, parse_workers=None, min_gap_days=5, metrics=NULL_METRICS, cache=None):
+    """ download the missing history, up to yesterday, of every symbol not updated in the last 22 hours
+    :param db_file: registry database holding yahoo_links
+    :param price_store_file: database of the price store
+    :param output_dir: directory the CSV piece is written to, and the pieces of earlier runs are read from
+    :param snapshot_dir: directory the snapshots are published in
+    :param history_start: first date wanted for a symbol nothing is held for
+    :param fetch_max_workers: number of downloads in flight at once
+    :param fetch_requests_per_second: most requests per second sent to Yahoo
+    :param parse_workers: number of processes parsing the downloads (None = one per CPU, 1 = parse in this process)
+    :param min_gap_days: symbols missing fewer days than this are left for a later pass instead of costing a request each now
+    :param metrics: RunMetrics of the run
+    :param cache: ResponseCache of the downloads, None for no cache
+    :return: dictionary summarizing the run
+    """
+    conn = configure_connection(sqlite3.connect(db_file))
+    price_store = PriceStore(price_store_file)
+    try:
+        ensure_last_update(conn)
+        # The yahoo_links indexes are no longer dropped by our updates, so they only need creating once
+        ensure_indexes(conn)
+        logging.info("\nStarting Yahoo link processing")
+
+        # look only as far as yesterday's close date, in case closing price is not yet available when running today
+        dt_now = date.today() - timedelta(days=1)
+        dt_now = datetime(dt_now.year, dt_now.month, dt_now.day, tzinfo=timezone.utc)
+        dt_start = datetime(history_start.year, history_start.month, history_start.day, tzinfo=timezone.utc)
+        logging.info(f"\nYahoo period1 = {int(dt_start.timestamp())} corresponds to date {dt_start}")
+        logging.info(f"\nYahoo period2 = {int(dt_now.timestamp())} corresponds to date {dt_now}")
+
+        # Read only those securities that were not updated within the last 22 hours - the filter runs in SQLite
+        time_22hours_ago = (datetime.utcnow() - STALE_AFTER).isoformat(sep=" ", timespec="seconds")
+        with metrics.span('registry_read'):
+            df_Yahoo_links = read_registry(conn, columns=['Yahoo_Symbol', 'Yahoo_Listings_Link'], updated_before=time_22hours_ago)
+        logging.info(f"\nRead {df_Yahoo_links.shape[0]} symbols to update.\n{df_Yahoo_links.head()}")
+
+        # Work out which dates we are missing for each symbol, so that we only download those.
+        # Pieces saved by earlier runs are loaded into the price store first, so their dates count as held.
+        import_pieces(price_store, os.path.join(output_dir, "database_*.csv"))
+        import_pieces(price_store, os.path.join(output_dir, f"{HISTORY_PIECE_PREFIX}_*.csv"))
+        list_symbols_needing_update = df_Yahoo_links['Yahoo_Symbol'].to_list()
+        dict_windows, list_deferred, list_up_to_date = missing_windows(
+              list_symbols_needing_update
+            , price_store.watermarks.get_symbols(list_symbols_needing_update)
+            , dt_start.date()
+            , dt_now.date()
+            , min_gap_days
+        )
+        logging.info(f"\n{len(dict_windows)} symbols to download, {len(list_deferred)} deferred to a later pass (fewer than {min_gap_days} days missing), {len(list_up_to_date)} already up to date")
+
+        # Replace the placeholders in each link with the timestamps of the dates its symbol is missing
+        list_downloads = []
+        for symbol, link in zip(df_Yahoo_links['Yahoo_Symbol'], df_Yahoo_links['Yahoo_Listings_Link']):
+            if symbol in dict_windows:
+                window_start, window_end = dict_windows[symbol]
+                list_downloads.append((symbol, window_link(link, window_start, window_end)))
+
+        rows_written = 0
+        if len(list_downloads) > 0:
+            rows_written = _download_history(conn, price_store, list_downloads, dt_start, dt_now, output_dir,
+                                             fetch_max_workers, fetch_requests_per_second, parse_workers, metrics, cache)
+
+        # The securities already up to date are stamped as updated too, whether or not anything was downloaded
+        with metrics.span('mark_updated'):
+            mark_updated(conn, list_up_to_date, datetime.utcnow().isoformat(sep=" ", timespec="seconds"))
+
+        # Publish a memory-mapped snapshot of all the prices, which readers open without parsing anything
+        with metrics.span('snapshot_publish'):
+            snapshot_manifest = publish_snapshot(price_store, snapshot_dir)
+        logging.info(f"\nPublished price snapshot {snapshot_manifest['version']}: {snapshot_manifest['n_dates']} dates x {snapshot_manifest['n_symbols']} symbols")
+    finally:
+        price_store.close()
+        conn.close()
+
+    return {
+          'downloads'        : len(list_downloads)
+        , 'deferred'         : len(list_deferred)
+        , 'up_to_date'       : len(list_up_to_date)
+        , 'prices_written'   : rows_written
+        , 'snapshot_version' : snapshot_manifest['version']
+    }
+
+
+def _download_history(conn, price_store, list_downloads, dt_start, dt_now, output_dir,
+                      fetch_max_workers, fetch_requests_per_second, parse_workers, metrics, cache):
+    """ download, parse and save one batch of histories
+    :return: number of prices written to the price store
+    """
+    list_payloads = []
+    logging.info(f"\nNumber of securities to update = {len(list_downloads)}")
+
+    # Start the parsing processes before any download threads
+    with ParsePool(parse_workers) as parse_pool, FetchEngine(max_workers=fetch_max_workers, rate=fetch_requests_per_second,
+                                                            metrics=metrics, cache=cache) as engine:
+
+        # Download over a pooled session, a few symbols at a time, without going over Yahoo's request rate
+        with metrics.span('download'):
+            for result in engine.fetch_all(list_downloads):
+                symbol = result.key
+                logging.info(f"\nDownloaded historical prices for symbol '{symbol}' from {result.url} in {result.elapsed:.2f}s")
+                if result.error is not None:
+                    logging.error(f"Failed {symbol}: {result.error}")
+                elif result.status_code == 200:
+                    # Keep the raw CSV - the whole batch is parsed in one go below
+                    list_payloads.append((symbol, result.content))
+                else:
+                    logging.info(f"Failed {symbol}: {result.status_code}")
+
+        logging.info("\nJoining all columns of the downloaded securities into a single dataframe")
+
+        # Create a series of dates from the start date of our project to yesterday's date
+        idxDates = pd.Series(pd.date_range(start=dt_start.date(), end=dt_now.date()))
+
+        # Parse all the downloaded CSVs into date and price arrays, spread over the parsing processes
+        with metrics.span('parse'):
+            parsed_prices = parse_pool.parse(list_payloads, idxDates.iloc[0], idxDates.iloc[-1])
+    for symbol, error in parsed_prices.errors:
+        logging.error(f"{symbol}: {error}")
+    metrics.count('parse_errors', len(parsed_prices.errors))
+
+    # Align all the downloaded series onto the series of dates in a single pass
+    with metrics.span('assemble'):
+        dfAllDates = align_arrays(idxDates, parsed_prices.series())
+
+    # Stamp the securities retrieved before Yahoo started throttling us as updated -
+    # only their rows are written, so the table and its indexes stay in place
+    with metrics.span('mark_updated'):
+        mark_updated(conn, dfAllDates.columns.to_list(), datetime.utcnow().isoformat(sep=" ", timespec="seconds"))
+
+    # Before writing out our dataframe, drop any rows that contain only NULL values
+    logging.info(f"Before dropping empty rows, rowcount = {dfAllDates.shape[0]}")
+    with metrics.span('drop_empty_rows'):
+        df_trading_dates = dfAllDates.drop(dfAllDates[dfAllDates.any(axis=1) == False].index, axis=0)
+    logging.info(f"After dropping empty rows, rowcount = {df_trading_dates.shape[0]}")
+
+    # SQLite3 has a limitation of 2,000 columns so the wide prices are written to CSV
+    output_datestamp = datetime.now().isoformat(sep=" ", timespec="seconds").replace('-', '').replace(':', '').replace(' ', '_')
+    outputfilename = os.path.join(output_dir, f"{HISTORY_PIECE_PREFIX}_{output_datestamp}_{len(df_trading_dates.columns)-1}.csv")
+    logging.info(f"\nSaving joined dataframe to file: {outputfilename}")
+    with metrics.span('csv_write'), open(outputfilename, "w") as filehandle:
+        df_trading_dates.to_csv(filehandle, index=True, lineterminator = '\n', encoding='utf-8')
+    metrics.count('piece_rows_written', df_trading_dates.shape[0])
+    metrics.count('piece_columns_written', df_trading_dates.shape[1])
+
+    # Also store the prices in long format, where the 2,000 column limit does not apply
+    with metrics.span('store_append'):
+        rows_written = price_store.append(df_trading_dates)
+    metrics.count('prices_written', rows_written)
+    mark_piece_imported(price_store, outputfilename, rows_written)
+    logging.info(f"Appended {rows_written} prices to the price store")
+    return rows_written
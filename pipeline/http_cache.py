@@ -0,0 +1,241 @@
+""" http_cache.py - Persistent, content-addressed cache of the HTTP responses downloaded
+
+A run that dies after downloading hundreds of symbols, but before saving them,
+used to lose every download - and the next run spent the upstream rate limit
+again to get the very same bytes. A FetchEngine given a ResponseCache keeps
+every 200 response on disk, and answers the same request from disk without
+spending a token of the host's rate limit:
+
+    output/http_cache/index.sqlite3            normalized URL -> body, time stored, time last read
+    output/http_cache/objects/ab/cdef....zz    zlib-compressed bodies, named by the SHA-256 of their content
+
+The key is the SHA-256 of the normalized URL (lower-case scheme and host,
+default port dropped, query parameters sorted, fragment dropped): a Yahoo link
+carries the date window it asks for (period1, period2), so each window of each
+symbol is an entry of its own. Identical bodies are stored once. Entries older
+than the TTL are not used, and once the bodies take more than max_bytes the
+entries read least recently are evicted.
+
+Modes:
+  * use       read the cache, download and store on a miss (the default)
+  * refresh   always download, and store
+  * replay    only read the cache, never touch the network: a miss is answered as
+              a 404 with a CacheMiss error - the whole pipeline can be rerun offline
+
+    with FetchEngine(cache=ResponseCache(mode='replay')) as engine:
+        ..."""
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+#=========================================================================================
+
+DEFAULT_CACHE_DIR = "output/http_cache"
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+MODES = ['use', 'refresh', 'replay']
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Entries evicted at a time once the cache is over its size
+EVICTION_BATCH = 100
+
+#=========================================================================================
+
+class CacheMiss(Exception):
+    """ A request not in the cache, in replay mode """
+
+
+def normalize_url(url):
+    """ normalize a URL so that equivalent requests share a cache entry
+    :param url: absolute URL
+    :return: URL with a lower-case scheme and host, no default port, sorted query parameters and no fragment
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+
+def url_key(url):
+    """ cache key of a URL: SHA-256 of its normalized form """
+    return hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+
+#=========================================================================================
+
+class ResponseCache:
+    """ Bodies of successful responses on disk, shared by the threads of a FetchEngine """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, mode='use', ttl=DEFAULT_TTL_SECONDS, max_bytes=DEFAULT_MAX_BYTES,
+                 compress_level=6):
+        """
+        :param cache_dir: directory of the cache, created if needed
+        :param mode: one of MODES
+        :param ttl: seconds an entry can be used for after it was stored (replay ignores it)
+        :param max_bytes: most bytes of compressed bodies kept
+        :param compress_level: zlib compression level of the bodies
+        """
+        if mode not in MODES:
+            raise ValueError(f"cache mode must be one of {MODES}, not {mode!r}")
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.compress_level = compress_level
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "index.sqlite3"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=30000")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                  key      TEXT    NOT NULL PRIMARY KEY
+                , url      TEXT    NOT NULL
+                , body     TEXT    NOT NULL
+                , stored   REAL    NOT NULL
+                , accessed REAL    NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_responses_accessed ON responses (accessed);
+            CREATE INDEX IF NOT EXISTS ix_responses_body ON responses (body);
+            CREATE TABLE IF NOT EXISTS bodies (
+                  body            TEXT    NOT NULL PRIMARY KEY
+                , size            INTEGER NOT NULL
+                , compressed_size INTEGER NOT NULL
+            );
+        """)
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _body_file(self, body):
+        return os.path.join(self.cache_dir, "objects", body[:2], body[2:] + ".zz")
+
+    #=====================================================================================
+
+    def get(self, url):
+        """ read the body cached for a URL
+        :param url: URL requested
+        :return: body bytes, None on a miss (or in refresh mode)
+        """
+        if self.mode == 'refresh':
+            return None
+        key = url_key(url)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT body, stored FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.mode != 'replay' and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            body, _ = row
+            with self.conn:
+                self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        try:
+            with open(self._body_file(body), 'rb') as filehandle:
+                content = zlib.decompress(filehandle.read())
+        except (OSError, zlib.error) as e:
+            # A body lost or damaged on disk is a miss; the entry is replaced by the next download
+            logging.warning(f"Cached response of {url} unreadable, ignored: {e}")
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return content
+
+    def put(self, url, content):
+        """ store the body of a successful response (nothing is stored in replay mode)
+        :param url: URL requested
+        :param content: body bytes
+        """
+        if self.mode == 'replay':
+            return
+        body = hashlib.sha256(content).hexdigest()
+        body_file = self._body_file(body)
+        with self.lock:
+            known = self.conn.execute("SELECT 1 FROM bodies WHERE body = ?", (body,)).fetchone() is not None
+        if not known or not os.path.exists(body_file):
+            compressed = zlib.compress(content, self.compress_level)
+            os.makedirs(os.path.dirname(body_file), exist_ok=True)
+            # Written under a temporary name, then renamed: a body file is always complete
+            handle, temp_file = tempfile.mkstemp(prefix=".body_", dir=os.path.dirname(body_file))
+            try:
+                with os.fdopen(handle, 'wb') as filehandle:
+                    filehandle.write(compressed)
+                os.replace(temp_file, body_file)
+            except BaseException:
+                os.unlink(temp_file)
+                raise
+            compressed_size = len(compressed)
+        now = time.time()
+        with self.lock:
+            with self.conn:
+                if not known:
+                    self.conn.execute("INSERT OR REPLACE INTO bodies (body, size, compressed_size) VALUES (?, ?, ?)",
+                                      (body, len(content), compressed_size))
+                self.conn.execute("INSERT OR REPLACE INTO responses (key, url, body, stored, accessed) VALUES (?, ?, ?, ?, ?)",
+                                  (url_key(url), normalize_url(url), body, now, now))
+            if not known:
+                self._evict()
+
+    #=====================================================================================
+
+    def size(self):
+        """ bytes of compressed bodies held """
+        return self.conn.execute("SELECT COALESCE(SUM(compressed_size), 0) FROM bodies").fetchone()[0]
+
+    def _delete_entries(self, keys):
+        """ delete entries, and the bodies no other entry uses (call with the lock held) """
+        with self.conn:
+            bodies = {body for body, in self.conn.execute(
+                f"SELECT DISTINCT body FROM responses WHERE key IN ({','.join('?' * len(keys))})", keys)}
+            self.conn.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key in keys])
+            orphans = [body for body in bodies
+                       if self.conn.execute("SELECT 1 FROM responses WHERE body = ? LIMIT 1", (body,)).fetchone() is None]
+            self.conn.executemany("DELETE FROM bodies WHERE body = ?", [(body,) for body in orphans])
+        for body in orphans:
+            try:
+                os.unlink(self._body_file(body))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        """ evict the entries read least recently until the bodies fit in max_bytes (call with the lock held) """
+        total = self.size()
+        while total > self.max_bytes:
+            keys = [key for key, in self.conn.execute("SELECT key FROM responses ORDER BY accessed LIMIT ?", (EVICTION_BATCH,))]
+            if len(keys) == 0:
+                break
+            self._delete_entries(keys)
+            total = self.size()
+
+    def purge(self):
+        """ delete the entries older than the TTL, and evict down to max_bytes
+        :return: number of entries deleted
+        """
+        with self.lock:
+            keys = [key for key, in self.conn.execute("SELECT key FROM responses WHERE stored < ?", (time.time() - self.ttl,))]
+            for start in range(0, len(keys), EVICTION_BATCH):
+                self._delete_entries(keys[start:start + EVICTION_BATCH])
+            self._evict()
+        return len(keys)
@@ -0,0 +1,278 @@
+""" metrics.py - Structured timings and counts of an update run
+
+The log of a run tells what happened, not how long each phase took, how the
+download latencies were spread or how many requests failed. A RunMetrics
+collects, for one run of update_data_db.py or load_data_db.py:
+
+  * spans       wall time of each phase (repeated phases, e.g. one per batch, add up)
+  * histograms  distributions, e.g. the latency of every download, in fixed buckets
+  * counters    totals, labelled or not, e.g. bytes downloaded, responses per HTTP status, rows written
+
+and writes them, at the end of the run, as a JSON run summary and as a
+Prometheus textfile (for the node_exporter textfile collector):
+
+    run_metrics = RunMetrics('update_data_db')
+    with run_metrics.span('download'):
+        ...
+    run_metrics.observe('fetch_seconds', result.elapsed)
+    run_metrics.count('http_responses', status=result.status_code)
+    run_metrics.write('output/metrics')    # output/metrics/update_data_db_<time>.json and update_data_db.prom
+
+When metrics are off the scripts use NULL_METRICS instead, whose methods do
+nothing: instrumented code pays one no-op method call per event."""
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+#=========================================================================================
+
+DEFAULT_METRICS_DIR = "output/metrics"
+METRIC_PREFIX = "portfolio_analyzer"
+
+# Upper bounds of the histogram buckets, in seconds - from a fast local response to a throttled one
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+#=========================================================================================
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullMetrics:
+    """ Metrics turned off: every method does nothing """
+
+    enabled = False
+
+    def span(self, name):
+        return _NULL_SPAN
+
+    def observe(self, name, value):
+        pass
+
+    def count(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def write(self, metrics_dir=DEFAULT_METRICS_DIR):
+        return None
+
+
+NULL_METRICS = NullMetrics()
+
+
+class _Span:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics._end_span(self.name, self.start, time.perf_counter(), exc_type is not None)
+        return False
+
+
+class RunMetrics:
+    """ Spans, histograms and counters of one run, safe to update from several threads """
+
+    enabled = True
+
+    def __init__(self, job, buckets=LATENCY_BUCKETS):
+        """
+        :param job: name of the script, used in the file names and as the job label
+        :param buckets: upper bounds of the histogram buckets
+        """
+        self.job = job
+        self.buckets = tuple(buckets)
+        self.started = datetime.utcnow()
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.spans = OrderedDict()      # name -> {'seconds', 'count', 'errors', 'first_start'}
+        self.histograms = OrderedDict() # name -> {'buckets': counts, 'sum', 'count', 'min', 'max'}
+        self.counters = OrderedDict()   # (name, sorted label items) -> value
+        self.values = OrderedDict()     # name -> last value set
+
+    #=====================================================================================
+
+    def span(self, name):
+        """ time a phase of the run: with run_metrics.span('parse'): ...
+        :param name: name of the phase
+        :return: context manager
+        """
+        return _Span(self, name)
+
+    def _end_span(self, name, start, end, failed):
+        with self.lock:
+            span = self.spans.get(name)
+            if span is None:
+                span = self.spans[name] = {'seconds': 0.0, 'count': 0, 'errors': 0, 'first_start': start - self.start}
+            span['seconds'] += end - start
+            span['count'] += 1
+            span['errors'] += int(failed)
+
+    def observe(self, name, value):
+        """ add a value to a histogram
+        :param name: name of the histogram
+        :param value: value observed, e.g. a latency in seconds
+        """
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0,
+                                                     'count': 0, 'min': value, 'max': value}
+            histogram['buckets'][position] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+            histogram['min'] = min(histogram['min'], value)
+            histogram['max'] = max(histogram['max'], value)
+
+    def count(self, name, value=1, **labels):
+        """ add to a counter
+        :param name: name of the counter
+        :param value: amount added
+        :param labels: labels of the counter, e.g. status=200
+        """
+        key = (name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value):
+        """ record a value of the run, e.g. the number of symbols queued
+        :param name: name of the value
+        :param value: number
+        """
+        with self.lock:
+            self.values[name] = value
+
+    #=====================================================================================
+
+    def _quantile(self, histogram, q):
+        """ estimate a quantile by linear interpolation within its bucket """
+        rank = q * histogram['count']
+        cumulative = 0
+        for i, bucket_count in enumerate(histogram['buckets']):
+            if bucket_count > 0 and cumulative + bucket_count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else histogram['min']
+                upper = self.buckets[i] if i < len(self.buckets) else histogram['max']
+                lower, upper = max(lower, histogram['min']), min(upper, histogram['max'])
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return histogram['max']
+
+    def summary(self):
+        """ get everything collected as a dictionary ready for json.dump """
+        with self.lock:
+            counters = OrderedDict()
+            for (name, labels), value in self.counters.items():
+                if labels:
+                    counters.setdefault(name, OrderedDict())[",".join(f"{k}={v}" for k, v in labels)] = value
+                else:
+                    counters[name] = value
+            return {
+                  'job'        : self.job
+                , 'started'    : self.started.isoformat(sep=" ", timespec="seconds")
+                , 'seconds'    : time.perf_counter() - self.start
+                , 'spans'      : {name: dict(span) for name, span in self.spans.items()}
+                , 'histograms' : {name: {
+                                      'count' : h['count']
+                                    , 'sum'   : h['sum']
+                                    , 'mean'  : h['sum'] / h['count']
+                                    , 'min'   : h['min']
+                                    , 'p50'   : self._quantile(h, 0.5)
+                                    , 'p90'   : self._quantile(h, 0.9)
+                                    , 'p99'   : self._quantile(h, 0.99)
+                                    , 'max'   : h['max']
+                                    , 'buckets' : dict(zip([str(b) for b in self.buckets] + ['+Inf'], h['buckets']))
+                                 } for name, h in self.histograms.items()}
+                , 'counters'   : counters
+                , 'values'     : dict(self.values)
+            }
+
+    def prometheus(self, prefix=METRIC_PREFIX):
+        """ render everything collected in the Prometheus text exposition format
+        :param prefix: prefix of the metric names
+        :return: text
+        """
+        job = f'job="{self.job}"'
+        summary = self.summary()
+        lines = [
+              f"# HELP {prefix}_run_seconds Wall time of the run"
+            , f"# TYPE {prefix}_run_seconds gauge"
+            , f"{prefix}_run_seconds{{{job}}} {summary['seconds']:.6f}"
+            , f"# HELP {prefix}_run_timestamp_seconds Unix time the run ended at"
+            , f"# TYPE {prefix}_run_timestamp_seconds gauge"
+            , f"{prefix}_run_timestamp_seconds{{{job}}} {time.time():.0f}"
+            , f"# HELP {prefix}_phase_seconds Wall time spent in each phase of the run"
+            , f"# TYPE {prefix}_phase_seconds gauge"
+        ]
+        lines.extend(f'{prefix}_phase_seconds{{{job},phase="{name}"}} {span["seconds"]:.6f}' for name, span in summary['spans'].items())
+
+        with self.lock:
+            histograms = {name: dict(h, buckets=list(h['buckets'])) for name, h in self.histograms.items()}
+            counters = list(self.counters.items())
+            values = list(self.values.items())
+        for name, histogram in histograms.items():
+            lines.append(f"# TYPE {prefix}_{name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip([str(b) for b in self.buckets] + ['+Inf'], histogram['buckets']):
+                cumulative += bucket_count
+                lines.append(f'{prefix}_{name}_bucket{{{job},le="{bound}"}} {cumulative}')
+            lines.append(f"{prefix}_{name}_sum{{{job}}} {histogram['sum']:.6f}")
+            lines.append(f"{prefix}_{name}_count{{{job}}} {histogram['count']}")
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                typed.add(name)
+            label_text = "".join(f',{label}="{label_value}"' for label, label_value in labels)
+            lines.append(f"{prefix}_{name}_total{{{job}{label_text}}} {value}")
+        for name, value in values:
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name}{{{job}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, metrics_dir=DEFAULT_METRICS_DIR):
+        """ write the run summary as <job>_<start time>.json and the Prometheus textfile as <job>.prom, atomically
+        :param metrics_dir: directory written to
+        :return: path of the JSON file
+        """
+        os.makedirs(metrics_dir, exist_ok=True)
+        json_file = os.path.join(metrics_dir, f"{self.job}_{self.started.strftime('%Y%m%d_%H%M%S')}.json")
+        _write_atomic(json_file, json.dumps(self.summary(), indent=2))
+        _write_atomic(os.path.join(metrics_dir, f"{self.job}.prom"), self.prometheus())
+        return json_file
+
+
+def _write_atomic(file_name, text):
+    """ write a file through a temporary file renamed over it, so readers never see it half written """
+    handle, temp_file = tempfile.mkstemp(prefix=f".{os.path.basename(file_name)}_", dir=os.path.dirname(os.path.abspath(file_name)))
+    try:
+        with os.fdopen(handle, 'w', encoding='utf-8') as filehandle:
+            filehandle.write(text)
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, file_name)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
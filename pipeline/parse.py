@@ -0,0 +1,325 @@
+""" parse.py - Parse a batch of downloaded Yahoo price CSVs straight into numpy arrays
+
+Every downloaded history used to go through
+
+    df = pd.read_csv(io.BytesIO(result.content), usecols=["Date", "Adj Close"])
+    df['Date'] = pd.to_datetime(df['Date'])
+    df.columns = ["Date", symbol]
+    df.set_index('Date', drop=True, inplace=True)
+
+one symbol at a time: a dataframe, a column of Python date strings and a date
+format guess per symbol, only for align_frames() to take the arrays back out.
+parse_price_payloads() does a whole batch in one call, on the response bytes:
+
+  * the payloads sharing a header (all of them, in practice) are concatenated
+    into one buffer, without their header lines,
+  * the dates are read from the first 10 bytes of every line - Yahoo writes
+    them as fixed-width YYYY-MM-DD - and converted to datetime64[D] with
+    integer arithmetic, without creating a single string,
+  * the Adj Close column is read with a single pandas C parser call,
+  * the result is three flat arrays (dates, values, and per-symbol offsets
+    into them), ready for align_arrays().
+
+A payload whose lines do not start with an ISO date goes through the old
+pandas path instead, so odd responses are parsed as before.
+
+ParsePool spreads the parsing of a batch over worker processes, in chunks of
+payloads. Each worker also drops the missing prices and the dates outside the
+wanted range, and sends back only the flat arrays, not dataframes."""
+import io
+import logging
+import math
+import multiprocessing
+import os
+import signal
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+#=========================================================================================
+
+DATE_COLUMN = b"Date"
+PRICE_COLUMN = b"Adj Close"
+
+_DATE_WIDTH = 10 # YYYY-MM-DD
+_DIGIT_POSITIONS = [0, 1, 2, 3, 5, 6, 8, 9]
+
+#=========================================================================================
+
+class ParsedPrices(namedtuple('ParsedPrices', ['symbols', 'offsets', 'dates', 'values', 'errors'])):
+    """ Prices of a batch of payloads: the rows of symbols[i] are dates[offsets[i]:offsets[i + 1]]
+        and values[offsets[i]:offsets[i + 1]]; errors lists the (symbol, message) of the payloads
+        that could not be parsed """
+    __slots__ = ()
+
+    def series(self):
+        """ iterate over the (symbol, dates, values) of each symbol, as views - the input of align_arrays
+        :return: generator of (symbol, datetime64[D] array, float array)
+        """
+        for i, symbol in enumerate(self.symbols):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            yield symbol, self.dates[start:end], self.values[start:end]
+
+#=========================================================================================
+
+def _split_header(content):
+    """ split a payload into its header fields and its body, which ends with exactly one newline """
+    header_end = content.find(b'\n')
+    if header_end < 0:
+        header, body = content, b''
+    else:
+        header, body = content[:header_end], content[header_end + 1:]
+    header = tuple(field.strip() for field in header.rstrip(b'\r').split(b','))
+    body = body.rstrip(b'\r\n')
+    return header, body + b'\n' if body else b''
+
+
+def _iso_dates(buffer):
+    """ read the YYYY-MM-DD date at the start of every line of a buffer
+    :param buffer: bytes, every line ending with a newline
+    :return: datetime64[D] array with one date per line, or None if a line does not start with an ISO date
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    starts = np.flatnonzero(data == ord('\n'))[:-1] + 1
+    starts = np.concatenate([[0], starts])
+    # Every line, newline included, must be longer than a date, or the date of a short line would be read into the next one
+    if not (np.diff(np.append(starts, len(buffer))) > _DATE_WIDTH).all():
+        return None
+    chars = data[starts[:, None] + np.arange(_DATE_WIDTH)]
+
+    digits = chars[:, _DIGIT_POSITIONS].astype(np.int64) - ord('0')
+    if ((digits < 0) | (digits > 9)).any() or (chars[:, 4] != ord('-')).any() or (chars[:, 7] != ord('-')).any():
+        return None
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 4] * 10 + digits[:, 5]
+    day = digits[:, 6] * 10 + digits[:, 7]
+    if ((month < 1) | (month > 12) | (day < 1) | (day > 31)).any():
+        return None
+
+    # Days since 1970-01-01 of a proleptic Gregorian date (H. Hinnant's days_from_civil)
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return (era * 146097 + day_of_era - 719468).astype('datetime64[D]')
+
+
+def _parse_group(bodies, price_position, dtype):
+    """ parse the concatenated bodies of payloads sharing a header
+    :return: (dates, values) arrays, or None if the bodies are not in the expected layout
+    """
+    buffer = b''.join(bodies)
+    if not buffer:
+        return np.empty(0, dtype='datetime64[D]'), np.empty(0, dtype=dtype)
+    dates = _iso_dates(buffer)
+    if dates is None:
+        return None
+    try:
+        values = pd.read_csv(io.BytesIO(buffer), header=None, usecols=[price_position], dtype={price_position: np.float64},
+                             skip_blank_lines=False, engine='c').iloc[:, 0].to_numpy(dtype=dtype)
+    except ValueError: # a price that is not a number
+        return None
+    if len(values) != len(dates):
+        return None
+    return dates, values
+
+
+def _parse_one(content, dtype):
+    """ the per-symbol pandas path, for the payloads the batch parser does not handle """
+    df = pd.read_csv(io.BytesIO(content), usecols=["Date", "Adj Close"])
+    dates = pd.to_datetime(df['Date'], utc=False).to_numpy().astype('datetime64[D]')
+    return dates, df['Adj Close'].to_numpy(dtype=dtype)
+
+#=========================================================================================
+
+def parse_price_payloads(payloads, dtype=np.float64):
+    """ parse many downloaded price CSVs in one call
+    :param payloads: iterable of (symbol, content) with content the bytes of a Yahoo download
+    :param dtype: dtype of the values (numpy.float64 or numpy.float32)
+    :return: ParsedPrices, with the symbols in the order given (less the ones in errors)
+    """
+    parsed = {}
+    errors = []
+
+    # Group the payloads by the position of their Adj Close column, so that each group can be parsed as one buffer
+    groups = {}
+    for symbol, content in payloads:
+        header, body = _split_header(content)
+        if header[0] == DATE_COLUMN and PRICE_COLUMN in header:
+            price_position = header.index(PRICE_COLUMN)
+        else:
+            price_position = None
+        parsed[symbol] = None
+        groups.setdefault(price_position, []).append((symbol, content, body))
+
+    for price_position, members in groups.items():
+        result = None if price_position is None else _parse_group([body for _, _, body in members], price_position, dtype)
+        if result is not None:
+            dates, values = result
+            start = 0
+            for symbol, _, body in members:
+                end = start + body.count(b'\n')
+                parsed[symbol] = (dates[start:end], values[start:end])
+                start = end
+            continue
+
+        # Some payload is not in the expected layout: parse them one by one, falling back on
+        # the pandas path the scripts have always used for the ones the batch parser rejects
+        for symbol, content, body in members:
+            result = None if price_position is None else _parse_group([body], price_position, dtype)
+            if result is not None:
+                parsed[symbol] = result
+                continue
+            try:
+                parsed[symbol] = _parse_one(content, dtype)
+            except Exception as e:
+                del parsed[symbol]
+                errors.append((symbol, f"{type(e).__name__}: {e}"))
+
+    symbols = list(parsed)
+    return _flatten(symbols, [parsed[symbol] for symbol in symbols], errors, dtype)
+
+
+def _flatten(symbols, arrays, errors, dtype):
+    """ build a ParsedPrices from a list of (dates, values) per symbol """
+    offsets = np.zeros(len(symbols) + 1, dtype=np.int64)
+    np.cumsum([len(dates) for dates, _ in arrays], out=offsets[1:])
+    dates = np.concatenate([dates for dates, _ in arrays]) if arrays else np.empty(0, dtype='datetime64[D]')
+    values = np.concatenate([values for _, values in arrays]) if arrays else np.empty(0, dtype=dtype)
+    return ParsedPrices(symbols, offsets, dates, values, errors)
+
+
+def clean_prices(parsed, start=None, end=None):
+    """ drop the missing prices, and the dates outside [start, end], of every symbol
+    :param parsed: ParsedPrices
+    :param start: first date kept (anything numpy.datetime64 accepts), None for no lower bound
+    :param end: last date kept, None for no upper bound
+    :return: ParsedPrices
+    """
+    keep = ~np.isnan(parsed.values)
+    if start is not None:
+        keep &= parsed.dates >= np.datetime64(start, 'D')
+    if end is not None:
+        keep &= parsed.dates <= np.datetime64(end, 'D')
+    kept_before = np.concatenate([[0], np.cumsum(keep)])
+    return ParsedPrices(parsed.symbols, kept_before[parsed.offsets], parsed.dates[keep], parsed.values[keep], parsed.errors)
+
+
+def concat_parsed(parts):
+    """ join the ParsedPrices of several chunks of payloads, in order
+    :param parts: list of ParsedPrices
+    :return: ParsedPrices
+    """
+    if len(parts) == 1:
+        return parts[0]
+    symbols, offsets, errors = [], [np.zeros(1, dtype=np.int64)], []
+    for part in parts:
+        symbols.extend(part.symbols)
+        offsets.append(part.offsets[1:] + offsets[-1][-1])
+        errors.extend(part.errors)
+    return ParsedPrices(symbols, np.concatenate(offsets), np.concatenate([part.dates for part in parts]),
+                        np.concatenate([part.values for part in parts]), errors)
+
+
+def _parse_chunk(payloads, dtype, start, end):
+    """ worker side of ParsePool """
+    return clean_prices(parse_price_payloads(payloads, dtype), start, end)
+
+
+def _init_worker():
+    """ leave Ctrl+C and SIGTERM to the parent process, which finishes its batch and shuts the pool down itself """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+#=========================================================================================
+
+class ParsePool:
+    """ Parses batches of payloads on a pool of worker processes
+
+    The workers are started as soon as the pool is created, so create it before
+    starting any threads (such as a FetchEngine's). They are forked where the
+    "fork" start method exists, which costs a few milliseconds each; elsewhere
+    (Windows) they are spawned, and each re-imports numpy and this module once.
+    The work of the scripts and of the CLI runs from main(), behind their
+    __name__ == "__main__" guards, so a spawned worker runs none of it.
+
+    If a worker dies, the workers are started again and the batch parsed once
+    more; if they die again the batch is parsed in this process.
+    """
+
+    def __init__(self, workers=None, min_chunk_size=50, dtype=np.float64):
+        """
+        :param workers: number of worker processes, None for one per CPU; 0 or 1 parses in this process
+        :param min_chunk_size: fewest payloads sent to a worker at once
+        :param dtype: dtype of the values (numpy.float64 or numpy.float32)
+        """
+        self.workers = os.cpu_count() if workers is None else workers
+        self.min_chunk_size = min_chunk_size
+        self.dtype = dtype
+        self.executor = None
+        if self.workers > 1:
+            self._start()
+
+    def _start(self):
+        """ start the worker processes """
+        start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(start_method),
+                                            initializer=_init_worker)
+        self.executor.submit(int).result() # start the workers now
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def parse(self, payloads, start=None, end=None):
+        """ parse and clean a batch of payloads, spread over the workers
+        :param payloads: iterable of (symbol, content) with content the bytes of a Yahoo download
+        :param start: first date kept, None for no lower bound
+        :param end: last date kept, None for no upper bound
+        :return: ParsedPrices without missing prices, with the symbols in the order given (less the ones in errors)
+        """
+        payloads = list(payloads)
+        # A few chunks per worker, so that a slow chunk does not hold up the others
+        chunk_size = max(self.min_chunk_size, math.ceil(len(payloads) / (4 * max(self.workers, 1))))
+        if self.executor is None or len(payloads) <= chunk_size:
+            return _parse_chunk(payloads, self.dtype, start, end)
+
+        chunks = [payloads[i:i + chunk_size] for i in range(0, len(payloads), chunk_size)]
+        try:
+            return self._map(chunks, start, end)
+        except BrokenProcessPool as e:
+            # A worker died (killed by the OOM killer, say): the executor takes no more work, start a new one
+            logging.warning(f"Parse worker lost ({e}), restarting the {self.workers} parse workers")
+            self._abandon()
+            try:
+                self._start()
+                return self._map(chunks, start, end)
+            except BrokenProcessPool as e:
+                logging.warning(f"Parse workers lost again ({e}), parsing the batch in this process")
+                self._abandon()
+                return _parse_chunk(payloads, self.dtype, start, end)
+
+    def _map(self, chunks, start, end):
+        """ parse the chunks on the workers """
+        return concat_parsed(list(self.executor.map(_parse_chunk, chunks, repeat(self.dtype), repeat(start), repeat(end))))
+
+    def _abandon(self):
+        """ drop a broken executor, killing the workers it has left: they ignore the SIGTERM it would stop them with """
+        if self.executor is None:
+            return
+        for process in list((self.executor._processes or {}).values()):
+            process.kill()
+        self.executor.shutdown(wait=False)
+        self.executor = None
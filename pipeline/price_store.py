@@ -0,0 +1,203 @@
+""" price_store.py - Long-format (symbol, date, adj_close) storage of historical prices
+
+SQLite's 2,000 column limit is what pushed the prices out of the database and
+into the one-column-per-symbol output/historical_ticker_data.csv, which has to
+be rewritten in full on every update and parsed in full by every reader.
+Stored "long" instead, one row per symbol and trading day, there is no column
+limit at all:
+
+    prices (symbol_id, date, adj_close)   PRIMARY KEY (symbol_id, date), WITHOUT ROWID
+
+WITHOUT ROWID makes the table itself the primary key b-tree, so the rows of a
+symbol are stored together in date order: an update is an append of the new
+rows, and reading a slice of symbols and dates only touches that slice.
+
+    store = PriceStore("output/price_store.sqlite3")
+    store.append(df_wide)                                   # index = dates, columns = symbols
+    df = store.read_wide(["MSFT", "AAPL"], "2020-01-01", "2020-12-31")
+"""
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from pipeline.watermarks import Watermarks
+
+#=========================================================================================
+
+DEFAULT_PRICE_STORE_FILE = "output/price_store.sqlite3"
+
+# SQLite versions before 3.32 allow at most 999 host parameters in a statement
+MAX_SQL_PARAMETERS = 900
+
+#=========================================================================================
+
+class PriceStore:
+    """ Adjusted close prices stored one row per (symbol, date) in a SQLite database """
+
+    def __init__(self, db_file=DEFAULT_PRICE_STORE_FILE):
+        """
+        :param db_file: SQLite database file, created if it does not exist
+        """
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute("PRAGMA journal_mode=WAL") # readers are not blocked while an update is written
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS symbols (
+                  symbol_id INTEGER PRIMARY KEY
+                , symbol    TEXT NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS prices (
+                  symbol_id INTEGER NOT NULL REFERENCES symbols (symbol_id)
+                , date      TEXT    NOT NULL
+                , adj_close REAL
+                , PRIMARY KEY (symbol_id, date)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS ix_prices_date ON prices (date);
+        """)
+        self.conn.commit()
+        self.watermarks = Watermarks(self.conn)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    #=====================================================================================
+
+    def symbol_ids(self, symbols, create=False):
+        """ map symbols to their symbol_id
+        :param symbols: list of symbols
+        :param create: register the symbols that are not known yet
+        :return: dictionary of symbol -> symbol_id (unknown symbols are left out unless create=True)
+        """
+        symbols = list(symbols)
+        if create:
+            self.conn.executemany("INSERT OR IGNORE INTO symbols (symbol) VALUES (?)", [(s,) for s in symbols])
+        ids = {}
+        for start in range(0, len(symbols), MAX_SQL_PARAMETERS):
+            chunk = symbols[start:start + MAX_SQL_PARAMETERS]
+            cur = self.conn.execute(f"SELECT symbol, symbol_id FROM symbols WHERE symbol IN ({','.join('?' * len(chunk))})", chunk)
+            ids.update(cur.fetchall())
+        return ids
+
+    def symbols(self):
+        """ list every symbol held in the store
+        :return: list of symbols, alphabetically
+        """
+        return [s for s, in self.conn.execute("SELECT symbol FROM symbols ORDER BY symbol")]
+
+    def date_range(self):
+        """ get the first and last dates held in the store
+        :return: (first, last) ISO date strings, or (None, None) for an empty store
+        """
+        return self.conn.execute("SELECT MIN(date), MAX(date) FROM prices").fetchone()
+
+    #=====================================================================================
+
+    def append(self, df_wide):
+        """ add (or overwrite) the prices of a wide dataframe, in a single transaction
+
+        Missing values (NaN) are not stored: a symbol simply has no row for a day it did not trade.
+        The per-symbol watermarks are moved forward in the same transaction.
+
+        :param df_wide: dataframe indexed by date with one column of adjusted closes per symbol
+        :return: number of price rows written
+        """
+        if df_wide.shape[1] == 0 or df_wide.shape[0] == 0:
+            return 0
+        dates = np.asarray(pd.to_datetime(df_wide.index).strftime('%Y-%m-%d'), dtype=object)
+        values = df_wide.to_numpy(dtype=np.float64)
+
+        with self.conn:
+            ids = self.symbol_ids([str(c) for c in df_wide.columns], create=True)
+            current = self.watermarks.get_symbols([str(c) for c in df_wide.columns])
+            rows_written = 0
+            batches = []
+            for col, symbol in enumerate(df_wide.columns):
+                symbol_id = ids[str(symbol)]
+                column = values[:, col]
+                present = ~np.isnan(column)
+                if not present.any():
+                    continue
+                symbol_dates, symbol_values = dates[present].tolist(), column[present].tolist()
+                # New rows are inserted; only if some dates were already held are those overwritten as well
+                cur = self.conn.executemany("INSERT OR IGNORE INTO prices (symbol_id, date, adj_close) VALUES (?, ?, ?)",
+                                            zip([symbol_id] * len(symbol_dates), symbol_dates, symbol_values))
+                rows_inserted = cur.rowcount
+                if rows_inserted < len(symbol_dates):
+                    self.conn.executemany("UPDATE prices SET adj_close = ? WHERE symbol_id = ? AND date = ?",
+                                          zip(symbol_values, [symbol_id] * len(symbol_dates), symbol_dates))
+                rows_written += len(symbol_dates)
+
+                # The watermark moves by the rows just written, without counting the symbol's history again
+                watermark = current.get(str(symbol))
+                if watermark is None:
+                    # Only prices stored before the watermarks existed need counting, once
+                    row_count, last_date = self.conn.execute("SELECT COUNT(*), MAX(date) FROM prices WHERE symbol_id = ?", (symbol_id,)).fetchone()
+                else:
+                    row_count = watermark['row_count'] + rows_inserted
+                    last_date = max(d for d in [watermark['last_date'], max(symbol_dates)] if d is not None)
+                batches.append((str(symbol), symbol_dates, symbol_values, row_count, last_date))
+            self.watermarks.advance_symbols(batches)
+        return rows_written
+
+    def import_wide_csv(self, csv_file, chunksize=250):
+        """ load a one-column-per-symbol CSV (such as historical_ticker_data.csv) into the store
+
+        The file is read a few hundred rows at a time, so it never has to fit in memory at once.
+
+        :param csv_file: CSV file with dates in the first column and one column per symbol
+        :param chunksize: number of rows read at a time
+        :return: number of price rows written
+        """
+        rows_written = 0
+        for df_chunk in pd.read_csv(csv_file, index_col=0, chunksize=chunksize):
+            rows_written += self.append(df_chunk)
+        return rows_written
+
+    #=====================================================================================
+
+    def read_long(self, symbols=None, start=None, end=None):
+        """ read prices in long format
+        :param symbols: list of symbols to read, None for all of them
+        :param start: first date (inclusive) as an ISO string or date, None for no lower bound
+        :param end: last date (inclusive) as an ISO string or date, None for no upper bound
+        :return: dataframe with columns Date, Symbol, Adj Close
+        """
+        start = '0000-00-00' if start is None else pd.Timestamp(start).strftime('%Y-%m-%d')
+        end = '9999-99-99' if end is None else pd.Timestamp(end).strftime('%Y-%m-%d')
+
+        if symbols is None:
+            cur = self.conn.execute("""
+                SELECT s.symbol, p.date, p.adj_close FROM prices p JOIN symbols s USING (symbol_id)
+                WHERE p.date BETWEEN ? AND ?""", (start, end))
+            rows = cur.fetchall()
+        else:
+            # One primary key range scan per symbol, so the cost follows the size of the slice
+            rows = []
+            for symbol, symbol_id in self.symbol_ids(symbols).items():
+                cur = self.conn.execute("SELECT date, adj_close FROM prices WHERE symbol_id = ? AND date BETWEEN ? AND ?", (symbol_id, start, end))
+                rows.extend((symbol, d, v) for d, v in cur)
+
+        df_long = pd.DataFrame(rows, columns=['Symbol', 'Date', 'Adj Close'])
+        df_long['Date'] = pd.to_datetime(df_long['Date'], format='%Y-%m-%d')
+        return df_long[['Date', 'Symbol', 'Adj Close']]
+
+    def read_wide(self, symbols=None, start=None, end=None):
+        """ read prices as a wide dataframe, the same shape as historical_ticker_data.csv
+        :param symbols: list of symbols to read, None for all of them
+        :param start: first date (inclusive) as an ISO string or date, None for no lower bound
+        :param end: last date (inclusive) as an ISO string or date, None for no upper bound
+        :return: dataframe indexed by Date with one column per symbol, in the order requested
+        """
+        df_long = self.read_long(symbols, start, end)
+        df_wide = df_long.pivot(index='Date', columns='Symbol', values='Adj Close').sort_index()
+        df_wide.columns.name = None
+        columns = sorted(df_wide.columns) if symbols is None else [s for s in symbols if s in df_wide.columns]
+        return df_wide[columns]
@@ -0,0 +1,221 @@
+""" registry.py - Reads and writes of the yahoo_links symbol registry
+
+After every download batch the scripts used to write the whole yahoo_links
+dataframe back with to_sql(if_exists='replace'), which drops and recreates the
+table - losing the ix_yahoo_links_* indexes - just to touch a timestamp. Here
+only the rows that changed are updated, with one executemany UPDATE in a single
+transaction, and the database runs in WAL mode so that the scheduled jobs and
+the Flask app can keep reading the registry while an update is written.
+
+The symbols are also queried here, without reading the whole table into pandas
+first: query_registry turns filters on sector, exchange, market cap, IPO date
+and last_update into one parameterized SELECT that SQLite answers from the
+indexes, in Yahoo_Symbol order so that a limited query always returns the
+same rows, and RegistryQueries keeps the latest answers in an LRU cache that
+is dropped as soon as any connection writes to the database:
+
+    df_stale = read_registry(conn, updated_before=time_22hours_ago)
+    queries = RegistryQueries()                       # one read-only connection, shared by the threads behind a lock
+    columns, rows = queries.query(sectors=['Energy'], min_market_cap=1e9)"""
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import pandas as pd
+
+#=========================================================================================
+
+# Indexes of yahoo_links: the ones load_data_db.py has always created, plus the one
+# the targeted UPDATEs look rows up by
+REGISTRY_INDEXES = {
+      'ix_yahoo_links_IPO_Date'     : 'IPO_Date'
+    , 'ix_yahoo_links_Category3'    : 'Category3'
+    , 'ix_yahoo_links_GICS_Sector'  : 'GICS_Sector'
+    , 'ix_yahoo_links_Yahoo_Symbol' : 'Yahoo_Symbol'
+    , 'ix_yahoo_links_Exchange_ID'  : 'Exchange_ID'
+    , 'ix_yahoo_links_Market_Cap'   : 'Market_Cap'
+    , 'ix_yahoo_links_last_update'  : 'last_update'
+}
+
+REGISTRY_FILE = "output/team122project.sqlite3"
+
+REGISTRY_COLUMNS = [
+      'Country', 'Exchange_ID', 'Symbol', 'Description', 'Local_Symbol', 'IPO_Date', 'Category1', 'Category2'
+    , 'Category3', 'GICS_Sector', 'ISIN', 'SEDOL', 'Market_Cap', 'Currency', 'Actions', 'Yahoo_Symbol'
+    , 'Yahoo_Listings_Link', 'last_update'
+]
+
+#=========================================================================================
+
+def configure_connection(conn, busy_timeout_ms=30000):
+    """ switch a registry connection to WAL mode, so that readers and the writer do not block each other
+    :param conn: sqlite3 Connection to output/team122project.sqlite3
+    :param busy_timeout_ms: how long a statement waits for a lock held by another process
+    :return: the connection
+    """
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+    return conn
+
+
+def normalize_last_update(conn):
+    """ rewrite the last_update values stored as "YYYY-MM-DDTHH:MM:SS" (by the to_sql writes of the scripts) as
+        "YYYY-MM-DD HH:MM:SS", the format mark_updated writes: last_update is compared as text, and
+        "2023-10-13T08:00:00" sorts after "2023-10-13 22:00:00"
+    :param conn: sqlite3 Connection to the registry database
+    :return: number of rows rewritten
+    """
+    with conn:
+        cur = conn.execute("UPDATE yahoo_links SET last_update = REPLACE(last_update, 'T', ' ') WHERE INSTR(last_update, 'T') > 0")
+    return cur.rowcount
+
+
+def ensure_indexes(conn):
+    """ create the yahoo_links indexes that do not exist yet, and refresh the statistics the query planner picks them by
+        - after bringing last_update to a single format, so that the index orders the rows by time
+    :param conn: sqlite3 Connection to the registry database
+    """
+    normalize_last_update(conn)
+    with conn:
+        for index_name, column in REGISTRY_INDEXES.items():
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON yahoo_links ({column})")
+        conn.execute("ANALYZE yahoo_links")
+
+
+def mark_updated(conn, symbols, update_time=None):
+    """ set last_update on the given symbols only, in a single transaction
+    :param conn: sqlite3 Connection to the registry database
+    :param symbols: iterable of Yahoo symbols that were refreshed
+    :param update_time: timestamp to store, defaults to now (UTC) as "YYYY-MM-DD HH:MM:SS"
+    :return: number of rows updated
+    """
+    if update_time is None:
+        update_time = datetime.utcnow().isoformat(sep=" ", timespec="seconds")
+    with conn:
+        cur = conn.executemany("UPDATE yahoo_links SET last_update = ? WHERE Yahoo_Symbol = ?", [(update_time, symbol) for symbol in symbols])
+    return cur.rowcount
+
+#=========================================================================================
+
+def build_query(columns=None, sectors=None, exchanges=None, min_market_cap=None, max_market_cap=None,
+                ipo_after=None, ipo_before=None, updated_after=None, updated_before=None, limit=None):
+    """ turn filters into a parameterized SELECT on yahoo_links - every filter left as None is not applied
+    :param columns: columns to return (from REGISTRY_COLUMNS), None for all
+    :param sectors: GICS sectors to keep
+    :param exchanges: Exchange_IDs to keep
+    :param min_market_cap: smallest Market_Cap kept
+    :param max_market_cap: largest Market_Cap kept
+    :param ipo_after: keep the IPO dates on or after this date, YYYY-MM-DD
+    :param ipo_before: keep the IPO dates before this date, YYYY-MM-DD
+    :param updated_after: keep the symbols with a last_update on or after this time, "YYYY-MM-DD HH:MM:SS"
+    :param updated_before: keep the symbols with a last_update before this time - the stale ones
+    :param limit: most rows returned, the first ones in Yahoo_Symbol order
+    :return: (sql, parameters)
+    """
+    columns = REGISTRY_COLUMNS if columns is None else list(columns)
+    unknown = [column for column in columns if column not in REGISTRY_COLUMNS]
+    if len(unknown) > 0:
+        raise ValueError(f"unknown registry columns: {', '.join(map(str, unknown))}")
+
+    conditions, parameters = [], []
+    for column, values in [('GICS_Sector', sectors), ('Exchange_ID', exchanges)]:
+        if values is not None:
+            values = [values] if isinstance(values, str) else list(values)
+            conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+            parameters.extend(values)
+    for condition, value in [
+          ('Market_Cap >= ?', min_market_cap)
+        , ('Market_Cap <= ?', max_market_cap)
+        , ('IPO_Date >= ?', ipo_after)
+        , ('IPO_Date < ?', ipo_before)
+        , ('last_update >= ?', updated_after)
+        , ('last_update < ?', updated_before)
+    ]:
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value)
+
+    sql = f"SELECT {', '.join(columns)} FROM yahoo_links"
+    if len(conditions) > 0:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY Yahoo_Symbol"
+    if limit is not None:
+        sql += " LIMIT ?"
+        parameters.append(int(limit))
+    return sql, parameters
+
+
+def query_registry(conn, **filters):
+    """ get the rows of yahoo_links matching filters (see build_query)
+    :param conn: sqlite3 Connection to the registry database
+    :return: (column names, list of row tuples)
+    """
+    sql, parameters = build_query(**filters)
+    cur = conn.execute(sql, parameters)
+    return [description[0] for description in cur.description], cur.fetchall()
+
+
+def read_registry(conn, dtype=None, parse_dates=None, **filters):
+    """ read the rows of yahoo_links matching filters (see build_query) into a dataframe
+    :param conn: sqlite3 Connection to the registry database
+    :param dtype: dictionary of column -> dtype, as for pd.read_sql (the columns not returned are ignored)
+    :param parse_dates: list of date columns, as for pd.read_sql
+    :return: dataframe
+    """
+    sql, parameters = build_query(**filters)
+    columns = filters.get('columns') or REGISTRY_COLUMNS
+    return pd.read_sql(sql, con=conn, params=parameters,
+                       dtype={c: t for c, t in (dtype or {}).items() if c in columns},
+                       parse_dates=[c for c in (parse_dates or []) if c in columns])
+
+
+class RegistryQueries:
+    """ Registry queries answered from a least recently used cache, safe to share between threads
+
+    The cache is dropped whenever the database changed since the last query -
+    PRAGMA data_version tells when another connection committed a write - so a
+    screen never returns rows older than the last update. The queries share one
+    read-only connection: with the indexes, each one takes well under a millisecond.
+    """
+
+    def __init__(self, db_file=REGISTRY_FILE, maxsize=256):
+        """
+        :param db_file: registry database, opened read-only on the first query
+        :param maxsize: number of query results kept
+        """
+        self.db_file = db_file
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.conn = None
+        self.data_version = None
+        self.hits = 0
+        self.misses = 0
+
+    def query(self, **filters):
+        """ get the rows of yahoo_links matching filters (see build_query), from the cache if possible
+        :return: (column names, tuple of row tuples)
+        """
+        key = tuple(sorted((name, tuple(value) if isinstance(value, (list, tuple)) else value)
+                           for name, value in filters.items() if value is not None))
+        with self.lock:
+            if self.conn is None:
+                self.conn = sqlite3.connect(f"file:{self.db_file}?mode=ro", uri=True, check_same_thread=False)
+                self.conn.execute("PRAGMA busy_timeout=30000")
+            data_version, = self.conn.execute("PRAGMA data_version").fetchone()
+            if data_version != self.data_version:
+                self.entries.clear()
+                self.data_version = data_version
+            elif key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            columns, rows = query_registry(self.conn, **filters)
+            entry = (columns, tuple(rows))
+            self.entries[key] = entry
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            return entry
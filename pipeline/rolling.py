@@ -0,0 +1,279 @@
+""" rolling.py - Rolling-window statistics kept up to date one new row at a time
+
+Rolling means, volatilities and correlations recomputed over the whole history
+after every nightly update cost as much as the history is long, when only a
+row or two was added. RollingState keeps, for every symbol and every window
+length, the running sums those statistics are made of, plus ring buffers of the
+last prices, log returns and benchmark returns - the values that will leave the
+windows later. Folding in a new day adds the new values to the sums and
+subtracts the ones that drop out of each window: the cost of an update follows
+the number of new rows, not the length of the history.
+
+The state is saved next to the price store (output/rolling_state.npz) and
+advanced at the end of each run of update_data_db.py:
+
+    state = RollingState.load()                 # or a new one, the first time
+    state.update_from_store(price_store)        # only the rows the state has not seen
+    state.save()
+    df_20_days = state.statistics(20)           # moving average, volatility, correlation per symbol
+
+The running sums are recomputed exactly from the ring buffers before every
+save, so floating point drift never builds up across runs."""
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+#=========================================================================================
+
+DEFAULT_STATE_FILE = "output/rolling_state.npz"
+DEFAULT_WINDOWS = (20, 60, 252)
+PERIODS_PER_YEAR = 252
+
+# Running sums kept per window: of the prices, of the log returns and their squares,
+# and, over the days both have a return, of the symbol's and the benchmark's returns,
+# their squares and their products
+SUMS = ['price', 'price_n', 'ret', 'ret2', 'ret_n', 'pair_r', 'pair_r2', 'pair_b', 'pair_b2', 'pair_rb', 'pair_n']
+
+#=========================================================================================
+
+def _contributions(price, ret, bench):
+    """ the amount each value triple adds to each running sum (NaN contributes nothing)
+    :return: array of shape (len(SUMS),) + price.shape
+    """
+    has_price = ~np.isnan(price)
+    has_ret = ~np.isnan(ret)
+    pair = has_ret & ~np.isnan(bench)
+    r = np.where(has_ret, ret, 0.0)
+    rp = np.where(pair, ret, 0.0)
+    bp = np.where(pair, bench, 0.0)
+    return np.stack([
+          np.where(has_price, price, 0.0), has_price.astype(np.float64)
+        , r, r * r, has_ret.astype(np.float64)
+        , rp, rp * rp, bp, bp * bp, rp * bp, pair.astype(np.float64)
+    ])
+
+
+class RollingState:
+    """ Running sums and ring buffers of rolling windows, for every symbol """
+
+    def __init__(self, windows=DEFAULT_WINDOWS, benchmark=None):
+        """
+        :param windows: window lengths, in trading days (observations of each symbol)
+        :param benchmark: symbol the rolling correlations are computed against, None for no correlations
+        """
+        self.windows = np.array(sorted(set(windows)), dtype=np.int64)
+        self.benchmark = benchmark
+        self.capacity = int(self.windows.max())
+        self.symbols = []
+        self.columns = {}
+        self.count = np.zeros(0, dtype=np.int64)
+        self.last_date = np.zeros(0, dtype='datetime64[D]')
+        self.last_price = np.zeros(0)
+        self.ring = np.zeros((3, self.capacity, 0)) # price, return, benchmark return
+        self.sums = np.zeros((len(SUMS), len(self.windows), 0))
+
+    #=====================================================================================
+
+    def _add_symbols(self, symbols):
+        new = [s for s in dict.fromkeys(symbols) if s not in self.columns]
+        if len(new) == 0:
+            return
+        for symbol in new:
+            self.columns[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        n = len(new)
+        self.count = np.concatenate([self.count, np.zeros(n, dtype=np.int64)])
+        self.last_date = np.concatenate([self.last_date, np.full(n, np.datetime64('NaT'), dtype='datetime64[D]')])
+        self.last_price = np.concatenate([self.last_price, np.full(n, np.nan)])
+        self.ring = np.concatenate([self.ring, np.full((3, self.capacity, n), np.nan)], axis=2)
+        self.sums = np.concatenate([self.sums, np.zeros((len(SUMS), len(self.windows), n))], axis=2)
+
+    def advance(self, date, cols, prices, bench_return=np.nan):
+        """ fold one day's prices into the state
+        :param date: the day, as datetime64[D]
+        :param cols: array of column positions of the symbols priced that day (each at most once)
+        :param prices: their prices
+        :param bench_return: the benchmark's log return that day, NaN if unknown
+        """
+        previous = self.last_price[cols]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = np.log(prices / previous)
+        returns[~np.isfinite(returns)] = np.nan
+        bench = np.full(len(cols), bench_return, dtype=np.float64)
+
+        count = self.count[cols]
+        for k, window in enumerate(self.windows):
+            # The value that falls out of this window, if it is full
+            leaving = count >= window
+            if leaving.any():
+                slots = (count[leaving] - window) % self.capacity
+                leaving_cols = cols[leaving]
+                old = self.ring[:, slots, leaving_cols]
+                self.sums[:, k, leaving_cols] -= _contributions(old[0], old[1], old[2])
+        self.sums[:, :, cols] += _contributions(prices, returns, bench)[:, None, :]
+
+        slots = count % self.capacity
+        self.ring[0, slots, cols] = prices
+        self.ring[1, slots, cols] = returns
+        self.ring[2, slots, cols] = bench
+        self.count[cols] = count + 1
+        self.last_price[cols] = prices
+        self.last_date[cols] = date
+
+    def resync(self):
+        """ recompute every running sum exactly from the ring buffers """
+        n = len(self.symbols)
+        self.sums = np.zeros((len(SUMS), len(self.windows), n))
+        if n == 0:
+            return
+        # age[i, j]: how many observations ago ring slot i of symbol j was written (0 = latest)
+        age = (self.count[None, :] - 1 - np.arange(self.capacity)[:, None]) % self.capacity
+        filled = np.arange(self.capacity)[:, None] < np.minimum(self.count, self.capacity)[None, :]
+        contributions = _contributions(self.ring[0], self.ring[1], self.ring[2])
+        for k, window in enumerate(self.windows):
+            in_window = filled & (age < window)
+            self.sums[:, k, :] = np.where(in_window[None], contributions, 0.0).sum(axis=1)
+
+    #=====================================================================================
+
+    def update_from_store(self, price_store, symbol_chunk=500):
+        """ fold in every price of the store the state has not seen yet
+        :param price_store: PriceStore
+        :param symbol_chunk: symbols read at a time
+        :return: number of prices folded in
+        """
+        benchmark_returns = self._benchmark_returns(price_store)
+        store_symbols = price_store.symbols()
+        new_symbols = [s for s in store_symbols if s not in self.columns or self.count[self.columns[s]] == 0]
+        known_symbols = sorted(set(store_symbols).difference(new_symbols))
+        self._add_symbols(store_symbols)
+        folded = 0
+
+        # Symbols seen for the first time: their whole history, a group of symbols at a time
+        for start in range(0, len(new_symbols), symbol_chunk):
+            folded += self._fold(price_store.read_long(new_symbols[start:start + symbol_chunk]), benchmark_returns)
+
+        # The others: only the symbols the store holds later prices for, each from the day after its own last date -
+        # a symbol that stopped trading costs nothing, and holds nobody else back to its last date
+        watermarks = price_store.watermarks.get_symbols(known_symbols)
+        by_last_date = {}
+        for symbol in known_symbols:
+            last_date = str(self.last_date[self.columns[symbol]])
+            held_until = watermarks.get(symbol, {'last_date': None})['last_date']
+            if held_until is None or held_until > last_date:
+                by_last_date.setdefault(last_date, []).append(symbol)
+        for last_date, symbols in sorted(by_last_date.items()):
+            since = np.datetime64(last_date, 'D') + 1
+            for start in range(0, len(symbols), symbol_chunk):
+                folded += self._fold(price_store.read_long(symbols[start:start + symbol_chunk], since), benchmark_returns)
+        return folded
+
+    def _benchmark_returns(self, price_store):
+        """ log returns of the benchmark between its consecutive prices, indexed by date """
+        if self.benchmark is None:
+            return pd.Series(dtype=np.float64)
+        df_benchmark = price_store.read_long([self.benchmark]).sort_values('Date')
+        prices = df_benchmark['Adj Close'].to_numpy(dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = np.log(prices[1:] / prices[:-1])
+        return pd.Series(returns, index=df_benchmark['Date'].to_numpy()[1:].astype('datetime64[D]'))
+
+    def _fold(self, df_long, benchmark_returns):
+        """ advance the state with long-format prices, date by date, skipping what each symbol already holds """
+        if len(df_long) == 0:
+            return 0
+        df_wide = df_long.pivot(index='Date', columns='Symbol', values='Adj Close').sort_index()
+        cols = np.array([self.columns[s] for s in df_wide.columns], dtype=np.int64)
+        values = df_wide.to_numpy(dtype=np.float64)
+        dates = df_wide.index.to_numpy().astype('datetime64[D]')
+        bench = benchmark_returns.reindex(dates).to_numpy() if len(benchmark_returns) else np.full(len(dates), np.nan)
+
+        folded = 0
+        for i, date in enumerate(dates):
+            row = values[i]
+            last = self.last_date[cols]
+            take = ~np.isnan(row) & (np.isnat(last) | (last < date))
+            if take.any():
+                self.advance(date, cols[take], row[take], bench[i])
+                folded += int(take.sum())
+        return folded
+
+    #=====================================================================================
+
+    def statistics(self, window, periods_per_year=PERIODS_PER_YEAR):
+        """ the rolling statistics of every symbol over its last `window` observations
+        :param window: one of the window lengths of the state
+        :param periods_per_year: number of return periods in a year, to annualize the volatility
+        :return: dataframe indexed by symbol: last_date, moving_average, volatility (annualized, of the
+                 log returns) and correlation with the benchmark - NaN until a symbol has a full window
+        """
+        matches = np.flatnonzero(self.windows == window)
+        if len(matches) == 0:
+            raise ValueError(f"window must be one of {self.windows.tolist()}, not {window}")
+        sums = dict(zip(SUMS, self.sums[:, matches[0], :]))
+        full = self.count >= window
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            moving_average = sums['price'] / sums['price_n']
+            n = sums['ret_n']
+            variance = (sums['ret2'] - sums['ret'] ** 2 / n) / (n - 1)
+            volatility = np.sqrt(np.maximum(variance, 0.0) * periods_per_year)
+            m = sums['pair_n']
+            covariance = sums['pair_rb'] - sums['pair_r'] * sums['pair_b'] / m
+            variance_r = sums['pair_r2'] - sums['pair_r'] ** 2 / m
+            variance_b = sums['pair_b2'] - sums['pair_b'] ** 2 / m
+            correlation = covariance / np.sqrt(np.maximum(variance_r, 0.0) * np.maximum(variance_b, 0.0))
+
+        return pd.DataFrame({
+              'last_date'      : self.last_date
+            , 'moving_average' : np.where(full, moving_average, np.nan)
+            , 'volatility'     : np.where(full & (n >= 2), volatility, np.nan)
+            , 'correlation'    : np.where(full & (m >= 2), correlation, np.nan)
+        }, index=pd.Index(self.symbols, name='Symbol'))
+
+    #=====================================================================================
+
+    def save(self, state_file=DEFAULT_STATE_FILE):
+        """ write the state, atomically, after recomputing the sums from the ring buffers
+        :param state_file: .npz file
+        """
+        self.resync()
+        directory = os.path.dirname(os.path.abspath(state_file))
+        handle, temp_file = tempfile.mkstemp(prefix='.rolling_', suffix='.npz', dir=directory)
+        try:
+            with os.fdopen(handle, 'wb') as filehandle:
+                np.savez(filehandle, windows=self.windows, benchmark=np.array(self.benchmark or ''),
+                         symbols=np.array(self.symbols, dtype=str), count=self.count, last_date=self.last_date,
+                         last_price=self.last_price, ring=self.ring, sums=self.sums)
+                filehandle.flush()
+                os.fsync(filehandle.fileno())
+            os.chmod(temp_file, 0o644)
+            os.replace(temp_file, state_file)
+        except BaseException:
+            os.unlink(temp_file)
+            raise
+
+    @classmethod
+    def load(cls, state_file=DEFAULT_STATE_FILE, windows=DEFAULT_WINDOWS, benchmark=None):
+        """ read a saved state - or start a new one if there is none, or if it was kept for other windows or benchmark
+        :param state_file: .npz file
+        :param windows: window lengths wanted
+        :param benchmark: benchmark symbol wanted
+        :return: RollingState
+        """
+        state = cls(windows, benchmark)
+        if not os.path.exists(state_file):
+            return state
+        with np.load(state_file) as saved:
+            if saved['windows'].tolist() != state.windows.tolist() or (str(saved['benchmark']) or None) != benchmark:
+                return state # rebuilt from the whole history by the next update_from_store
+            state.symbols = saved['symbols'].tolist()
+            state.columns = {symbol: i for i, symbol in enumerate(state.symbols)}
+            state.count = saved['count']
+            state.last_date = saved['last_date']
+            state.last_price = saved['last_price']
+            state.ring = saved['ring']
+            state.sums = saved['sums']
+        return state
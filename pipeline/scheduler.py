@@ -0,0 +1,303 @@
+""" scheduler.py - Resident update daemon, woken on a cron schedule
+
+The Windows task of data_scraping/README.md relaunched update_data_db.py every
+hour: every launch paid the interpreter start, the imports, the connections
+and the parsing processes again, and wrote yet another CSV piece. The daemon
+below starts once (python -m pipeline daemon, e.g. as a systemd service) and
+keeps between its runs:
+
+  * the registry and price store connections and the rolling statistics, in
+    memory,
+  * the parsing processes, the download session and the throttle's rate.
+
+At every tick of its cron schedule it queues the symbols not updated in the
+last 22 hours, then drains the queue continuously - throttled symbols are
+retried as soon as their backoff ends, instead of an hour later. Only once no
+job is pending for the day are the day's pieces appended to the master data
+file, the snapshot published and the rolling statistics advanced; the day is
+then recorded as done in the price store, so a restart does not redo it. A
+run that fails (a locked database, a full disk, pieces the master data file
+cannot take) is logged, and the day is taken up again at the next tick.
+
+SIGTERM (or Ctrl+C) stops the daemon gracefully: the batch being downloaded
+is saved and committed, and the parsing processes and connections are closed -
+everything else (queue, prices, rolling statistics, days done) was persisted
+as it went. A day stopped half-way is resumed from its queue at the next start.
+
+    daemon = UpdateDaemon(CronSchedule("30 22 * * 1-5"))
+    daemon.run()"""
+import logging
+import signal
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+from pipeline.compaction import CompactionError
+from pipeline.fetch import FetchEngine
+from pipeline.metrics import NULL_METRICS, RunMetrics
+from pipeline.parse import ParsePool
+from pipeline.price_store import DEFAULT_PRICE_STORE_FILE, PriceStore
+from pipeline.registry import REGISTRY_FILE, configure_connection, ensure_indexes
+from pipeline.rolling import DEFAULT_STATE_FILE, DEFAULT_WINDOWS, RollingState
+from pipeline.snapshot import DEFAULT_SNAPSHOT_DIR
+from pipeline.update import (HISTORICAL_TICKER_DATA_FILE, OUTPUT_DIR, compact_day, master_watermark, publish_day,
+                             queue_downloads, save_downloaded_batch, update_window)
+from pipeline.work_queue import AdaptiveThrottle, WorkQueue, drain_queue
+
+#=========================================================================================
+
+# After the close of the US markets, on weekdays
+DEFAULT_SCHEDULE = "30 22 * * 1-5"
+
+# Name of the global watermark of the price store holding the last run date completed by the daemon
+COMPLETED_WATERMARK = "scheduler"
+
+# Fields of a cron expression: name, lowest and highest value
+CRON_FIELDS = [('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 7)]
+
+#=========================================================================================
+
+class CronSchedule:
+    """ A five-field cron expression (minute hour day-of-month month day-of-week), in local time
+
+    Each field is *, a value, a range a-b, a step */n or a-b/n, or a comma-separated
+    list of those; Sunday is 0 or 7. As in cron, when both the day of the month and
+    the day of the week are restricted, a day matching either of them matches.
+    """
+
+    def __init__(self, expression):
+        """
+        :param expression: cron expression, e.g. "30 22 * * 1-5"
+        """
+        fields = expression.split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError(f"cron expression needs {len(CRON_FIELDS)} fields (minute hour day month weekday), not {expression!r}")
+        self.expression = expression
+        values = {name: _parse_field(field, name, low, high) for field, (name, low, high) in zip(fields, CRON_FIELDS)}
+        self.minutes = values['minute']
+        self.hours = values['hour']
+        self.days = values['day']
+        self.months = values['month']
+        self.weekdays = {weekday % 7 for weekday in values['weekday']}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def _day_matches(self, day):
+        # isoweekday is 1 (Monday) to 7 (Sunday); cron counts Sunday as 0
+        day_match = day.day in self.days
+        weekday_match = day.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_match and weekday_match
+        return day_match or weekday_match
+
+    def next_after(self, moment):
+        """ get the first time of the schedule strictly after a moment
+        :param moment: naive local datetime
+        :return: naive local datetime, to the minute
+        """
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Day by day over at most a few years (e.g. "0 0 29 2 *" waits for a leap year), then within the day
+        day = moment.date()
+        for _ in range(366 * 8):
+            if day.month in self.months and self._day_matches(day):
+                for hour in sorted(self.hours):
+                    for minute in sorted(self.minutes):
+                        candidate = datetime(day.year, day.month, day.day, hour, minute)
+                        if candidate >= moment:
+                            return candidate
+            day += timedelta(days=1)
+        raise ValueError(f"cron expression {self.expression!r} never matches")
+
+    def __repr__(self):
+        return f"CronSchedule({self.expression!r})"
+
+
+def _parse_field(field, name, low, high):
+    """ the set of values of a cron field """
+    values = set()
+    for part in field.split(','):
+        expression, _, step = part.partition('/')
+        if expression == '*':
+            first, last = low, high
+        elif '-' in expression:
+            first, last = (int(value) for value in expression.split('-', 1))
+        else:
+            first = last = int(expression)
+            if step:
+                last = high
+        step = int(step) if step else 1
+        if first < low or last > high or first > last or step < 1:
+            raise ValueError(f"invalid {name} field {field!r} in cron expression: values go from {low} to {high}")
+        values.update(range(first, last + 1, step))
+    return values
+
+#=========================================================================================
+
+class UpdateDaemon:
+    """ Runs the nightly update on a schedule, in one resident process """
+
+    def __init__(self, schedule, db_file=REGISTRY_FILE, price_store_file=DEFAULT_PRICE_STORE_FILE,
+                 master_file=HISTORICAL_TICKER_DATA_FILE, output_dir=OUTPUT_DIR, snapshot_dir=DEFAULT_SNAPSHOT_DIR,
+                 rolling_state_file=DEFAULT_STATE_FILE, fetch_max_workers=8, fetch_requests_per_second=4,
+                 parse_workers=None, rolling_windows=DEFAULT_WINDOWS, rolling_benchmark='SPY', metrics_dir=None, cache=None):
+        """
+        :param schedule: CronSchedule of the runs
+        :param db_file: registry database holding yahoo_links and the download queue
+        :param price_store_file: database of the price store
+        :param master_file: master data file the day's pieces are appended to
+        :param output_dir: directory the CSV pieces are written to
+        :param snapshot_dir: directory the snapshots are published in
+        :param rolling_state_file: file of the rolling statistics
+        :param fetch_max_workers: number of downloads in flight at once
+        :param fetch_requests_per_second: most requests per second sent to Yahoo
+        :param parse_workers: number of processes parsing the downloads (None = one per CPU, 1 = parse in this process)
+        :param rolling_windows: window lengths of the rolling statistics, in trading days
+        :param rolling_benchmark: benchmark symbol of the rolling correlations
+        :param metrics_dir: directory the metrics of every run are written to, None for no metrics
+        :param cache: ResponseCache of the downloads, None for no cache
+        """
+        self.schedule = schedule
+        self.db_file = db_file
+        self.price_store_file = price_store_file
+        self.master_file = master_file
+        self.output_dir = output_dir
+        self.snapshot_dir = snapshot_dir
+        self.rolling_state_file = rolling_state_file
+        self.fetch_max_workers = fetch_max_workers
+        self.fetch_requests_per_second = fetch_requests_per_second
+        self.parse_workers = parse_workers
+        self.rolling_windows = rolling_windows
+        self.rolling_benchmark = rolling_benchmark
+        self.metrics_dir = metrics_dir
+        self.cache = cache
+        self.stopping = threading.Event()
+        self.parse_pool = self.engine = self.conn = self.price_store = None
+
+    def stop(self, signum=None, frame=None):
+        """ ask the daemon to stop once the current batch is saved - usable as a signal handler """
+        if signum is not None:
+            logging.info(f"Received signal {signum}, stopping after the current batch")
+        self.stopping.set()
+
+    #=====================================================================================
+
+    def run(self, run_now=False):
+        """ run until stopped: wait for the next time of the schedule, update, and so on
+        :param run_now: True to start with a run instead of waiting for the schedule
+        """
+        previous_handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                previous_handlers[signum] = signal.signal(signum, self.stop)
+
+        try:
+            # The parsing processes are started first, before any thread (the download session's)
+            self.parse_pool = ParsePool(self.parse_workers)
+            self.engine = FetchEngine(max_workers=self.fetch_max_workers, rate=self.fetch_requests_per_second, cache=self.cache)
+            self.throttle = AdaptiveThrottle(self.engine)
+            self.conn = configure_connection(sqlite3.connect(self.db_file))
+            self.price_store = PriceStore(self.price_store_file)
+            ensure_indexes(self.conn)
+            self.fetch_queue = WorkQueue(self.conn)
+            self.watermark = master_watermark(self.price_store, self.master_file)
+            self.rolling_state = RollingState.load(self.rolling_state_file, windows=self.rolling_windows, benchmark=self.rolling_benchmark)
+            logging.info(f"Update daemon started on schedule {self.schedule.expression!r}")
+
+            # A day stopped half-way (or crashed) is resumed right away
+            if run_now or self.unfinished_day() is not None:
+                self.run_safely()
+            while not self.stopping.is_set():
+                wake = self.schedule.next_after(datetime.now())
+                logging.info(f"Next update at {wake.isoformat(sep=' ')}")
+                # Waiting in short steps follows changes of the clock (e.g. after a suspend)
+                while not self.stopping.is_set() and datetime.now() < wake:
+                    self.stopping.wait(min(60.0, max(0.0, (wake - datetime.now()).total_seconds())))
+                if not self.stopping.is_set():
+                    self.run_safely()
+        finally:
+            # Every batch and every completed day is already committed: only the resources are left to release
+            for resource in (self.engine, self.parse_pool, self.price_store, self.conn):
+                if resource is not None:
+                    resource.close()
+            self.parse_pool = self.engine = self.conn = self.price_store = None
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+            logging.info("Update daemon stopped")
+
+    def completed_date(self):
+        """ last run date the daemon completed (downloaded, compacted and published), None if none """
+        watermark = self.price_store.watermarks.get_global(COMPLETED_WATERMARK)
+        return None if watermark is None else watermark['last_date']
+
+    def unfinished_day(self):
+        """ run date of today's download queue if it exists and the day was not completed yet, else None """
+        run_date = date.today().isoformat()
+        if self.fetch_queue.has_run(run_date) and self.completed_date() != run_date:
+            return run_date
+        return None
+
+    def run_safely(self):
+        """ run_once, logging its errors instead of raising them, so that the daemon carries on to its next run """
+        try:
+            return self.run_once()
+        except Exception:
+            logging.exception("Update failed - retried at the next scheduled run")
+            return None
+
+    def run_once(self):
+        """ update the prices of the day: queue, drain, and once the day's set is complete, compact and publish
+        :return: dictionary of status -> count of the day's queue, None if there was nothing to do
+        """
+        # Read again on every run: a failed run may have left it behind the store
+        self.watermark = master_watermark(self.price_store, self.master_file)
+        window = update_window(self.watermark)
+        if window is None:
+            logging.info(f"Master data file {self.master_file} already holds the latest data")
+            return None
+        dt_last_update, dt_now = window
+        run_date = dt_now.date().isoformat()
+        if self.completed_date() == run_date:
+            logging.info(f"Update of {run_date} already completed")
+            return None
+
+        metrics = RunMetrics('scheduler') if self.metrics_dir is not None else NULL_METRICS
+        self.engine.metrics = metrics
+        try:
+            queue_downloads(self.conn, self.fetch_queue, run_date, int(dt_last_update.timestamp()), int(dt_now.timestamp()), metrics)
+            idx_dates = pd.Series(pd.date_range(start=dt_last_update.date(), end=dt_now.date()))
+            save_batch = lambda results: save_downloaded_batch(results, self.conn, self.price_store, self.parse_pool, idx_dates,
+                                                               f"database_{run_date.replace('-', '')}", self.output_dir, metrics)
+
+            # Throttled symbols are retried as soon as their backoff ends; a stop request ends the wait at once
+            with metrics.span('drain_queue'):
+                queue_counts = drain_queue(self.fetch_queue, self.engine, save_batch, run_date, throttle=self.throttle,
+                                           sleep=self.stopping.wait, should_stop=self.stopping.is_set)
+            for status, status_count in queue_counts.items():
+                metrics.set(f"queue_{status}", status_count)
+            if queue_counts.get('pending', 0) > 0:
+                logging.info(f"Stopped with {queue_counts['pending']} downloads pending for {run_date} - resumed at the next start")
+                return queue_counts
+            logging.info(f"\nDownload queue for {run_date} drained: {queue_counts}")
+
+            # The day's set is complete: append it to the master data file, publish, and record the day as done -
+            # unless the master data file could not take it, in which case the day is left to the next run
+            try:
+                compact_day(self.price_store, run_date, self.master_file, self.output_dir, metrics, raise_errors=True)
+            except CompactionError:
+                metrics.count('compaction_failed')
+                logging.error(f"Update of {run_date} not completed - compaction is retried at the next run")
+                return queue_counts
+            publish_day(self.price_store, self.rolling_state, self.snapshot_dir, self.rolling_state_file, metrics)
+            with self.price_store.conn:
+                self.price_store.watermarks.set_global(run_date, queue_counts.get('done', 0), None, None, name=COMPLETED_WATERMARK)
+            logging.info(f"\nUpdate of {run_date} completed")
+            return queue_counts
+        except Exception:
+            metrics.count('run_failed')
+            raise
+        finally:
+            self.engine.metrics = NULL_METRICS
+            if self.metrics_dir is not None:
+                metrics.write(self.metrics_dir)
@@ -0,0 +1,223 @@
+""" snapshot.py - Binary, memory-mapped snapshot of the whole price history
+
+Every reader of the prices starts by parsing a text CSV into a float64
+dataframe: seconds of CPU and a private copy of the data per process. The
+update scripts now also publish a snapshot of the price store that can be
+opened with no parsing at all:
+
+    output/snapshot/CURRENT                 name of the current version
+    output/snapshot/<version>/prices.npy    dates x symbols float32 matrix, NaN for no price
+    output/snapshot/<version>/dates.npy     datetime64[D] date of each row
+    output/snapshot/<version>/symbols.npy   symbol of each column
+    output/snapshot/<version>/manifest.json version, shape, last date, creation time
+    output/snapshot/<version>/weekly*.npy   weekly and monthly open/high/low/close (pipeline/aggregates.py)
+    output/snapshot/<version>/monthly*.npy
+
+The matrix is stored column by column (Fortran order), so the prices of one
+symbol are contiguous on disk, and is opened with numpy.load(mmap_mode='r'):
+the data is read from the page cache on demand, and every process that opens
+the same version shares the same pages (the date and symbol arrays are mapped
+the same way). A new version is written to its own directory and published by
+replacing CURRENT, so readers never see a partial snapshot and keep using the
+version they opened until they reopen.
+
+    df_prices = load_snapshot()           # DataFrame over the mapped matrix, no copy
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from pipeline.aggregates import FREQUENCIES, write_aggregates
+
+#=========================================================================================
+
+DEFAULT_SNAPSHOT_DIR = "output/snapshot"
+
+CURRENT_FILE = "CURRENT"
+PRICES_FILE = "prices.npy"
+DATES_FILE = "dates.npy"
+SYMBOLS_FILE = "symbols.npy"
+MANIFEST_FILE = "manifest.json"
+
+#=========================================================================================
+
+class Snapshot(namedtuple('Snapshot', ['version', 'dates', 'symbols', 'prices', 'manifest'])):
+    """ An opened snapshot: prices[i, j] is the price of symbols[j] on dates[i] (a read-only memory map) """
+    __slots__ = ()
+
+    def column(self, symbol):
+        """ get the position of a symbol's column
+        :param symbol: symbol
+        :return: column index, or None if the symbol is not in the snapshot
+        """
+        position = np.searchsorted(self.symbols, symbol)
+        if position < len(self.symbols) and self.symbols[position] == symbol:
+            return int(position)
+        return None
+
+    def frame(self):
+        """ wrap the matrix in a dataframe indexed by Date with one column per symbol, without copying it
+        :return: dataframe (read-only float32 values)
+        """
+        return pd.DataFrame(self.prices, index=pd.DatetimeIndex(self.dates, name="Date"), columns=self.symbols, copy=False)
+
+
+class Aggregate(namedtuple('Aggregate', ['frequency', 'dates', 'ohlc'])):
+    """ Opened aggregates of a snapshot: ohlc[f, i, j] is the open, high, low or close (f = 0 to 3) of the
+        symbol of snapshot column j in the period ending on dates[i] (a read-only memory map) """
+    __slots__ = ()
+
+#=========================================================================================
+
+def current_version(snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+    """ read the name of the current snapshot version
+    :param snapshot_dir: directory the snapshots are published in
+    :return: version, or None if no snapshot was published yet
+    """
+    try:
+        with open(os.path.join(snapshot_dir, CURRENT_FILE), encoding='utf-8') as filehandle:
+            return filehandle.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def open_snapshot(snapshot_dir=DEFAULT_SNAPSHOT_DIR, version=None):
+    """ map a snapshot into memory - nothing is read until it is used
+    :param snapshot_dir: directory the snapshots are published in
+    :param version: version to open, None for the current one
+    :return: Snapshot
+    """
+    version = current_version(snapshot_dir) if version is None else version
+    if version is None:
+        raise FileNotFoundError(f"No snapshot has been published in {snapshot_dir}")
+    directory = os.path.join(snapshot_dir, version)
+    with open(os.path.join(directory, MANIFEST_FILE), encoding='utf-8') as filehandle:
+        manifest = json.load(filehandle)
+    return Snapshot(
+          version
+        , np.load(os.path.join(directory, DATES_FILE), mmap_mode='r')
+        , np.load(os.path.join(directory, SYMBOLS_FILE), mmap_mode='r')
+        , np.load(os.path.join(directory, PRICES_FILE), mmap_mode='r')
+        , manifest
+    )
+
+
+def load_snapshot(snapshot_dir=DEFAULT_SNAPSHOT_DIR, version=None):
+    """ open a snapshot as a dataframe, without parsing or copying the prices
+    :param snapshot_dir: directory the snapshots are published in
+    :param version: version to open, None for the current one
+    :return: dataframe indexed by Date with one float32 column per symbol
+    """
+    return open_snapshot(snapshot_dir, version).frame()
+
+
+def open_aggregate(frequency, snapshot_dir=DEFAULT_SNAPSHOT_DIR, version=None):
+    """ map the weekly or monthly aggregates of a snapshot into memory
+    :param frequency: 'weekly' or 'monthly'
+    :param snapshot_dir: directory the snapshots are published in
+    :param version: version to open, None for the current one
+    :return: Aggregate - raises FileNotFoundError for versions published without aggregates
+    """
+    if frequency not in FREQUENCIES:
+        raise ValueError(f"frequency must be one of {FREQUENCIES}, not {frequency!r}")
+    version = current_version(snapshot_dir) if version is None else version
+    if version is None:
+        raise FileNotFoundError(f"No snapshot has been published in {snapshot_dir}")
+    directory = os.path.join(snapshot_dir, version)
+    return Aggregate(
+          frequency
+        , np.load(os.path.join(directory, f"{frequency}_dates.npy"), mmap_mode='r')
+        , np.load(os.path.join(directory, f"{frequency}.npy"), mmap_mode='r')
+    )
+
+#=========================================================================================
+
+def publish_snapshot(price_store, snapshot_dir=DEFAULT_SNAPSHOT_DIR, keep_versions=2):
+    """ write the whole content of a price store as a new snapshot version and make it the current one
+
+    The matrix is written one symbol (one contiguous column) at a time, so the
+    prices never have to fit in memory as a dataframe.
+
+    :param price_store: PriceStore to take the prices from
+    :param snapshot_dir: directory the snapshots are published in
+    :param keep_versions: number of versions kept on disk, the current one included
+    :return: manifest of the new version
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    dates = np.array([d for d, in price_store.conn.execute("SELECT DISTINCT date FROM prices ORDER BY date")], dtype='datetime64[D]')
+    symbols = price_store.symbols()
+    ids = price_store.symbol_ids(symbols)
+
+    created = datetime.utcnow()
+    version = created.strftime('%Y%m%dT%H%M%S%f')
+    temp_directory = tempfile.mkdtemp(prefix=f".{version}_", dir=snapshot_dir)
+    try:
+        prices = np.lib.format.open_memmap(os.path.join(temp_directory, PRICES_FILE), mode='w+', dtype=np.float32,
+                                           shape=(len(dates), len(symbols)), fortran_order=True)
+        prices[:] = np.nan
+        for col, symbol in enumerate(symbols):
+            rows = price_store.conn.execute("SELECT date, adj_close FROM prices WHERE symbol_id = ?", (ids[symbol],)).fetchall()
+            if len(rows) == 0:
+                continue
+            symbol_dates, symbol_values = zip(*rows)
+            positions = np.searchsorted(dates, np.array(symbol_dates, dtype='datetime64[D]'))
+            prices[positions, col] = np.array(symbol_values, dtype=np.float64)
+        prices.flush()
+
+        # Weekly and monthly aggregates for the charts, computed from the matrix just written
+        periods = write_aggregates(temp_directory, dates, prices)
+        del prices
+
+        np.save(os.path.join(temp_directory, DATES_FILE), dates)
+        np.save(os.path.join(temp_directory, SYMBOLS_FILE), np.array(symbols, dtype=str))
+        manifest = {
+              'version'    : version
+            , 'created'    : created.isoformat(sep=" ", timespec="seconds")
+            , 'n_dates'    : len(dates)
+            , 'n_symbols'  : len(symbols)
+            , 'first_date' : str(dates[0]) if len(dates) else None
+            , 'last_date'  : str(dates[-1]) if len(dates) else None
+            , 'dtype'      : 'float32'
+            , 'aggregates' : periods
+        }
+        with open(os.path.join(temp_directory, MANIFEST_FILE), 'w', encoding='utf-8') as filehandle:
+            json.dump(manifest, filehandle, indent=2)
+
+        for file_name in os.listdir(temp_directory):
+            with open(os.path.join(temp_directory, file_name), 'rb') as filehandle:
+                os.fsync(filehandle.fileno())
+        os.chmod(temp_directory, 0o755)
+        os.replace(temp_directory, os.path.join(snapshot_dir, version))
+    except BaseException:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        raise
+
+    # Publish: readers switch to the new version the next time they open the snapshot
+    handle, temp_current = tempfile.mkstemp(prefix=f".{CURRENT_FILE}_", dir=snapshot_dir)
+    with os.fdopen(handle, 'w', encoding='utf-8') as filehandle:
+        filehandle.write(version + '\n')
+        filehandle.flush()
+        os.fsync(filehandle.fileno())
+    os.chmod(temp_current, 0o644)
+    os.replace(temp_current, os.path.join(snapshot_dir, CURRENT_FILE))
+
+    _remove_old_versions(snapshot_dir, keep_versions)
+    return manifest
+
+
+def _remove_old_versions(snapshot_dir, keep_versions):
+    """ delete all but the newest keep_versions version directories (processes that still map them keep their data) """
+    versions = sorted(entry for entry in os.listdir(snapshot_dir)
+                      if not entry.startswith('.') and os.path.isdir(os.path.join(snapshot_dir, entry)))
+    for version in versions[:-keep_versions]:
+        try:
+            shutil.rmtree(os.path.join(snapshot_dir, version))
+        except OSError as e: # still mapped on Windows
+            logging.info(f"Old snapshot {version} not removed: {e}")
@@ -0,0 +1,110 @@
+""" stub_server.py - Local stand-in for the Yahoo! Finance download endpoint
+
+Serves canned CSV payloads on 127.0.0.1 so that the download code can be run
+and timed without touching the real Yahoo! Finance servers. Paths have the same
+shape as the real API (/v7/finance/download/<symbol>?period1=...), so the link
+templates stored in yahoo_links only need their host swapped out.
+
+    with StubYahooServer({'MSFT': b'Date,Open,...'}) as server:
+        link = server.link_template('MSFT')
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, unquote
+
+DOWNLOAD_PATH = '/v7/finance/download/'
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1' # keep-alive, so connection reuse can be observed
+
+    def do_GET(self):
+        server = self.server
+        path = urlsplit(self.path).path
+        server.record_request(path)
+
+        status = server.next_status()
+        symbol = unquote(path[len(DOWNLOAD_PATH):]) if path.startswith(DOWNLOAD_PATH) else None
+        if status == 200:
+            body = server.payloads.get(symbol)
+            if body is None:
+                status, body = 404, b'Not Found'
+        else:
+            body = b'Too Many Requests' if status == 429 else b'Error'
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/csv' if status == 200 else 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # keep the console quiet
+
+
+class StubYahooServer(ThreadingHTTPServer):
+    """ Threaded HTTP server that serves canned CSVs per symbol
+
+    Failures can be scripted by pushing status codes onto `statuses`: each
+    request pops the next one (e.g. 429 or 503) before falling back to 200.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, payloads, port=0):
+        """
+        :param payloads: dictionary of symbol -> CSV body (bytes)
+        :param port: port to listen on, 0 picks a free one
+        """
+        super().__init__(('127.0.0.1', port), _StubHandler)
+        self.payloads = payloads
+        self.statuses = []
+        self.request_paths = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def link_template(self, symbol):
+        """ build a yahoo_links style template link that points at this server
+        :param symbol: Yahoo symbol
+        :return: link with {timestmp1}/{timestmp2} placeholders
+        """
+        return f"{self.base_url}{DOWNLOAD_PATH}{symbol}?period1={{timestmp1}}&period2={{timestmp2}}&interval=1d&events=history&includeAdjustedClose=true"
+
+    def get_request(self):
+        with self._lock:
+            self.connections += 1
+        return super().get_request()
+
+    def record_request(self, path):
+        with self._lock:
+            self.request_paths.append(path)
+
+    def next_status(self):
+        with self._lock:
+            return self.statuses.pop(0) if self.statuses else 200
+
+    def start(self):
+        """ serve requests on a background thread """
+        self._thread = threading.Thread(target=self.serve_forever, name='stub-yahoo', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ stop serving and release the port """
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
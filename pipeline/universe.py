@@ -0,0 +1,261 @@
+""" universe.py - Build the yahoo_links symbol universe from the stockmarketmba listings
+
+Part 1 of load_data_db.py used to fetch the exchange pages one after the
+other, parse them with the pure-Python html.parser, and concatenate the rows
+read so far into the master dataframe again after every row - which is where
+its duplicate rows came from. Here the exchange pages are downloaded
+concurrently through a FetchEngine, parsed with lxml, and every row is built
+once, in a single pass over the table; the symbols are then deduplicated on
+ISIN and Yahoo symbol. A rebuild takes a few seconds, so it can run every
+week: save_universe replaces yahoo_links in one transaction and keeps the
+last_update of the symbols that were already there.
+
+    df_universe = build_universe(exchange_codes, countries=['USA'])
+    df_universe = clean_universe(df_universe)
+    save_universe(conn, df_universe)
+
+or all three at once, only when yahoo_links does not exist yet (or rebuild=True):
+
+    init_universe(conn, rebuild=True)"""
+import logging
+from urllib.parse import urljoin
+
+import lxml.html
+import pandas as pd
+
+from pipeline.fetch import FetchEngine
+from pipeline.metrics import NULL_METRICS
+from pipeline.registry import ensure_indexes
+
+#=========================================================================================
+
+START_URL = "https://stockmarketmba.com/globalstockexchanges.php"
+
+# stockmarketmba exchange code -> Yahoo suffix of its symbols, see https://stockmarketmba.com/globalstockexchanges.php
+# and https://help.yahoo.com/kb/exchanges-data-providers-yahoo-finance-sln2310.html
+# We are only interested in USA stock markets for this project
+USA_EXCHANGE_CODES = {
+      "UA" : ""
+    , "UN" : ""
+    , "UQ" : ""
+    , "UR" : ""
+    , "UW" : ""
+    , "UV" : ""
+}
+
+# Yahoo link of every symbol - the timestamps are left as placeholders, filled in by every daily update
+YAHOO_LINK_TEMPLATE = "https://query1.finance.yahoo.com/v7/finance/download/{ticker}?period1={{timestmp1}}&period2={{timestmp2}}&interval=1d&events=history&includeAdjustedClose=true"
+
+# We only track stocks in certain sectors
+GOOD_SECTORS = [
+      'Financials', 'Communication Services', 'Consumer Discretionary', 'Information Technology', 'Industrials'
+    , 'Consumer Staples', 'Energy', 'Materials', 'Health Care', 'Capital Goods', 'Real Estate', 'Utilities', 'Retailing'
+    , 'Real Estate Development & Operations', 'Commercial REITs', 'Technology Hardware & Equipment'
+    , 'Food Beverage & Tobacco', 'Automobiles & Components', 'Consumer Services', 'Health Care Equipment & Services'
+    , 'Consumer Durables & Apparel', 'Banks', 'Minerals', 'Information technology'
+]
+
+# Symbols listed after this date do not have the full history the project works on
+MAX_IPO_DATE = '2010-01-01'
+
+# Value of last_update of the symbols never downloaded
+NEVER_UPDATED = '1970-01-01 00:00:00'
+
+#=========================================================================================
+
+def _table(html):
+    """ the data table of a stockmarketmba page, and its header with spaces replaced by underscores """
+    tree = lxml.html.fromstring(html)
+    tables = tree.xpath('//table[@id="ETFs"]')
+    if len(tables) == 0:
+        raise ValueError("page has no table with id ETFs")
+    table = tables[0]
+    head = [th.text_content().replace(' ', '_') for th in table.xpath('./thead/tr[1]/th')]
+    return table, head
+
+
+def _rows(table):
+    """ the cells of every row of the table body, with their text - most cells have no markup, so their
+        text is read directly instead of through text_content() """
+    for tbody in table.iterchildren('tbody'):
+        for tr in tbody.iterchildren('tr'):
+            cells = list(tr.iterchildren('td'))
+            if len(cells) > 0:
+                yield cells, [(cell.text or '') if len(cell) == 0 else cell.text_content() for cell in cells]
+
+
+def parse_exchanges(html, exchange_codes, base_url=START_URL):
+    """ read the list of exchanges of the global stock exchanges page
+    :param html: content of the page
+    :param exchange_codes: dictionary of stockmarketmba exchange code -> Yahoo suffix, of the exchanges wanted
+    :param base_url: URL of the page, to resolve the links to the listings
+    :return: list of dictionaries, one per exchange wanted: the columns of the table, Yahoo_Code and Listings_Link
+    """
+    table, head = _table(html)
+    exchanges = []
+    for cells, texts in _rows(table):
+        if texts[0] not in exchange_codes:
+            continue
+        exchange = dict(zip(head, texts))
+        if '#_of_Stocks' in exchange:
+            exchange['#_of_Stocks'] = int(exchange['#_of_Stocks'].replace(',', '') or 0)
+        exchange['Yahoo_Code'] = exchange_codes[texts[0]]
+        exchange['Listings_Link'] = urljoin(base_url, cells[-1].xpath('.//a/@href')[0])
+        exchanges.append(exchange)
+    return exchanges
+
+
+def parse_listings(html, country, exchange_key, yahoo_code):
+    """ read the common stocks of an exchange's listings page, in a single pass over its rows
+    :param html: content of the page
+    :param country: country of the exchange
+    :param exchange_key: stockmarketmba code of the exchange
+    :param yahoo_code: suffix of the exchange's symbols on Yahoo
+    :return: list of dictionaries, one per common stock with an ISIN or SEDOL
+    """
+    table, head = _table(html)
+    rows = []
+    for cells, texts in _rows(table):
+        link = cells[0].find('.//a')
+        if link is None:
+            continue
+        row = {'Country': country, 'Exchange_ID': exchange_key}
+        row.update(zip(head, texts))
+        # We only track common stocks - all other forms of debt or equity are ignored for the purpose of this project
+        if row.get('Category2') != "Common stocks":
+            continue
+        # Needs either one of these columns populated to generate a valid Yahoo URL
+        if row.get('ISIN', '') == '' and row.get('SEDOL', '') == '':
+            continue
+        if row.get('Local_Symbol', '') == '':
+            row['Local_Symbol'] = link.text or ''
+        market_cap = row.get('Market_Cap', '').replace(',', '').strip()
+        row['Market_Cap'] = int(float(market_cap)) if market_cap else None
+        # Some local symbols are wrong for Yahoo - Thailand is an example (already contains a dotted suffix
+        # which must be removed and replaced with Yahoo suffix for Thailand)
+        ticker = row['Local_Symbol'] + yahoo_code
+        row['Yahoo_Symbol'] = ticker
+        row['Yahoo_Listings_Link'] = YAHOO_LINK_TEMPLATE.format(ticker=ticker)
+        rows.append(row)
+    return rows
+
+#=========================================================================================
+
+def build_universe(exchange_codes, countries=None, start_url=START_URL, max_workers=8, rate=2.0, engine=None, metrics=NULL_METRICS,
+                   cache=None):
+    """ download and parse the listings of every exchange wanted, the listing pages concurrently
+    :param exchange_codes: dictionary of stockmarketmba exchange code -> Yahoo suffix, of the exchanges wanted
+    :param countries: list of the countries wanted, None for all
+    :param start_url: page listing the exchanges
+    :param max_workers: number of pages downloaded at once
+    :param rate: most requests per second sent to stockmarketmba
+    :param engine: FetchEngine to download with, None for a new one
+    :param metrics: RunMetrics of the new engine's downloads
+    :param cache: ResponseCache of the new engine, None for no cache
+    :return: dataframe with one row per symbol, deduplicated on ISIN and on Yahoo symbol
+    """
+    own_engine = engine is None
+    engine = FetchEngine(max_workers=max_workers, rate=rate, metrics=metrics, cache=cache) if own_engine else engine
+    try:
+        result = engine.fetch(None, start_url)
+        if result.status_code != 200:
+            raise RuntimeError(f"Could not get the list of exchanges from {start_url}: {result.error or result.status_code}")
+        exchanges = parse_exchanges(result.content, exchange_codes, start_url)
+        if countries is not None:
+            exchanges = [exchange for exchange in exchanges if exchange.get('Country') in countries]
+        logging.info(f"Total number of stock symbols for the {len(exchanges)} exchanges: {sum(e.get('#_of_Stocks', 0) for e in exchanges)}")
+        logging.info("\n" + "\n".join([f"{e['Listings_Link']}\t{e['Yahoo_Code']}\t{e.get('Country')}" for e in exchanges]))
+
+        by_link = {exchange['Listings_Link']: exchange for exchange in exchanges}
+        rows = []
+        for result in engine.fetch_all([(link, link) for link in by_link]):
+            if result.status_code != 200:
+                raise RuntimeError(f"Could not get the listings at {result.url}: {result.error or result.status_code}")
+            exchange = by_link[result.key]
+            exchange_rows = parse_listings(result.content, exchange.get('Country'), result.key[-2:], exchange['Yahoo_Code'])
+            logging.info(f"Read {len(exchange_rows)} common stocks from {result.url} in {result.elapsed:.2f}s")
+            rows.extend(exchange_rows)
+    finally:
+        if own_engine:
+            engine.close()
+
+    df_universe = pd.DataFrame(rows)
+    if len(df_universe) == 0:
+        return df_universe
+    # The same security can be listed more than once: keep the first listing of every ISIN, then of every Yahoo symbol
+    has_isin = df_universe['ISIN'].fillna('') != ''
+    duplicated_isin = has_isin & df_universe['ISIN'].duplicated()
+    df_universe = df_universe[~duplicated_isin].drop_duplicates(subset='Yahoo_Symbol').reset_index(drop=True)
+    logging.info(f"{len(rows)} rows read, {len(df_universe)} after removing the duplicate ISINs and symbols")
+    return df_universe
+
+
+def clean_universe(df_universe, sectors=GOOD_SECTORS, max_ipo_date=MAX_IPO_DATE):
+    """ keep the symbols of the sectors tracked, with a real IPO date before max_ipo_date
+    :param df_universe: dataframe from build_universe
+    :param sectors: sectors kept
+    :param max_ipo_date: latest IPO date kept (excluded)
+    :return: filtered dataframe, with IPO_Date as datetimes
+    """
+    df_good_sectors = df_universe[df_universe['GICS_Sector'].isin(sectors)].copy()
+    logging.info(f"\nFrom the {df_universe.shape[0]} rows in the original list, removing 'bad industry sectors' reduced the number or rows to {df_good_sectors.shape[0]}")
+    df_good_sectors['IPO_Date'] = pd.to_datetime(df_good_sectors['IPO_Date'], errors='coerce')
+    # Many of the IPO dates are set to a fake date (Jan. 1, 1900) - we filter these out
+    df_good_dates = df_good_sectors[df_good_sectors['IPO_Date'].notna() & (df_good_sectors['IPO_Date'] != df_good_sectors['IPO_Date'].min())]
+    df_start = df_good_dates[df_good_dates['IPO_Date'] < max_ipo_date].reset_index(drop=True)
+    logging.info(f"\nAfter filtering data to use only good industry sectors and valid IPO dates, the number of securities available is: {df_start.shape[0]}")
+    return df_start
+
+
+def save_universe(conn, df_universe):
+    """ replace the yahoo_links table with a new universe, keeping the last_update of the symbols already there
+    :param conn: sqlite3 Connection to the registry database
+    :param df_universe: dataframe from clean_universe
+    :return: (number of symbols, number of them new)
+    """
+    table_exists, = conn.execute("SELECT EXISTS(SELECT 1 FROM sqlite_master WHERE type='table' AND name='yahoo_links')").fetchone()
+    last_updates = dict(conn.execute("SELECT Yahoo_Symbol, last_update FROM yahoo_links").fetchall()) if table_exists else {}
+    df_universe = df_universe.copy()
+    df_universe['last_update'] = df_universe['Yahoo_Symbol'].map(last_updates).fillna(NEVER_UPDATED)
+
+    # The new table is written next to the old one, and swapped in by a single transaction
+    df_universe.to_sql(name='yahoo_links_new', con=conn, if_exists='replace', index=False)
+    with conn:
+        conn.execute("BEGIN")
+        conn.execute("DROP TABLE IF EXISTS yahoo_links")
+        conn.execute("ALTER TABLE yahoo_links_new RENAME TO yahoo_links")
+    ensure_indexes(conn)
+    new_symbols = int((~df_universe['Yahoo_Symbol'].isin(last_updates.keys())).sum())
+    logging.info(f"Table 'yahoo_links' written with {len(df_universe)} symbols, {new_symbols} of them new")
+    return len(df_universe), new_symbols
+
+
+def init_universe(conn, exchange_codes=USA_EXCHANGE_CODES, countries=('USA',), rebuild=False, start_url=START_URL,
+                  max_workers=8, rate=2.0, metrics=NULL_METRICS, cache=None):
+    """ build, clean and save the universe, unless yahoo_links already exists
+    :param conn: sqlite3 Connection to the registry database
+    :param exchange_codes: dictionary of stockmarketmba exchange code -> Yahoo suffix, of the exchanges wanted
+    :param countries: list of the countries wanted, None for all
+    :param rebuild: True to rebuild yahoo_links even if it exists - the symbols already downloaded keep their last_update
+    :param start_url: page listing the exchanges
+    :param max_workers: number of pages downloaded at once
+    :param rate: most requests per second sent to stockmarketmba
+    :param metrics: RunMetrics of the run
+    :param cache: ResponseCache of the pages downloaded, None for no cache
+    :return: (number of symbols, number of them new), None if yahoo_links was left as it was
+    """
+    table_exists, = conn.execute("SELECT EXISTS(SELECT 1 FROM sqlite_master WHERE type='table' AND name='yahoo_links')").fetchone()
+    if table_exists and not rebuild:
+        logging.info("\nThe registry already has table yahoo_links - skipping the universe build")
+        return None
+
+    logging.info(f"\nGetting stock exchange information from {start_url}")
+    with metrics.span('universe_build'):
+        df_universe = build_universe(exchange_codes, countries=countries, start_url=start_url, max_workers=max_workers,
+                                     rate=rate, metrics=metrics, cache=cache)
+    df_universe = clean_universe(df_universe)
+    with metrics.span('universe_save'):
+        n_symbols, n_new = save_universe(conn, df_universe)
+    metrics.set('universe_symbols', n_symbols)
+    metrics.set('universe_new_symbols', n_new)
+    return n_symbols, n_new
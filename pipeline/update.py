@@ -0,0 +1,362 @@
+""" update.py - The nightly update of the prices, as functions
+
+What update_data_db.py used to run at import time: find where the master data
+file ends, queue the symbols not updated in the last 22 hours, drain the queue
+(download, parse, save each batch as a CSV piece and in the price store),
+append the day's pieces to the master data file, publish a snapshot and
+advance the rolling statistics. Nothing runs, connects or configures logging
+when the module is imported: the CLI (python -m pipeline update) and the
+script call update_prices, which returns a summary of the run.
+
+    summary = update_prices(metrics=RunMetrics('update_data_db'))"""
+import logging
+import os
+import re
+import sqlite3
+from datetime import date, datetime, timedelta, timezone
+
+import pandas as pd
+
+from pipeline.assemble import align_arrays
+from pipeline.compaction import CompactionError, compact_pieces
+from pipeline.fetch import FetchEngine
+from pipeline.fetch_windows import mark_piece_imported
+from pipeline.metrics import NULL_METRICS
+from pipeline.parse import ParsePool
+from pipeline.price_store import DEFAULT_PRICE_STORE_FILE, PriceStore
+from pipeline.registry import REGISTRY_FILE, configure_connection, ensure_indexes, mark_updated, read_registry
+from pipeline.rolling import DEFAULT_STATE_FILE, DEFAULT_WINDOWS, RollingState
+from pipeline.snapshot import DEFAULT_SNAPSHOT_DIR, publish_snapshot
+from pipeline.watermarks import file_checksum
+from pipeline.work_queue import WorkQueue, drain_queue
+
+#=========================================================================================
+
+OUTPUT_DIR = "output"
+HISTORICAL_TICKER_DATA_FILE = "output/historical_ticker_data.csv"
+
+# Hard code to the day before our earliest date to be considered for this project
+DEFAULT_START_DATE = '2009-12-31T00:00:00'
+
+# Symbols updated more recently than this are not downloaded again
+STALE_AFTER = timedelta(hours=22)
+
+REGISTRY_DTYPES = {
+      'Country'             : str
+    , 'Exchange_ID'         : str
+    , 'Symbol'              : str
+    , 'Description'         : str
+    , 'Local_Symbol'        : str
+    , 'IPO_Date'            : str
+    , 'Category1'           : str
+    , 'Category2'           : str
+    , 'Category3'           : str
+    , 'GICS_Sector'         : str
+    , 'ISIN'                : str
+    , 'SEDOL'               : str
+    , 'Market_Cap'          : str #np.int64
+    , 'Currency'            : str
+    , 'Actions'             : str
+    , 'Yahoo_Symbol'        : str
+    , 'Yahoo_Listings_Link' : str
+    , 'last_update'         : str
+}
+
+#=========================================================================================
+
+def master_watermark(price_store, master_file=HISTORICAL_TICKER_DATA_FILE):
+    """ get the watermark of the master data file, seeding the price store from the file on its first run
+    :param price_store: PriceStore keeping the watermark
+    :param master_file: master data file
+    :return: watermark dictionary, with last_date None if there is no master data yet
+    """
+    watermark = price_store.watermarks.get_global()
+    if watermark is not None:
+        return watermark
+
+    # First run with a price store: read the master file once to seed the store and its watermark
+    try:
+        df_combined_securities = pd.read_csv(master_file, index_col=0)
+    except FileNotFoundError as e:
+        logging.info(f"Error reading historical data: {str(type(e))} : {e}")
+        df_combined_securities = pd.DataFrame() # Create an empty dataframe because we could not find a CSV file on disk
+
+    if df_combined_securities.shape[0] > 0:
+        logging.info(f"Seeding the price store from {master_file}")
+        rows_written = price_store.append(df_combined_securities)
+        logging.info(f"Price store seeded with {rows_written} prices")
+
+    with price_store.conn:
+        price_store.watermarks.set_global(
+              date.fromisoformat(df_combined_securities.index[-1]).isoformat() if df_combined_securities.shape[0] > 0 else None
+            , df_combined_securities.shape[0]
+            , df_combined_securities.shape[1]
+            , file_checksum(master_file) if os.path.exists(master_file) else None
+        )
+    return price_store.watermarks.get_global()
+
+
+def queue_downloads(conn, fetch_queue, run_date, timestmp1, timestmp2, metrics=NULL_METRICS):
+    """ queue the download of every symbol not updated in the last 22 hours, once per run date
+    :param conn: sqlite3 Connection to the registry database
+    :param fetch_queue: WorkQueue of the downloads
+    :param run_date: ISO date of the daily refresh
+    :param timestmp1: Yahoo period1 (first date wanted) as a Unix timestamp
+    :param timestmp2: Yahoo period2 (last date wanted) as a Unix timestamp
+    :param metrics: RunMetrics of the run
+    :return: number of downloads queued, None if the queue of run_date already existed
+    """
+    # Any later run on the same day (e.g. after a crash) resumes that queue instead of re-reading yahoo_links
+    if fetch_queue.has_run(run_date):
+        logging.info(f"\nResuming download queue for {run_date}: {fetch_queue.counts(run_date)}")
+        return None
+
+    # Only the symbols not updated in the last 22 hours are read - the filter runs in SQLite, on the last_update index
+    time_22hours_ago = (datetime.utcnow() - STALE_AFTER).isoformat(sep=" ", timespec="seconds")
+    with metrics.span('registry_read'):
+        df_Yahoo_links_good_sectors_latestdates = read_registry(conn, dtype=REGISTRY_DTYPES, parse_dates=['IPO_Date', 'last_update'],
+                                                                columns=['Yahoo_Symbol', 'Yahoo_Listings_Link', 'last_update'],
+                                                                updated_before=time_22hours_ago)
+
+    # Build the list of (symbol, link) downloads to perform, with the placeholders in the links replaced by actual timestamps
+    list_downloads = [
+        (symbol, link.replace('{timestmp1}', str(timestmp1)).replace('{timestmp2}', str(timestmp2)))
+        for symbol, link in zip(df_Yahoo_links_good_sectors_latestdates['Yahoo_Symbol'], df_Yahoo_links_good_sectors_latestdates['Yahoo_Listings_Link'])
+    ]
+    fetch_queue.enqueue(list_downloads, run_date)
+    logging.info(f"\nQueued {len(list_downloads)} downloads for {run_date}")
+    return len(list_downloads)
+
+
+def compact_day(price_store, run_date, master_file=HISTORICAL_TICKER_DATA_FILE, output_dir=OUTPUT_DIR, metrics=NULL_METRICS,
+                raise_errors=False):
+    """ append the CSV pieces downloaded on run_date to the master data file and move its watermark forward
+    :param price_store: PriceStore keeping the master watermark
+    :param run_date: ISO date of the daily refresh
+    :param master_file: master data file
+    :param output_dir: directory of the pieces
+    :param metrics: RunMetrics of the run
+    :param raise_errors: raise the CompactionError when the pieces cannot be appended, instead of logging it and returning None
+    :return: result of compact_pieces, None if there was nothing to append or the master file was left unchanged
+    """
+    piece_prefix = f"database_{run_date.replace('-', '')}"
+    base_filename = f"^{piece_prefix}" + "_[0-9]+_[0-9]+.csv"
+    file_pieces = sorted([os.path.join(output_dir, f) for f in os.listdir(output_dir) if re.search(base_filename, f)])
+
+    if len(file_pieces) == 0:
+        logging.info(f"\nNo downloaded files to join for {run_date}")
+        return None
+
+    # The pieces are merged and appended to the master file as text, in bounded memory, through a temporary
+    # file that replaces the master only once it is complete - a crash can never leave a half-written master
+    logging.info(f"\nAppending {len(file_pieces)} downloaded files to {master_file}")
+    watermark = master_watermark(price_store, master_file)
+    try:
+        # Symbols given up on today are left empty for the new dates instead of holding back the whole update,
+        # and symbols new to the universe are added as columns, empty for the dates before today
+        with metrics.span('compaction'):
+            compaction = compact_pieces(master_file, file_pieces, allow_missing_columns=True, allow_new_columns=True)
+    except CompactionError as e:
+        logging.error(f"Master data file {master_file} left unchanged: {e}")
+        if raise_errors:
+            raise
+        return None
+
+    if len(compaction['missing_columns']) > 0:
+        logging.warning(f"{len(compaction['missing_columns'])} symbols of the master data file were not downloaded today: {', '.join(compaction['missing_columns'])}")
+    if len(compaction['new_columns']) > 0:
+        logging.warning(f"{len(compaction['new_columns'])} new symbols added to the master data file: {', '.join(compaction['new_columns'])}")
+    logging.info(f"Master data file updated: {compaction['rows_appended']} rows appended, {compaction['rows_skipped']} rows already present")
+    metrics.set('master_rows_appended', compaction['rows_appended'])
+    metrics.set('master_columns', compaction['col_count'])
+
+    # Move the master watermark forward so the next run starts from here without reading the file
+    with price_store.conn:
+        price_store.watermarks.set_global(
+              compaction['last_date']
+            , (watermark['row_count'] or 0) + compaction['rows_appended']
+            , compaction['col_count']
+            , compaction['checksum']
+        )
+    logging.info(f"Master watermark: {price_store.watermarks.get_global()}")
+    return compaction
+
+#=========================================================================================
+
+def update_window(watermark, today=None):
+    """ work out the dates to download: from the day after the last date of the master data file to today
+    :param watermark: watermark of the master data file, from master_watermark
+    :param today: date of the run, date.today() if None
+    :return: (first, last) UTC midnight datetimes, None when the master data file is up to date
+    """
+    last_update = watermark['last_date'] or DEFAULT_START_DATE
+    today = date.today() if today is None else today
+    dt_now = datetime(today.year, today.month, today.day, tzinfo=timezone.utc)
+    dt_last_update = datetime.fromisoformat(last_update) + timedelta(days=1)
+    dt_last_update = datetime(dt_last_update.year, dt_last_update.month, dt_last_update.day, tzinfo=timezone.utc)
+    logging.info(f'Time range: {dt_last_update.isoformat(sep=" ", timespec="seconds")} to {dt_now.isoformat(sep=" ", timespec="seconds")}')
+    if dt_last_update == dt_now:
+        return None
+    return dt_last_update, dt_now
+
+
+def save_downloaded_batch(results, conn, price_store, parse_pool, idx_dates, piece_prefix, output_dir=OUTPUT_DIR, metrics=NULL_METRICS):
+    """ parse a batch of downloaded price histories, save them as a CSV piece
+        and stamp the symbols as updated in yahoo_links
+    :param results: list of FetchResult with status 200
+    :param conn: sqlite3 Connection to the registry database
+    :param price_store: PriceStore the prices are appended to
+    :param parse_pool: ParsePool parsing the downloads
+    :param idx_dates: series of the dates downloaded
+    :param piece_prefix: start of the name of the CSV piece, database_<run date>
+    :param output_dir: directory the CSV piece is written to
+    :param metrics: RunMetrics of the run
+    :return: list of the symbols that were saved
+    """
+    # Parse the whole batch of downloads into date and price arrays, spread over the parsing processes
+    with metrics.span('parse'):
+        parsed_prices = parse_pool.parse([(result.key, result.content) for result in results], idx_dates.iloc[0], idx_dates.iloc[-1])
+    for symbol, error in parsed_prices.errors:
+        logging.error(f"{symbol}: {error}")
+    metrics.count('parse_errors', len(parsed_prices.errors))
+
+    if len(parsed_prices.symbols) == 0:
+        return []
+
+    # Merge all the data into a single dataframe, aligned on the series of dates in a single pass
+    with metrics.span('assemble'):
+        dfAllDates = align_arrays(idx_dates, parsed_prices.series())
+
+    # Drop weekends and holidays in case we have any such "empty" rows
+    logging.info(f"Before dropping empty rows, rowcount = {dfAllDates.shape[0]}")
+    with metrics.span('drop_empty_rows'):
+        df_trading_dates = dfAllDates.drop(dfAllDates[dfAllDates.any(axis=1) == False].index, axis=0)
+    logging.info(f"After dropping empty rows, rowcount = {df_trading_dates.shape[0]}")
+
+    outputfilename = os.path.join(output_dir, f"{piece_prefix}_{datetime.utcnow().strftime('%H%M%S%f')}_{len(df_trading_dates.columns)}.csv")
+    logging.info(f"\nSaving joined dataframe to file: {outputfilename}")
+    with metrics.span('csv_write'), open(outputfilename, "w") as filehandle:
+        df_trading_dates.to_csv(filehandle, index=True, lineterminator = '\n', encoding='utf-8')
+    metrics.count('piece_rows_written', df_trading_dates.shape[0])
+    metrics.count('piece_columns_written', df_trading_dates.shape[1])
+
+    # Append the new prices to the price store - only the new rows are written
+    with metrics.span('store_append'):
+        rows_written = price_store.append(df_trading_dates)
+    metrics.count('prices_written', rows_written)
+    mark_piece_imported(price_store, outputfilename, rows_written)
+    logging.info(f"Appended {rows_written} prices to the price store")
+
+    # Set the update timestamp on all those securities that we successfully retrieved latest (nightly) prices for
+    with metrics.span('mark_updated'):
+        mark_updated(conn, parsed_prices.symbols)
+
+    return list(parsed_prices.symbols)
+
+
+def publish_day(price_store, rolling_state, snapshot_dir=DEFAULT_SNAPSHOT_DIR, rolling_state_file=DEFAULT_STATE_FILE, metrics=NULL_METRICS):
+    """ publish a snapshot of the price store and advance the rolling statistics with the prices they have not seen yet
+    :param price_store: PriceStore to publish
+    :param rolling_state: RollingState to advance, saved to rolling_state_file
+    :param snapshot_dir: directory the snapshots are published in
+    :param rolling_state_file: file of the rolling statistics
+    :param metrics: RunMetrics of the run
+    :return: manifest of the snapshot
+    """
+    # A memory-mapped snapshot of all the prices, which readers open without parsing anything
+    with metrics.span('snapshot_publish'):
+        snapshot_manifest = publish_snapshot(price_store, snapshot_dir)
+    logging.info(f"\nPublished price snapshot {snapshot_manifest['version']}: {snapshot_manifest['n_dates']} dates x {snapshot_manifest['n_symbols']} symbols")
+
+    with metrics.span('rolling_update'):
+        rolling_folded = rolling_state.update_from_store(price_store)
+        rolling_state.save(rolling_state_file)
+    metrics.set('rolling_prices_folded', rolling_folded)
+    logging.info(f"\nRolling statistics advanced by {rolling_folded} prices for {len(rolling_state.symbols)} symbols")
+    return snapshot_manifest
+
+#=========================================================================================
+
+def update_prices(db_file=REGISTRY_FILE, price_store_file=DEFAULT_PRICE_STORE_FILE, master_file=HISTORICAL_TICKER_DATA_FILE,
+                  output_dir=OUTPUT_DIR, snapshot_dir=DEFAULT_SNAPSHOT_DIR, rolling_state_file=DEFAULT_STATE_FILE,
+                  fetch_max_workers=8, fetch_requests_per_second=4, parse_workers=None,
+                  rolling_windows=DEFAULT_WINDOWS, rolling_benchmark='SPY', metrics=NULL_METRICS, cache=None):
+    """ download the prices since the last update of every stale symbol and publish them
+    :param db_file: registry database holding yahoo_links and the download queue
+    :param price_store_file: database of the price store
+    :param master_file: master data file the day's pieces are appended to
+    :param output_dir: directory the CSV pieces are written to
+    :param snapshot_dir: directory the snapshots are published in
+    :param rolling_state_file: file of the rolling statistics
+    :param fetch_max_workers: number of downloads in flight at once
+    :param fetch_requests_per_second: most requests per second sent to Yahoo
+    :param parse_workers: number of processes parsing the downloads (None = one per CPU, 1 = parse in this process)
+    :param rolling_windows: window lengths of the rolling statistics, in trading days
+    :param rolling_benchmark: benchmark symbol of the rolling correlations
+    :param metrics: RunMetrics of the run
+    :param cache: ResponseCache of the downloads, None for no cache
+    :return: dictionary summarizing the run - up_to_date is True when there was nothing to download
+    """
+    price_store = PriceStore(price_store_file)
+    conn = None
+    try:
+        # The price store keeps a watermark of the master data file (last date, size, checksum) so we do not
+        # parse the whole file just to find its last date - the file is only read by the compaction step
+        watermark = master_watermark(price_store, master_file)
+        logging.info(f"Last successful update saved: {watermark['last_date'] or DEFAULT_START_DATE}")
+
+        # Create the start and end datetimes for queying Yahoo! Finance
+        window = update_window(watermark)
+        if window is None:
+            logging.info(f'CSV file {master_file} contains the latest data - stopping the process')
+            return {'up_to_date': True, 'last_update': watermark['last_date']}
+        dt_last_update, dt_now = window
+
+        timestmp1 = int(dt_last_update.timestamp())
+        timestmp2 = int(dt_now.timestamp())
+        logging.info(f"\nYahoo period1 = {timestmp1} corresponds to date {dt_last_update}")
+        logging.info(f"\nYahoo period2 = {timestmp2} corresponds to date {dt_now}")
+
+        conn = configure_connection(sqlite3.connect(db_file))
+        ensure_indexes(conn)
+
+        # The symbols to refresh are queued once per day in table fetch_queue
+        run_date = dt_now.date().isoformat()
+        fetch_queue = WorkQueue(conn)
+        queue_downloads(conn, fetch_queue, run_date, timestmp1, timestmp2, metrics)
+
+        # Create a series of dates from the latest date to be updated to yesterday
+        idxDates = pd.Series(pd.date_range(start=dt_last_update.date(), end=dt_now.date()))
+
+        # This is where the Yahoo downloads actually occur - the queue is drained in this single run, backing off
+        # whenever Yahoo throttles us and speeding up again once it recovers. The parsing processes are started
+        # first, before the download threads; the drain_queue phase includes the saving of every batch, each to
+        # its own <output_dir>/database_<run date>_<time>_<count>.csv piece
+        with ParsePool(parse_workers) as parse_pool, FetchEngine(max_workers=fetch_max_workers, rate=fetch_requests_per_second,
+                                                                metrics=metrics, cache=cache) as engine:
+            save_batch = lambda results: save_downloaded_batch(results, conn, price_store, parse_pool, idxDates,
+                                                               f"database_{run_date.replace('-', '')}", output_dir, metrics)
+            with metrics.span('drain_queue'):
+                queue_counts = drain_queue(fetch_queue, engine, save_batch, run_date)
+        logging.info(f"\nDownload queue for {run_date} drained: {queue_counts}")
+        for status, status_count in queue_counts.items():
+            metrics.set(f"queue_{status}", status_count)
+
+        # All symbols were downloaded (or given up on) - join all of today's downloaded CSV files into the master data file
+        compaction = compact_day(price_store, run_date, master_file, output_dir, metrics)
+
+        rolling_state = RollingState.load(rolling_state_file, windows=rolling_windows, benchmark=rolling_benchmark)
+        snapshot_manifest = publish_day(price_store, rolling_state, snapshot_dir, rolling_state_file, metrics)
+    finally:
+        if conn is not None:
+            conn.close()
+        price_store.close()
+
+    logging.info(f"\nProcess ended for this run")
+    return {
+          'up_to_date'       : False
+        , 'run_date'         : run_date
+        , 'queue'            : queue_counts
+        , 'rows_appended'    : compaction['rows_appended'] if compaction is not None else 0
+        , 'snapshot_version' : snapshot_manifest['version']
+    }
@@ -0,0 +1,123 @@
+""" watermarks.py - How far the stored price history goes, without reading it
+
+update_data_db.py used to parse the whole multi-year historical_ticker_data.csv
+at startup just to find its last date. The watermarks below live in the price
+store database and are written in the same transaction as the prices they
+describe, so they can always be trusted and cost a single row lookup:
+
+  * one global watermark: the last date of the master data file, with its
+    row and column counts and the SHA-256 of the file,
+  * one watermark per symbol: the last date stored, the number of rows held
+    and a checksum chained over every batch of prices written for it."""
+import hashlib
+from datetime import datetime
+
+#=========================================================================================
+
+class Watermarks:
+    """ Global and per-symbol watermarks, kept in the database of a PriceStore """
+
+    def __init__(self, conn):
+        """
+        :param conn: sqlite3 Connection of the price store
+        """
+        self.conn = conn
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS global_watermark (
+                  name       TEXT    NOT NULL PRIMARY KEY
+                , last_date  TEXT
+                , row_count  INTEGER
+                , col_count  INTEGER
+                , checksum   TEXT
+                , updated_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS symbol_watermarks (
+                  symbol     TEXT    NOT NULL PRIMARY KEY
+                , last_date  TEXT
+                , row_count  INTEGER NOT NULL DEFAULT 0
+                , checksum   TEXT
+                , updated_at TEXT
+            );
+        """)
+        self.conn.commit()
+
+    #=====================================================================================
+
+    def get_global(self, name='master'):
+        """ read a global watermark
+        :param name: name of the watermark
+        :return: dictionary with last_date, row_count, col_count, checksum and updated_at, or None if never set
+        """
+        cur = self.conn.execute("SELECT last_date, row_count, col_count, checksum, updated_at FROM global_watermark WHERE name = ?", (name,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip(['last_date', 'row_count', 'col_count', 'checksum', 'updated_at'], row))
+
+    def set_global(self, last_date, row_count, col_count, checksum, name='master'):
+        """ record a global watermark (call inside the transaction of the write it describes)
+        :param last_date: last date held, as an ISO string
+        :param row_count: number of rows held
+        :param col_count: number of columns held
+        :param checksum: checksum of the data written
+        :param name: name of the watermark
+        """
+        self.conn.execute("""
+            INSERT OR REPLACE INTO global_watermark (name, last_date, row_count, col_count, checksum, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)""", (name, last_date, row_count, col_count, checksum, _now()))
+
+    #=====================================================================================
+
+    def get_symbols(self, symbols=None):
+        """ read per-symbol watermarks
+        :param symbols: list of symbols, None for all of them
+        :return: dictionary of symbol -> dictionary with last_date, row_count and checksum
+        """
+        if symbols is None:
+            cur = self.conn.execute("SELECT symbol, last_date, row_count, checksum FROM symbol_watermarks")
+            rows = cur.fetchall()
+        else:
+            symbols = list(symbols)
+            rows = []
+            for start in range(0, len(symbols), 900):
+                chunk = symbols[start:start + 900]
+                cur = self.conn.execute(f"SELECT symbol, last_date, row_count, checksum FROM symbol_watermarks WHERE symbol IN ({','.join('?' * len(chunk))})", chunk)
+                rows.extend(cur.fetchall())
+        return {symbol: {'last_date': last_date, 'row_count': row_count, 'checksum': checksum} for symbol, last_date, row_count, checksum in rows}
+
+    def advance_symbols(self, batches):
+        """ move per-symbol watermarks forward after writing prices (call inside the same transaction)
+        :param batches: iterable of (symbol, dates, values, row_count, last_date): the ISO dates and
+                        values just written, and the symbol's row count and last date after the write
+        """
+        batches = list(batches)
+        current = self.get_symbols([batch[0] for batch in batches])
+        updated_at = _now()
+        rows = []
+        for symbol, dates, values, row_count, last_date in batches:
+            previous = current.get(symbol, {'checksum': None})
+            digest = hashlib.sha256((previous['checksum'] or '').encode())
+            for d, v in zip(dates, values):
+                digest.update(f"{d},{v!r}\n".encode())
+            rows.append((symbol, last_date, row_count, digest.hexdigest(), updated_at))
+        self.conn.executemany("""
+            INSERT OR REPLACE INTO symbol_watermarks (symbol, last_date, row_count, checksum, updated_at)
+            VALUES (?, ?, ?, ?, ?)""", rows)
+
+#=========================================================================================
+
+def file_checksum(file_name, block_size=1 << 20):
+    """ compute the SHA-256 of a file, reading it in blocks
+    :param file_name: path of the file
+    :param block_size: number of bytes read at a time
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as filehandle:
+        for block in iter(lambda: filehandle.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _now():
+    return datetime.utcnow().isoformat(sep=" ", timespec="seconds")
@@ -0,0 +1,265 @@
+""" work_queue.py - Durable, resumable queue of symbol downloads
+
+Instead of re-running update_data_db.py every hour and re-selecting every row
+of yahoo_links that is older than 22 hours, the symbols to refresh for a given
+day are written once into the fetch_queue table. A single long-running worker
+then drains that table as fast as Yahoo allows:
+
+  * every job carries its attempt count and the time it may next be tried,
+  * 429 (Too Many Requests) and 5xx responses push the job back with an
+    exponential delay, and make the AdaptiveThrottle halve the request rate,
+  * a run of successful responses raises the rate again, step by step,
+  * progress is committed after every batch, so a crash resumes with exactly
+    the jobs that were still pending."""
+import logging
+import random
+import time
+
+#=========================================================================================
+
+# Responses worth retrying later: throttling and server-side trouble
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+#=========================================================================================
+
+class WorkQueue:
+    """ Symbol downloads for a day, persisted in the fetch_queue table of a SQLite database """
+
+    def __init__(self, conn):
+        """
+        :param conn: sqlite3 Connection the queue table lives in
+        """
+        self.conn = conn
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS fetch_queue (
+                  symbol        TEXT    NOT NULL PRIMARY KEY
+                , link          TEXT    NOT NULL
+                , run_date      TEXT    NOT NULL
+                , status        TEXT    NOT NULL DEFAULT 'pending'
+                , attempts      INTEGER NOT NULL DEFAULT 0
+                , next_eligible REAL    NOT NULL DEFAULT 0
+                , last_status   INTEGER
+                , updated_at    TEXT
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_fetch_queue_run_status ON fetch_queue (run_date, status, next_eligible)")
+        self.conn.commit()
+
+    def has_run(self, run_date):
+        """ check whether jobs were already queued for run_date (i.e. we are resuming)
+        :param run_date: ISO date of the daily refresh
+        :return: True or False
+        """
+        cur = self.conn.execute("SELECT EXISTS(SELECT 1 FROM fetch_queue WHERE run_date = ?)", (run_date,))
+        return bool(cur.fetchone()[0])
+
+    def enqueue(self, jobs, run_date):
+        """ queue (symbol, link) downloads for run_date; jobs left over from another day are reset
+        :param jobs: iterable of (symbol, link) tuples
+        :param run_date: ISO date of the daily refresh
+        :return: number of jobs queued
+        """
+        rows = [(symbol, link, run_date) for symbol, link in jobs]
+        with self.conn:
+            self.conn.executemany("""
+                INSERT INTO fetch_queue (symbol, link, run_date) VALUES (?, ?, ?)
+                ON CONFLICT (symbol) DO UPDATE SET
+                      link = excluded.link
+                    , run_date = excluded.run_date
+                    , status = 'pending'
+                    , attempts = 0
+                    , next_eligible = 0
+                    , last_status = NULL
+                WHERE fetch_queue.run_date <> excluded.run_date""", rows)
+        return len(rows)
+
+    def claim(self, run_date, limit, now=None):
+        """ get the pending jobs that may be tried now, longest waiting first
+        :param run_date: ISO date of the daily refresh
+        :param limit: maximum number of jobs returned
+        :param now: current unix time, defaults to time.time()
+        :return: list of (symbol, link) tuples
+        """
+        now = time.time() if now is None else now
+        cur = self.conn.execute("""
+            SELECT symbol, link FROM fetch_queue
+            WHERE run_date = ? AND status = 'pending' AND next_eligible <= ?
+            ORDER BY next_eligible, symbol
+            LIMIT ?""", (run_date, now, limit))
+        return cur.fetchall()
+
+    def next_eligible(self, run_date):
+        """ get the earliest time at which a pending job may be tried
+        :param run_date: ISO date of the daily refresh
+        :return: unix time, or None when nothing is pending
+        """
+        cur = self.conn.execute("SELECT MIN(next_eligible) FROM fetch_queue WHERE run_date = ? AND status = 'pending'", (run_date,))
+        return cur.fetchone()[0]
+
+    def counts(self, run_date):
+        """ count the jobs of run_date by status
+        :param run_date: ISO date of the daily refresh
+        :return: dictionary of status -> count
+        """
+        cur = self.conn.execute("SELECT status, COUNT(*) FROM fetch_queue WHERE run_date = ? GROUP BY status", (run_date,))
+        return dict(cur.fetchall())
+
+    def record(self, done, retry, failed):
+        """ save the outcome of a batch in a single transaction
+        :param done: list of (symbol, http_status) that succeeded
+        :param retry: list of (symbol, http_status, next_eligible) to try again later
+        :param failed: list of (symbol, http_status) that will not be retried
+        """
+        updated_at = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        with self.conn:
+            self.conn.executemany("""
+                UPDATE fetch_queue SET status = 'done', attempts = attempts + 1, last_status = ?, updated_at = ?
+                WHERE symbol = ?""", [(status, updated_at, symbol) for symbol, status in done])
+            self.conn.executemany("""
+                UPDATE fetch_queue SET attempts = attempts + 1, last_status = ?, next_eligible = ?, updated_at = ?
+                WHERE symbol = ?""", [(status, eligible, updated_at, symbol) for symbol, status, eligible in retry])
+            self.conn.executemany("""
+                UPDATE fetch_queue SET status = 'failed', attempts = attempts + 1, last_status = ?, updated_at = ?
+                WHERE symbol = ?""", [(status, updated_at, symbol) for symbol, status in failed])
+
+    def attempts(self, symbols):
+        """ get the number of attempts already made for each symbol
+        :param symbols: list of symbols
+        :return: dictionary of symbol -> attempts
+        """
+        attempts = {}
+        for start in range(0, len(symbols), 500): # stay below SQLite's limit on host parameters
+            chunk = symbols[start:start + 500]
+            cur = self.conn.execute(f"SELECT symbol, attempts FROM fetch_queue WHERE symbol IN ({','.join('?' * len(chunk))})", chunk)
+            attempts.update(cur.fetchall())
+        return attempts
+
+#=========================================================================================
+
+class AdaptiveThrottle:
+    """ Additive-increase / multiplicative-decrease control of the FetchEngine request rate
+
+    A throttled (429) or 5xx response cuts the rate by `decrease` - at most
+    once per `cooldown` seconds, so that a burst of rejections from requests
+    already in flight counts as a single signal. Every `recover_after`
+    consecutive successes add `increase` requests/second back, up to the rate
+    the engine started with.
+    """
+
+    def __init__(self, engine, min_rate=0.1, max_rate=None, decrease=0.5, increase=0.5, recover_after=20, cooldown=2.0):
+        """
+        :param engine: FetchEngine whose rate is controlled
+        :param min_rate: lowest rate the throttle will go down to
+        :param max_rate: highest rate the throttle will go up to, defaults to the engine's current rate
+        :param decrease: factor applied to the rate after a throttled response
+        :param increase: requests/second added back after `recover_after` successes
+        :param recover_after: number of consecutive successes before raising the rate
+        :param cooldown: seconds after a decrease during which further throttled responses are ignored
+        """
+        self.engine = engine
+        self.min_rate = min_rate
+        self.max_rate = engine.rate if max_rate is None else max_rate
+        self.decrease = decrease
+        self.increase = increase
+        self.recover_after = recover_after
+        self.cooldown = cooldown
+        self._successes = 0
+        self._last_decrease = None
+
+    @property
+    def rate(self):
+        return self.engine.rate
+
+    def on_success(self):
+        self._successes += 1
+        if self._successes >= self.recover_after and self.rate < self.max_rate:
+            self.engine.set_rate(min(self.max_rate, self.rate + self.increase))
+            self._successes = 0
+            logging.info(f"Upstream recovering - request rate raised to {self.rate:.2f}/s")
+
+    def on_throttled(self):
+        self._successes = 0
+        now = time.monotonic()
+        if self._last_decrease is not None and now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        new_rate = max(self.min_rate, self.rate * self.decrease)
+        if new_rate < self.rate:
+            self.engine.set_rate(new_rate)
+            logging.info(f"Upstream throttling - request rate lowered to {self.rate:.2f}/s")
+
+#=========================================================================================
+
+def retry_delay(attempts, base_delay=30.0, max_delay=3600.0):
+    """ exponential backoff with jitter for a job that has failed `attempts` times
+    :param attempts: number of attempts made so far, including the one that just failed
+    :param base_delay: delay in seconds after the first failure
+    :param max_delay: upper bound on the delay in seconds
+    :return: delay in seconds
+    """
+    delay = min(max_delay, base_delay * (2 ** (attempts - 1)))
+    return delay * random.uniform(0.75, 1.25)
+
+
+def drain_queue(queue, engine, on_batch, run_date, batch_size=None, max_attempts=8,
+                base_delay=30.0, max_delay=3600.0, throttle=None, sleep=time.sleep, should_stop=None):
+    """ download every pending job of run_date, waiting out backoffs, until the queue is empty
+
+    on_batch is called with the successful FetchResults of each batch and must
+    persist them before returning: only then are the jobs marked as done. It
+    returns the keys it saved; downloads it could not use are marked as failed.
+
+    :param queue: WorkQueue to drain
+    :param engine: FetchEngine used for the downloads
+    :param on_batch: callable(list of FetchResult) that saves successful downloads and returns the saved keys
+    :param run_date: ISO date of the daily refresh
+    :param batch_size: number of jobs downloaded between commits, defaults to 4 x engine.max_workers
+    :param max_attempts: attempts after which a retryable job is given up
+    :param base_delay: retry delay in seconds after a job's first failure
+    :param max_delay: upper bound on a job's retry delay in seconds
+    :param throttle: AdaptiveThrottle adjusting the engine's rate, one is created if None
+    :param sleep: function used to wait for the next eligible job
+    :param should_stop: function checked before every batch - when it returns True, the queue is left as it is
+    :return: dictionary of status -> count for run_date once drained (or stopped)
+    """
+    batch_size = batch_size or engine.max_workers * 4
+    throttle = throttle or AdaptiveThrottle(engine)
+
+    while should_stop is None or not should_stop():
+        jobs = queue.claim(run_date, batch_size)
+        if not jobs:
+            wake = queue.next_eligible(run_date)
+            if wake is None:
+                break
+            logging.info(f"All pending downloads are backing off - sleeping {max(0.0, wake - time.time()):.0f}s")
+            sleep(max(0.0, wake - time.time()))
+            continue
+
+        previous_attempts = queue.attempts([symbol for symbol, _ in jobs])
+        done, retry, failed, downloaded = [], [], [], []
+        for result in engine.fetch_all(jobs):
+            attempts = previous_attempts.get(result.key, 0) + 1
+            if result.status_code == 200:
+                throttle.on_success()
+                downloaded.append(result)
+            elif result.status_code is None or result.status_code in RETRYABLE_STATUS_CODES:
+                if result.status_code is not None:
+                    throttle.on_throttled()
+                if attempts >= max_attempts:
+                    logging.info(f"Failed {result.key}: {result.status_code or result.error} - giving up after {attempts} attempts")
+                    failed.append((result.key, result.status_code))
+                else:
+                    retry.append((result.key, result.status_code, time.time() + retry_delay(attempts, base_delay, max_delay)))
+            else:
+                logging.info(f"Failed {result.key}: {result.status_code}")
+                failed.append((result.key, result.status_code))
+
+        saved = set(on_batch(downloaded))
+        for result in downloaded:
+            if result.key in saved:
+                done.append((result.key, result.status_code))
+            else:
+                failed.append((result.key, result.status_code))
+        queue.record(done, retry, failed)
+        logging.info(f"Batch finished: {len(done)} done, {len(retry)} to retry, {len(failed)} failed; queue {queue.counts(run_date)}")
+
+    return queue.counts(run_date)
@@ -0,0 +1,92 @@
+""" test_compaction.py - Appending the day's pieces to the master data file, atomically """
+import hashlib
+import os
+
+import pytest
+
+import pipeline.compaction
+from pipeline.compaction import CompactionError, compact_pieces
+
+#=========================================================================================
+
+MASTER = "Date,AAA,BBB\n2023-10-10,1.0,2.0\n2023-10-11,1.1,2.1\n"
+
+
+def _write(path, text):
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+
+@pytest.fixture
+def master(tmp_path):
+    return _write(tmp_path / "historical_ticker_data.csv", MASTER)
+
+#=========================================================================================
+
+def test_pieces_are_merged_by_date_in_master_column_order(tmp_path, master):
+    pieces = [
+          _write(tmp_path / "database_1.csv", "Date,BBB\n2023-10-12,2.2\n2023-10-13,2.3\n")
+        , _write(tmp_path / "database_2.csv", "Date,AAA\n2023-10-12,1.2\n2023-10-13,1.3\n")
+    ]
+    stats = compact_pieces(master, pieces)
+    with open(master, encoding='utf-8') as filehandle:
+        assert filehandle.read() == MASTER + "2023-10-12,1.2,2.2\n2023-10-13,1.3,2.3\n"
+    assert stats['rows_appended'] == 2
+    assert stats['last_date'] == '2023-10-13'
+    with open(master, 'rb') as filehandle:
+        assert stats['checksum'] == hashlib.sha256(filehandle.read()).hexdigest()
+
+
+def test_rows_already_in_the_master_and_empty_rows_are_skipped(tmp_path, master):
+    piece = _write(tmp_path / "database_1.csv", "Date,AAA,BBB\n2023-10-11,9,9\n2023-10-12,,\n2023-10-13,1.3,2.3\n")
+    stats = compact_pieces(master, [piece])
+    assert stats['rows_skipped'] == 1
+    assert stats['rows_appended'] == 1
+    # running it again appends nothing
+    assert compact_pieces(master, [piece])['rows_appended'] == 0
+
+
+def test_missing_and_new_columns_are_errors_unless_allowed(tmp_path, master):
+    with open(master, 'rb') as filehandle:
+        before = filehandle.read()
+    missing = _write(tmp_path / "database_1.csv", "Date,AAA\n2023-10-12,1.2\n")
+    new = _write(tmp_path / "database_2.csv", "Date,AAA,BBB,CCC\n2023-10-12,1.2,2.2,3.2\n")
+    with pytest.raises(CompactionError):
+        compact_pieces(master, [missing])
+    with pytest.raises(CompactionError):
+        compact_pieces(master, [new])
+    with open(master, 'rb') as filehandle:
+        assert filehandle.read() == before
+
+
+def test_new_columns_are_added_to_the_master(tmp_path, master):
+    piece = _write(tmp_path / "database_1.csv", "Date,AAA,CCC\n2023-10-12,1.2,3.2\n")
+    stats = compact_pieces(master, [piece], allow_missing_columns=True, allow_new_columns=True)
+    with open(master, encoding='utf-8') as filehandle:
+        assert filehandle.read() == ("Date,AAA,BBB,CCC\n2023-10-10,1.0,2.0,\n2023-10-11,1.1,2.1,\n"
+                                     "2023-10-12,1.2,,3.2\n")
+    assert stats['missing_columns'] == ['BBB']
+    assert stats['new_columns'] == ['CCC']
+    assert stats['col_count'] == 3
+
+
+def test_a_failed_compaction_leaves_the_master_and_no_temporary_file(tmp_path, master, monkeypatch):
+    piece = _write(tmp_path / "database_1.csv", "Date,AAA,BBB\n2023-10-12,1.2,2.2\n")
+
+    def crash(source, destination):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(pipeline.compaction.os, 'replace', crash)
+    with pytest.raises(OSError):
+        compact_pieces(master, [piece])
+    with open(master, encoding='utf-8') as filehandle:
+        assert filehandle.read() == MASTER
+    assert sorted(os.listdir(tmp_path)) == ["database_1.csv", "historical_ticker_data.csv"]
+
+
+def test_the_master_is_created_from_the_pieces(tmp_path):
+    master = str(tmp_path / "historical_ticker_data.csv")
+    piece = _write(tmp_path / "database_1.csv", "Date,BBB,AAA\n2023-10-12,2.2,1.2\n")
+    compact_pieces(master, [piece])
+    with open(master, encoding='utf-8') as filehandle:
+        assert filehandle.read() == "Date,AAA,BBB\n2023-10-12,1.2,2.2\n"
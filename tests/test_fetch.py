@@ -0,0 +1,91 @@
+""" test_fetch.py - FetchEngine and TokenBucket against the local stand-in Yahoo server """
+import time
+
+import pytest
+
+from pipeline.fetch import FetchEngine, TokenBucket
+from pipeline.stub_server import StubYahooServer
+
+#=========================================================================================
+
+PAYLOADS = {
+      'MSFT' : b"Date,Open,High,Low,Close,Adj Close,Volume\n2023-10-02,1,1,1,1,321.8,10\n"
+    , 'AAPL' : b"Date,Open,High,Low,Close,Adj Close,Volume\n2023-10-02,1,1,1,1,173.75,10\n"
+    , 'IBM'  : b"Date,Open,High,Low,Close,Adj Close,Volume\n2023-10-02,1,1,1,1,140.8,10\n"
+}
+
+
+@pytest.fixture
+def server():
+    with StubYahooServer(PAYLOADS) as stub:
+        yield stub
+
+
+def _link(server, symbol):
+    return server.link_template(symbol).replace('{timestmp1}', '1696204800').replace('{timestmp2}', '1696291200')
+
+#=========================================================================================
+
+def test_token_bucket_spaces_requests_after_the_burst():
+    bucket = TokenBucket(rate=20, capacity=1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    # the first token is there at once, the next five come 1/20 s apart
+    assert time.monotonic() - start >= 5 / 20 * 0.9
+
+
+def test_token_bucket_rejects_a_rate_that_is_not_positive():
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+
+
+def test_results_map_to_their_symbol(server):
+    jobs = [(symbol, _link(server, symbol)) for symbol in PAYLOADS]
+    with FetchEngine(max_workers=3, rate=100) as engine:
+        results = {result.key: result for result in engine.fetch_all(jobs)}
+    assert set(results) == set(PAYLOADS)
+    for symbol, result in results.items():
+        assert result.status_code == 200
+        assert result.content == PAYLOADS[symbol]
+        assert result.url.startswith(f"{server.base_url}/v7/finance/download/{symbol}?")
+
+
+def test_rate_limit_applies_to_concurrent_downloads(server):
+    jobs = [('MSFT', _link(server, 'MSFT'))] * 8
+    with FetchEngine(max_workers=8, rate=10, burst=1) as engine:
+        start = time.monotonic()
+        list(engine.fetch_all(jobs))
+        elapsed = time.monotonic() - start
+    # 8 requests at 10/s with no burst: at least 7 intervals of 0.1 s, however many workers
+    assert elapsed >= 0.7 * 0.9
+    assert len(server.request_paths) == 8
+
+
+def test_throttled_and_failed_responses_are_returned_not_raised(server):
+    server.statuses.extend([429, 503])
+    with FetchEngine(max_workers=1, rate=100) as engine:
+        statuses = [engine.fetch('MSFT', _link(server, 'MSFT')).status_code for _ in range(3)]
+        unknown = engine.fetch('NOPE', _link(server, 'NOPE'))
+    assert statuses == [429, 503, 200]
+    assert unknown.status_code == 404
+    assert unknown.error is None
+
+
+def test_connection_errors_have_no_status():
+    with StubYahooServer(PAYLOADS) as stub:
+        link = _link(stub, 'MSFT')
+    # the server is gone: the request fails without a response
+    with FetchEngine(max_workers=1, rate=100, timeout=2) as engine:
+        result = engine.fetch('MSFT', link)
+    assert result.key == 'MSFT'
+    assert result.status_code is None
+    assert result.error is not None
+
+
+def test_set_rate_changes_the_hosts_already_seen(server):
+    with FetchEngine(max_workers=1, rate=100) as engine:
+        bucket = engine.bucket_for(server.base_url)
+        engine.set_rate(2)
+        assert bucket.rate == 2
+        assert engine.bucket_for(server.base_url + "/other").rate == 2
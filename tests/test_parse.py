@@ -0,0 +1,89 @@
+""" test_parse.py - Parsing batches of downloaded price CSVs into flat arrays """
+import os
+import signal
+
+import numpy as np
+import pytest
+
+from pipeline.parse import ParsePool, _iso_dates, parse_price_payloads
+
+#=========================================================================================
+
+HEADER = b"Date,Open,High,Low,Close,Adj Close,Volume\n"
+
+
+def _payload(*rows):
+    return HEADER + b''.join(f"{date},1,1,1,1,{price},10\n".encode() for date, price in rows)
+
+
+def _as_dict(parsed):
+    return {symbol: (dates.astype(str).tolist(), values.tolist()) for symbol, dates, values in parsed.series()}
+
+#=========================================================================================
+
+def test_iso_dates_reads_every_line():
+    dates = _iso_dates(b"1999-12-31,1\n2000-02-29,2\n2023-10-13,3\n")
+    assert dates.astype(str).tolist() == ['1999-12-31', '2000-02-29', '2023-10-13']
+
+
+@pytest.mark.parametrize('buffer', [
+      b"2023-10-12,1\n2023-10\n2023-10-13,3\n"    # a short line in the middle
+    , b"2023-10-12,1\n\n2023-10-13,3\n"          # a blank line
+    , b"2023-10-12,1\n2023-10-1\n"             # a last line cut short
+    , b"2023-13-01,1\n"                        # not a date
+    , b"null,1\n2023-10-13,3\n"
+])
+def test_iso_dates_rejects_lines_without_a_whole_date(buffer):
+    assert _iso_dates(buffer) is None
+
+
+def test_batch_keeps_each_symbol_rows():
+    parsed = parse_price_payloads([
+          ('AAA', _payload(('2023-10-12', 1.5), ('2023-10-13', 1.6)))
+        , ('BBB', _payload(('2023-10-13', 2.5)))
+        , ('CCC', HEADER)
+    ])
+    assert parsed.symbols == ['AAA', 'BBB', 'CCC']
+    assert _as_dict(parsed) == {
+          'AAA' : (['2023-10-12', '2023-10-13'], [1.5, 1.6])
+        , 'BBB' : (['2023-10-13'], [2.5])
+        , 'CCC' : ([], [])
+    }
+    assert parsed.errors == []
+
+
+def test_odd_payloads_fall_back_to_pandas_without_affecting_the_others():
+    parsed = parse_price_payloads([
+          ('AAA', _payload(('2023-10-12', 1.5)))
+        , ('BBB', b"Date,Adj Close\n10/13/2023,2.5\n")  # not an ISO date: parsed by pandas
+        , ('CCC', _payload(('2023-10-13', 'null')))   # Yahoo's missing price
+        , ('DDD', b"<html>Not found</html>")
+    ])
+    result = _as_dict(parsed)
+    assert result['AAA'] == (['2023-10-12'], [1.5])
+    assert result['BBB'] == (['2023-10-13'], [2.5])
+    assert result['CCC'][0] == ['2023-10-13']
+    assert np.isnan(result['CCC'][1][0])
+    assert 'DDD' not in result
+    assert [symbol for symbol, _ in parsed.errors] == ['DDD']
+
+
+PAYLOADS = [(f"S{i}", _payload(('2023-10-12', i), ('2023-10-13', 'null'), ('2023-10-16', i + 0.5))) for i in range(20)]
+
+
+def test_pool_matches_the_single_process_parse():
+    with ParsePool(workers=2, min_chunk_size=3) as pool:
+        parsed = pool.parse(PAYLOADS, start='2023-10-13')
+    assert parsed.symbols == [symbol for symbol, _ in PAYLOADS]
+    assert _as_dict(parsed)['S7'] == (['2023-10-16'], [7.5])
+
+
+def test_pool_restarts_after_losing_a_worker():
+    with ParsePool(workers=2, min_chunk_size=3) as pool:
+        broken = pool.executor
+        pid = next(iter(broken._processes))
+        os.kill(pid, signal.SIGKILL)
+        parsed = pool.parse(PAYLOADS, start='2023-10-13')
+        assert pool.executor is not broken
+        assert pool.parse(PAYLOADS).symbols == parsed.symbols
+    assert parsed.symbols == [symbol for symbol, _ in PAYLOADS]
@@ -0,0 +1,38 @@
+""" test_registry.py - Queries and updates of the yahoo_links registry """
+import sqlite3
+
+import pytest
+
+from pipeline.registry import REGISTRY_COLUMNS, ensure_indexes, mark_updated, read_registry
+
+#=========================================================================================
+
+ROWS = [
+      ('AAA', '2023-10-13T08:00:00')   # written by the scripts' to_sql
+    , ('BBB', '2023-10-12T23:00:00')
+    , ('CCC', '1970-01-01 00:00:00')
+]
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute(f"CREATE TABLE yahoo_links ({', '.join(REGISTRY_COLUMNS)})")
+    conn.executemany("INSERT INTO yahoo_links (Yahoo_Symbol, last_update) VALUES (?, ?)", ROWS)
+    yield conn
+    conn.close()
+
+
+def _symbols(df):
+    return df['Yahoo_Symbol'].tolist()
+
+#=========================================================================================
+
+def test_last_update_is_compared_as_a_time_whatever_wrote_it(conn):
+    ensure_indexes(conn)
+    mark_updated(conn, ['CCC'], '2023-10-13 09:00:00')
+    assert [row[0] for row in conn.execute("SELECT last_update FROM yahoo_links ORDER BY Yahoo_Symbol")] == [
+        '2023-10-13 08:00:00', '2023-10-12 23:00:00', '2023-10-13 09:00:00']
+    # on the day of the cutoff, only the rows updated before it are stale
+    assert _symbols(read_registry(conn, updated_before='2023-10-13 08:30:00')) == ['AAA', 'BBB']
+    assert _symbols(read_registry(conn, updated_after='2023-10-13 08:30:00')) == ['CCC']
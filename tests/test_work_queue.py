@@ -0,0 +1,124 @@
+""" test_work_queue.py - Draining the persistent download queue, with retries and adaptive throttling """
+import sqlite3
+
+import pytest
+
+from pipeline.fetch import FetchEngine
+from pipeline.stub_server import StubYahooServer
+from pipeline.work_queue import AdaptiveThrottle, WorkQueue, drain_queue, retry_delay
+
+#=========================================================================================
+
+RUN_DATE = '2023-10-13'
+PAYLOADS = {symbol: f"Date,Adj Close\n2023-10-12,{i}\n".encode() for i, symbol in enumerate(['AAA', 'BBB', 'CCC', 'DDD'])}
+
+
+@pytest.fixture
+def server():
+    with StubYahooServer(PAYLOADS) as stub:
+        yield stub
+
+
+@pytest.fixture
+def queue():
+    conn = sqlite3.connect(':memory:')
+    yield WorkQueue(conn)
+    conn.close()
+
+
+def _drain(queue, saved=None, **kwargs):
+    """ drain the queue without waiting out the backoffs; saved collects the keys on_batch received """
+    saved = [] if saved is None else saved
+
+    def on_batch(results):
+        saved.extend(result.key for result in results)
+        return [result.key for result in results]
+
+    with FetchEngine(max_workers=2, rate=1000) as engine:
+        kwargs.setdefault('throttle', AdaptiveThrottle(engine, cooldown=0))
+        return drain_queue(queue, engine, on_batch, RUN_DATE, base_delay=0, max_delay=0, sleep=lambda seconds: None, **kwargs)
+
+
+def _enqueue(queue, server, symbols):
+    queue.enqueue([(symbol, server.link_template(symbol)) for symbol in symbols], RUN_DATE)
+
+#=========================================================================================
+
+def test_every_job_is_downloaded_once(queue, server):
+    _enqueue(queue, server, PAYLOADS)
+    saved = []
+    assert _drain(queue, saved) == {'done': len(PAYLOADS)}
+    assert sorted(saved) == sorted(PAYLOADS)
+    assert len(server.request_paths) == len(PAYLOADS)
+
+
+def test_throttled_and_server_errors_are_retried(queue, server):
+    _enqueue(queue, server, ['AAA'])
+    server.statuses.extend([429, 503, 500])
+    assert _drain(queue) == {'done': 1}
+    assert queue.attempts(['AAA']) == {'AAA': 4}
+
+
+def test_retryable_jobs_are_given_up_after_max_attempts(queue, server):
+    _enqueue(queue, server, ['AAA'])
+    server.statuses.extend([429] * 10)
+    assert _drain(queue, max_attempts=3) == {'failed': 1}
+    assert queue.attempts(['AAA']) == {'AAA': 3}
+
+
+def test_other_errors_fail_at_once(queue, server):
+    _enqueue(queue, server, ['AAA', 'ZZZ']) # no payload for ZZZ: 404
+    assert _drain(queue) == {'done': 1, 'failed': 1}
+    assert queue.attempts(['ZZZ']) == {'ZZZ': 1}
+
+
+def test_downloads_on_batch_did_not_save_are_failed(queue, server):
+    _enqueue(queue, server, ['AAA', 'BBB'])
+    with FetchEngine(max_workers=2, rate=1000) as engine:
+        counts = drain_queue(queue, engine, lambda results: ['AAA'], RUN_DATE, sleep=lambda seconds: None)
+    assert counts == {'done': 1, 'failed': 1}
+
+
+def test_a_stopped_drain_resumes_with_the_pending_jobs(queue, server):
+    _enqueue(queue, server, PAYLOADS)
+    assert _drain(queue, batch_size=1, should_stop=lambda: True) == {'pending': len(PAYLOADS)}
+    assert queue.has_run(RUN_DATE)
+    # queueing the same day again keeps the jobs as they are
+    _enqueue(queue, server, PAYLOADS)
+    assert _drain(queue) == {'done': len(PAYLOADS)}
+
+
+def test_jobs_of_an_earlier_day_are_reset(queue, server):
+    queue.enqueue([('AAA', server.link_template('AAA'))], '2023-10-12')
+    queue.record([('AAA', 200)], [], [])
+    _enqueue(queue, server, ['AAA'])
+    assert queue.counts(RUN_DATE) == {'pending': 1}
+    assert queue.attempts(['AAA']) == {'AAA': 0}
+
+#=========================================================================================
+
+def test_throttle_halves_the_rate_and_recovers_step_by_step():
+    with FetchEngine(rate=4) as engine:
+        throttle = AdaptiveThrottle(engine, recover_after=2, increase=1, cooldown=0)
+        throttle.on_throttled()
+        assert engine.rate == 2
+        for _ in range(2):
+            throttle.on_success()
+        assert engine.rate == 3
+        for _ in range(10):
+            throttle.on_success()
+        assert engine.rate == 4 # never above the starting rate
+
+
+def test_throttle_counts_a_burst_of_rejections_once():
+    with FetchEngine(rate=4) as engine:
+        throttle = AdaptiveThrottle(engine, cooldown=60)
+        for _ in range(5):
+            throttle.on_throttled()
+        assert engine.rate == 2
+
+
+def test_retry_delay_grows_exponentially_up_to_the_cap():
+    assert 0.75 * 30 <= retry_delay(1) <= 1.25 * 30
+    assert 0.75 * 120 <= retry_delay(3) <= 1.25 * 120
+    assert retry_delay(50, max_delay=600) <= 1.25 * 600
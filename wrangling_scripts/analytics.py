@@ -0,0 +1,186 @@
+""" analytics.py - Vectorized return and risk statistics of symbols and portfolios
+
+Everything here works on the dates x symbols matrix of adjusted closes (the
+snapshot's matrix, a read_wide() dataframe, or any 2-D array), whole columns at
+a time:
+
+    df_returns = daily_returns(df_prices)
+    df_stats = symbol_statistics(df_returns, benchmark="SPY")
+    df_portfolio_stats = portfolio_statistics(df_returns, weights, benchmark="SPY")
+
+Portfolios are rows of a portfolios x symbols weight matrix. Their daily
+returns are one matrix product, returns (dates x symbols) @ weights.T, done
+for a few thousand portfolios at a time so that the dates x portfolios result
+stays small; every statistic is then computed on the columns of that product.
+The portfolios are rebalanced daily to their weights, and a symbol without a
+price on a day contributes a zero return to them.
+
+Statistics (periods_per_year = 252 trading days by default):
+
+  * annual_return      geometric: (product of (1 + r)) ** (periods_per_year / n) - 1
+  * annual_volatility  standard deviation of the returns * sqrt(periods_per_year)
+  * sharpe             annualized mean excess return / annual_volatility
+  * sortino            annualized mean excess return / annualized downside deviation
+  * max_drawdown       largest fall from a running peak of the value, as a negative fraction
+  * beta               covariance with the benchmark's returns / variance of the benchmark's returns"""
+import numpy as np
+import pandas as pd
+
+#=========================================================================================
+
+PERIODS_PER_YEAR = 252
+
+STATISTICS = ['annual_return', 'annual_volatility', 'sharpe', 'sortino', 'max_drawdown', 'beta']
+
+#=========================================================================================
+
+def daily_returns(prices, log=False):
+    """ compute the returns from one row of prices to the next
+    :param prices: dates x symbols dataframe or 2-D array of prices (NaN for no price)
+    :param log: compute log returns, log(p[t] / p[t-1]), instead of simple returns, p[t] / p[t-1] - 1
+    :return: returns of the same type, one row shorter (NaN where either price is missing)
+    """
+    values = np.asarray(prices, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = values[1:] / values[:-1]
+        returns = np.log(ratio) if log else ratio - 1.0
+    returns[~np.isfinite(returns)] = np.nan
+    if isinstance(prices, pd.DataFrame):
+        return pd.DataFrame(returns, index=prices.index[1:], columns=prices.columns)
+    return returns
+
+
+def _split_benchmark(returns, benchmark):
+    """ get the returns matrix and the benchmark's returns as arrays
+    :return: (matrix, benchmark returns vector or None, column labels or None)
+    """
+    columns = returns.columns if isinstance(returns, pd.DataFrame) else None
+    matrix = np.asarray(returns)
+    if benchmark is None:
+        return matrix, None, columns
+    if isinstance(benchmark, str):
+        if columns is None:
+            raise ValueError("a benchmark symbol needs the returns as a dataframe")
+        benchmark = returns[benchmark]
+    benchmark = np.asarray(benchmark, dtype=np.float64)
+    if benchmark.shape != (matrix.shape[0],):
+        raise ValueError(f"benchmark has {benchmark.shape[0]} returns, the matrix has {matrix.shape[0]} rows")
+    return matrix, benchmark, columns
+
+
+def _statistics(matrix, benchmark, risk_free, periods_per_year):
+    """ the statistics of every column of a dates x columns matrix of returns, NaN being no return that day
+    :return: dictionary of statistic -> array with one value per column
+    """
+    matrix = np.asarray(matrix)
+    missing = np.isnan(matrix)
+    has_missing = missing.any()
+    filled = np.where(missing, 0.0, matrix) if has_missing else matrix
+    counts = (~missing).sum(axis=0) if has_missing else np.full(matrix.shape[1], matrix.shape[0])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Log growth: annual return and drawdowns (a missing return leaves the value unchanged)
+        growth = np.log1p(filled)
+        cumulative = np.cumsum(growth, axis=0)
+        annual_return = np.expm1(cumulative[-1] * (periods_per_year / counts))
+        drawdown = cumulative - np.maximum.accumulate(np.maximum(cumulative, 0.0), axis=0)
+        max_drawdown = np.expm1(drawdown.min(axis=0))
+
+        # Moments of the daily returns
+        risk_free_daily = risk_free / periods_per_year
+        mean = filled.sum(axis=0) / counts
+        centered = filled - mean
+        if has_missing:
+            centered[missing] = 0.0
+        variance = (centered * centered).sum(axis=0) / (counts - 1)
+        volatility = np.sqrt(variance)
+        excess = mean - risk_free_daily
+        downside = np.minimum(filled - risk_free_daily, 0.0)
+        if has_missing:
+            downside[missing] = 0.0
+        downside_deviation = np.sqrt((downside * downside).sum(axis=0) / counts)
+
+        statistics = {
+              'annual_return'     : annual_return
+            , 'annual_volatility' : volatility * np.sqrt(periods_per_year)
+            , 'sharpe'            : excess / volatility * np.sqrt(periods_per_year)
+            , 'sortino'           : excess / downside_deviation * np.sqrt(periods_per_year)
+            , 'max_drawdown'      : max_drawdown
+        }
+
+        if benchmark is not None:
+            benchmark_valid = ~np.isnan(benchmark)
+            benchmark_centered = np.where(benchmark_valid, benchmark - np.nanmean(benchmark), 0.0)
+            # One matrix-vector product gives the covariance of every column with the benchmark
+            covariance = (centered.T @ benchmark_centered.astype(centered.dtype)) / (counts - 1)
+            statistics['beta'] = covariance / (benchmark_centered @ benchmark_centered / (benchmark_valid.sum() - 1))
+        else:
+            statistics['beta'] = np.full(matrix.shape[1], np.nan)
+
+    for values in statistics.values():
+        values[counts < 2] = np.nan
+    return statistics
+
+#=========================================================================================
+
+def symbol_statistics(returns, benchmark=None, risk_free=0.0, periods_per_year=PERIODS_PER_YEAR):
+    """ compute the statistics of every symbol
+    :param returns: dates x symbols dataframe or 2-D array of daily returns (NaN for no return)
+    :param benchmark: returns of the benchmark (array or series aligned with the rows), or the symbol of a column
+    :param risk_free: annual risk-free rate, for the Sharpe and Sortino ratios
+    :param periods_per_year: number of return periods in a year
+    :return: dataframe with one row per symbol and one column per statistic (see STATISTICS)
+    """
+    matrix, benchmark, columns = _split_benchmark(returns, benchmark)
+    statistics = _statistics(matrix.astype(np.float64, copy=False), benchmark, risk_free, periods_per_year)
+    return pd.DataFrame(statistics, index=columns, columns=STATISTICS)
+
+
+def portfolio_returns(returns, weights):
+    """ compute the daily returns of portfolios, rebalanced daily to their weights
+    :param returns: dates x symbols dataframe or 2-D array of daily returns (NaN for no return)
+    :param weights: portfolios x symbols weight matrix (2-D array, or dataframe with symbols as columns)
+    :return: dates x portfolios array
+    """
+    matrix, weights = _weight_matrix(returns, weights)
+    return np.nan_to_num(matrix, nan=0.0) @ weights.T
+
+
+def _weight_matrix(returns, weights):
+    """ line the weights up with the columns of the returns """
+    if isinstance(weights, pd.DataFrame):
+        if not isinstance(returns, pd.DataFrame):
+            raise ValueError("weights given per symbol need the returns as a dataframe")
+        weights = weights.reindex(columns=returns.columns, fill_value=0.0)
+    matrix = np.asarray(returns)
+    weights = np.asarray(weights)
+    if weights.ndim != 2 or weights.shape[1] != matrix.shape[1]:
+        raise ValueError(f"weights must be portfolios x {matrix.shape[1]} symbols, not {weights.shape}")
+    return matrix, weights
+
+
+def portfolio_statistics(returns, weights, benchmark=None, risk_free=0.0, periods_per_year=PERIODS_PER_YEAR,
+                         chunk_size=4096, dtype=np.float32):
+    """ compute the statistics of many portfolios at once
+    :param returns: dates x symbols dataframe or 2-D array of daily returns (NaN for no return)
+    :param weights: portfolios x symbols weight matrix (2-D array, or dataframe with symbols as columns)
+    :param benchmark: returns of the benchmark (array or series aligned with the rows), or the symbol of a column
+    :param risk_free: annual risk-free rate, for the Sharpe and Sortino ratios
+    :param periods_per_year: number of return periods in a year
+    :param chunk_size: number of portfolios evaluated per matrix product
+    :param dtype: dtype of the matrix products - float32 halves the memory traffic, float64 for full precision
+    :return: dataframe with one row per portfolio (the index of weights, if a dataframe) and one column per statistic
+    """
+    _, benchmark, _ = _split_benchmark(returns, benchmark)
+    matrix, weight_matrix = _weight_matrix(returns, weights)
+    matrix = np.nan_to_num(matrix.astype(dtype), nan=0.0)
+
+    statistics = {name: np.empty(weight_matrix.shape[0]) for name in STATISTICS}
+    for start in range(0, weight_matrix.shape[0], chunk_size):
+        chunk = np.asarray(weight_matrix[start:start + chunk_size], dtype=dtype)
+        chunk_statistics = _statistics(matrix @ chunk.T, benchmark, risk_free, periods_per_year)
+        for name in STATISTICS:
+            statistics[name][start:start + chunk_size] = chunk_statistics[name]
+
+    index = weights.index if isinstance(weights, pd.DataFrame) else None
+    return pd.DataFrame(statistics, index=index, columns=STATISTICS)
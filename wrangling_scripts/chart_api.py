@@ -0,0 +1,179 @@
+""" chart_api.py - Price series sized for charts, for the Flask JSON API
+
+A chart line has a few hundred pixels: sending it every daily price of fifteen
+years (3,800 points per symbol) wastes megabytes. chart_page returns at most
+`points` points per symbol, at the finest resolution that fits:
+
+  * daily     the prices themselves, when the range has few enough trading days
+  * weekly    the weekly aggregates of the snapshot (pipeline/aggregates.py)
+  * monthly   the monthly aggregates
+  * lttb      the daily prices downsampled with Largest-Triangle-Three-Buckets,
+              when even the monthly aggregates would be too many points (or the
+              snapshot has no aggregates)
+
+Largest-Triangle-Three-Buckets (Steinarsson, 2013) keeps the first and last
+points, splits the others into equal buckets and keeps, in each bucket, the
+point forming the largest triangle with the point kept in the previous bucket
+and the average of the next bucket: peaks and troughs survive the
+downsampling, which an average or every n-th point would flatten."""
+from functools import lru_cache
+
+import numpy as np
+
+from pipeline.aggregates import FIELDS
+from pipeline.snapshot import open_aggregate
+from wrangling_scripts.price_api import MAX_SYMBOLS, _parse_date, _parse_limit, _price_list
+
+#=========================================================================================
+
+DEFAULT_POINTS = 300
+MAX_POINTS = 5000
+RESOLUTIONS = ['auto', 'daily', 'weekly', 'monthly', 'lttb']
+
+#=========================================================================================
+
+def lttb(x, y, n_out):
+    """ downsample a line with Largest-Triangle-Three-Buckets
+    :param x: increasing x of the points (1-D array)
+    :param y: y of the points, without NaN
+    :param n_out: number of points to keep
+    :return: sorted positions of the points kept
+    """
+    n = len(x)
+    if n_out >= n or n <= 2:
+        return np.arange(n)
+    if n_out < 3:
+        return np.array([0, n - 1])[:max(n_out, 1)]
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # Bucket edges of the points between the first and the last; the sums give each bucket's average in O(1)
+    edges = (np.arange(n_out - 1) * ((n - 2) / (n_out - 2))).astype(np.int64) + 1
+    edges[-1] = n - 1
+    sum_x = np.concatenate([[0.0], np.cumsum(x)])
+    sum_y = np.concatenate([[0.0], np.cumsum(y)])
+
+    kept = np.empty(n_out, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_start, next_stop = stop, edges[i + 2]
+        else:
+            next_start, next_stop = n - 1, n # the last bucket is the last point
+        average_x = (sum_x[next_stop] - sum_x[next_start]) / (next_stop - next_start)
+        average_y = (sum_y[next_stop] - sum_y[next_start]) / (next_stop - next_start)
+        # Twice the area of the triangles (a, candidate, next average) - the factor does not change the largest
+        area = np.abs((x[a] - average_x) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (average_y - y[a]))
+        a = start + int(np.argmax(area))
+        kept[i + 1] = a
+    return kept
+
+
+@lru_cache(maxsize=8)
+def _aggregate(version, frequency):
+    """ the aggregates of a snapshot version, mapped once per process - None if the version has none """
+    try:
+        return open_aggregate(frequency, version=version)
+    except FileNotFoundError:
+        return None
+
+
+def _series(dates, values, fields=None):
+    """ one symbol's points, without the dates it has no price on
+    :param dates: date of each point
+    :param values: closes, or 4 x points open/high/low/close array with fields=FIELDS
+    :param fields: names of the rows of values, None for closes only
+    """
+    has_price = ~np.isnan(values if fields is None else values[3])
+    series = {'dates': [str(d) for d in dates[has_price]]}
+    if fields is None:
+        series['close'] = _price_list(values[has_price])
+    else:
+        for f, field in enumerate(fields):
+            series[field] = _price_list(values[f][has_price])
+    return series
+
+#=========================================================================================
+
+def chart_page(snapshot, symbols, start=None, end=None, points=None, resolution=None, ohlc=None):
+    """ get the price lines of a few symbols over a date range, with at most `points` points each
+    :param snapshot: Snapshot to read from
+    :param symbols: comma-separated symbols (at most MAX_SYMBOLS)
+    :param start: first date wanted, YYYY-MM-DD, None for the first date held
+    :param end: last date wanted, YYYY-MM-DD, None for the last date held
+    :param points: most points per symbol, DEFAULT_POINTS if None, at most MAX_POINTS
+    :param resolution: one of RESOLUTIONS - 'auto' (the default) picks the finest that fits in `points`
+    :param ohlc: '1' to also return the open, high and low of the weekly and monthly points
+    :return: dictionary ready for jsonify - resolution, and dates and prices per symbol
+    """
+    list_symbols = list(dict.fromkeys(s.strip() for s in (symbols or '').split(',') if s.strip()))
+    if len(list_symbols) == 0:
+        raise ValueError("symbols is required, as a comma-separated list")
+    if len(list_symbols) > MAX_SYMBOLS:
+        raise ValueError(f"at most {MAX_SYMBOLS} symbols can be requested at once")
+    points = _parse_limit(points, DEFAULT_POINTS, MAX_POINTS)
+    resolution = resolution or 'auto'
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"resolution must be one of {RESOLUTIONS}, not {resolution!r}")
+    with_ohlc = ohlc in ('1', 'true')
+
+    first = snapshot.dates[0] if start in (None, '') else _parse_date(start, 'start')
+    last = snapshot.dates[-1] if end in (None, '') else _parse_date(end, 'end')
+    row_start = int(np.searchsorted(snapshot.dates, first, side='left'))
+    row_stop = int(np.searchsorted(snapshot.dates, last, side='right'))
+
+    columns, unknown = {}, []
+    for symbol in list_symbols:
+        col = snapshot.column(symbol)
+        if col is None:
+            unknown.append(symbol)
+        else:
+            columns[symbol] = col
+
+    # The finest resolution with few enough points: the daily rows, then the weekly and monthly periods
+    aggregate = None
+    if resolution == 'auto':
+        resolution = 'lttb'
+        if row_stop - row_start <= points:
+            resolution = 'daily'
+        else:
+            for frequency in ['weekly', 'monthly']:
+                candidate = _aggregate(snapshot.version, frequency)
+                if candidate is not None:
+                    period_start = int(np.searchsorted(candidate.dates, first, side='left'))
+                    # A period is labelled with its last trading date: the one containing `last` may end after it
+                    period_stop = int(np.searchsorted(candidate.dates, last, side='left')) + 1
+                    if period_stop - period_start <= points:
+                        resolution, aggregate = frequency, candidate
+                        break
+    elif resolution in ('weekly', 'monthly'):
+        aggregate = _aggregate(snapshot.version, resolution)
+        if aggregate is None:
+            raise ValueError(f"snapshot {snapshot.version} has no {resolution} aggregates, use resolution=auto")
+
+    series = {}
+    if aggregate is not None:
+        period_start = int(np.searchsorted(aggregate.dates, first, side='left'))
+        period_stop = min(int(np.searchsorted(aggregate.dates, last, side='left')) + 1, len(aggregate.dates))
+        dates = np.asarray(aggregate.dates[period_start:period_stop])
+        for symbol, col in columns.items():
+            values = np.asarray(aggregate.ohlc[:, period_start:period_stop, col])
+            series[symbol] = _series(dates, values, FIELDS) if with_ohlc else _series(dates, values[3])
+    else:
+        dates = np.asarray(snapshot.dates[row_start:row_stop])
+        for symbol, col in columns.items():
+            values = np.asarray(snapshot.prices[row_start:row_stop, col])
+            has_price = ~np.isnan(values)
+            symbol_dates, symbol_values = dates[has_price], values[has_price]
+            if resolution == 'lttb':
+                kept = lttb(symbol_dates.astype(np.int64), symbol_values, points)
+                symbol_dates, symbol_values = symbol_dates[kept], symbol_values[kept]
+            series[symbol] = _series(symbol_dates, symbol_values)
+
+    return {
+          'version'    : snapshot.version
+        , 'resolution' : resolution
+        , 'series'     : series
+        , 'unknown'    : unknown
+    }
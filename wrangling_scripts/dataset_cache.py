@@ -0,0 +1,97 @@
+""" dataset_cache.py - Datasets held by the Flask app, reloaded when their files change
+
+The app used to load its data once, at import: it served yesterday's data until
+it was restarted after the nightly update, and every restart paid for the full
+load again. A DatasetCache holds one loaded dataset along with the version it
+was loaded from. On each request it compares that version with a cheap marker
+(a small file's content, or a file's modification time and size); when a new
+version appears it is loaded on a background thread while the requests keep
+being served from the current one, and swapped in with a single assignment
+once it is complete.
+
+The version and modification time of the dataset are also what the routes use
+as ETag and Last-Modified, so clients can revalidate instead of downloading
+unchanged data again."""
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+#=========================================================================================
+
+CachedDataset = namedtuple('CachedDataset', ['version', 'last_modified', 'data'])
+
+#=========================================================================================
+
+def file_marker(file_name):
+    """ version marker of a data file: its modification time and size
+    :param file_name: path of the file
+    :return: (version, last_modified) - raises FileNotFoundError if the file does not exist
+    """
+    stats = os.stat(file_name)
+    return f"{stats.st_mtime_ns:x}-{stats.st_size:x}", datetime.fromtimestamp(stats.st_mtime, timezone.utc)
+
+
+class DatasetCache:
+    """ A dataset loaded from files, reloaded in the background when its version marker changes """
+
+    def __init__(self, load, probe, check_interval=0.0):
+        """
+        :param load: function(version) returning the dataset of that version
+        :param probe: function() returning the (version, last_modified datetime) of the data on disk,
+                      raising FileNotFoundError while there is none
+        :param check_interval: least number of seconds between two checks of the marker (0 = every request)
+        """
+        self.load = load
+        self.probe = probe
+        self.check_interval = check_interval
+        self.current = None
+        self.lock = threading.Lock()
+        self.reloading = None # version being loaded in the background
+        self.last_check = 0.0
+
+    def get(self):
+        """ get the dataset, starting a background reload if a new version is on disk
+        :return: CachedDataset - the first call loads the dataset before returning
+        """
+        current = self.current
+        if current is None:
+            with self.lock:
+                if self.current is None:
+                    version, last_modified = self.probe()
+                    self.current = CachedDataset(version, last_modified, self.load(version))
+                    self.last_check = time.monotonic()
+                return self.current
+
+        now = time.monotonic()
+        if now - self.last_check >= self.check_interval:
+            self.last_check = now
+            self._check(current)
+        return current
+
+    def _check(self, current):
+        try:
+            version, last_modified = self.probe()
+        except FileNotFoundError: # being replaced - keep serving the current version
+            return
+        if version == current.version:
+            return
+        with self.lock:
+            if self.reloading is not None:
+                return
+            self.reloading = version
+        threading.Thread(target=self._reload, args=(version, last_modified), daemon=True, name="dataset-reload").start()
+
+    def _reload(self, version, last_modified):
+        try:
+            start = time.perf_counter()
+            dataset = CachedDataset(version, last_modified, self.load(version))
+            self.current = dataset # readers see either the old dataset or the new one
+            logging.info(f"Dataset version {version} loaded in {time.perf_counter() - start:.2f}s")
+        except Exception:
+            logging.exception(f"Loading dataset version {version} failed - still serving version {self.current.version}")
+        finally:
+            with self.lock:
+                self.reloading = None
@@ -4,7 +4,12 @@ import csv
 def username():
     return 'gburdell3'
 
+TEMPLATES_FILE = 'output/combined_securities_good_sectors_templates.csv'
+
+def data_wrangling_frame(csv_file=TEMPLATES_FILE):
+    return pd.read_csv(csv_file, encoding='unicode_escape')
+
 def data_wrangling():
-    df =  pd.read_csv('output/combined_securities_good_sectors_templates.csv', encoding='unicode_escape')
+    df =  data_wrangling_frame()
     return df.head() , df.values.tolist()
 
@@ -0,0 +1,348 @@
+""" optimizer.py - Mean-variance optimization: efficient frontier, minimum variance and maximum Sharpe portfolios
+
+The expensive part of a mean-variance query is the covariance matrix of the
+symbols over the lookback window - and, for thousands of symbols, solving with
+it. Both are kept in an LRU cache keyed on (data version, symbols, window,
+estimator), so that the dashboard asking again about the same universe and
+window gets its answer in milliseconds:
+
+    moments = estimate_moments(snapshot, ["MSFT", "AAPL", ...], "2021-01-01", "2023-12-31")
+    result = efficient_frontier(moments, n_points=50, risk_free=0.02)
+
+Estimators of the covariance matrix:
+
+  * sample               the sample covariance - singular as soon as there are more symbols than days
+  * ledoit_wolf          shrunk towards a scaled identity matrix, with the Ledoit-Wolf (2004) intensity
+  * oas                  shrunk towards a scaled identity matrix, with the Oracle Approximating
+                         Shrinkage intensity (Chen et al., 2010)
+
+The shrunk matrices are always well conditioned, which is what makes solving
+with thousands of symbols possible at all.
+
+Without constraints on the weights (short sales allowed) the frontier has a
+closed form: every frontier portfolio is a combination of inv(S) 1 and inv(S) mu,
+two vectors computed once per cached entry. With long_only=True the portfolios
+are found by projected gradient descent on the weights simplex instead, which
+costs a few hundred matrix-vector products per point."""
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from wrangling_scripts.analytics import PERIODS_PER_YEAR, daily_returns
+
+#=========================================================================================
+
+ESTIMATORS = ['sample', 'ledoit_wolf', 'oas']
+
+# Fewest daily returns a symbol needs in the window to have a mean and a variance
+MIN_RETURNS = 2
+
+Portfolio = namedtuple('Portfolio', ['weights', 'expected_return', 'volatility', 'sharpe'])
+
+#=========================================================================================
+
+def _centered_returns(returns):
+    """ demean every column, a missing return counting as the mean (no information) """
+    returns = np.asarray(returns, dtype=np.float64)
+    mean = np.nanmean(returns, axis=0)
+    centered = returns - mean
+    centered[np.isnan(centered)] = 0.0
+    return mean, centered
+
+
+def covariance(returns, estimator='ledoit_wolf'):
+    """ estimate the covariance matrix of daily returns
+    :param returns: dates x symbols array of daily returns (NaN for no return)
+    :param estimator: one of ESTIMATORS
+    :return: (daily mean returns, symbols x symbols covariance matrix, shrinkage intensity used)
+    """
+    if estimator not in ESTIMATORS:
+        raise ValueError(f"estimator must be one of {', '.join(ESTIMATORS)}, not {estimator!r}")
+    mean, centered = _centered_returns(returns)
+    n_days, n_symbols = centered.shape
+    if n_days < 2:
+        raise ValueError("at least 2 days of returns are needed")
+
+    sample = centered.T @ centered / n_days
+    if estimator == 'sample':
+        return mean, sample * n_days / (n_days - 1), 0.0
+
+    target_scale = np.trace(sample) / n_symbols
+    deviation = sample.copy()
+    deviation[np.diag_indices(n_symbols)] -= target_scale
+    deviation_norm = (deviation * deviation).sum() # ||S - mu I||^2
+    if deviation_norm == 0.0:
+        return mean, sample, 0.0
+
+    if estimator == 'ledoit_wolf':
+        # Average squared distance of the daily outer products from the sample covariance,
+        # sum_t ||x_t x_t' - S||^2 / n^2, computed without forming the outer products
+        squared_norms = (centered * centered).sum(axis=1)
+        spread = ((squared_norms * squared_norms).sum() / n_days - (sample * sample).sum()) / n_days
+        shrinkage = min(max(spread / deviation_norm, 0.0), 1.0)
+    else: # oas
+        trace_squared = (sample * sample).sum()
+        trace = np.trace(sample)
+        numerator = (1 - 2 / n_symbols) * trace_squared + trace * trace
+        denominator = (n_days + 1 - 2 / n_symbols) * (trace_squared - trace * trace / n_symbols)
+        shrinkage = 1.0 if denominator == 0 else min(numerator / denominator, 1.0)
+
+    shrunk = (1.0 - shrinkage) * sample
+    shrunk[np.diag_indices(n_symbols)] += shrinkage * target_scale
+    return mean, shrunk, shrinkage
+
+#=========================================================================================
+
+class Moments:
+    """ Annualized mean returns and covariance matrix of a set of symbols, with the solves
+        the unconstrained frontier needs, computed on first use """
+
+    def __init__(self, symbols, mean, covariance, shrinkage, estimator, periods_per_year=PERIODS_PER_YEAR, dropped=()):
+        self.symbols = list(symbols)
+        self.dropped = list(dropped) # symbols left out for too few returns in the window
+        self.mean = mean * periods_per_year
+        self.covariance = covariance * periods_per_year
+        self.shrinkage = shrinkage
+        self.estimator = estimator
+        self._solves = None
+        self._lock = threading.Lock()
+
+    def solves(self):
+        """ get inv(S) 1 and inv(S) mu, through a Cholesky factorization
+        :return: (inv(S) 1, inv(S) mu)
+        """
+        with self._lock:
+            if self._solves is None:
+                try:
+                    factor = np.linalg.cholesky(self.covariance)
+                except np.linalg.LinAlgError:
+                    raise ValueError(f"the {self.estimator} covariance matrix of {len(self.symbols)} symbols is singular - use a shrinkage estimator")
+                rhs = np.column_stack([np.ones(len(self.symbols)), self.mean])
+                solved = np.linalg.solve(factor.T, np.linalg.solve(factor, rhs))
+                self._solves = (solved[:, 0], solved[:, 1])
+            return self._solves
+
+    def portfolio(self, weights, risk_free=0.0):
+        """ describe a portfolio of these symbols
+        :param weights: array of weights, in the order of symbols
+        :param risk_free: annual risk-free rate
+        :return: Portfolio
+        """
+        expected_return = float(weights @ self.mean)
+        volatility = float(np.sqrt(max(weights @ self.covariance @ weights, 0.0)))
+        sharpe = (expected_return - risk_free) / volatility if volatility > 0 else np.nan
+        return Portfolio(weights, expected_return, volatility, sharpe)
+
+
+class CovarianceCache:
+    """ Least recently used cache of Moments, safe to share between threads """
+
+    def __init__(self, maxsize=16):
+        """
+        :param maxsize: number of entries kept - a 3,000 symbol entry holds a 72 MB matrix
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        """ get the entry of a key, computing it (outside the lock) if it is not cached
+        :param key: hashable key
+        :param compute: function() returning the entry
+        :return: the entry
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        entry = compute()
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return entry
+
+
+moments_cache = CovarianceCache()
+
+#=========================================================================================
+
+def estimate_moments(snapshot, symbols, start=None, end=None, estimator='ledoit_wolf', cache=moments_cache):
+    """ get the annualized moments of symbols over a window of the price snapshot, from the cache if possible
+    :param snapshot: Snapshot (pipeline/snapshot.py) - its version is part of the cache key
+    :param symbols: list of symbols (the ones not in the snapshot, or with fewer than MIN_RETURNS returns in the window, are left out)
+    :param start: first date of the window, YYYY-MM-DD or None for the first date held
+    :param end: last date of the window, YYYY-MM-DD or None for the last date held
+    :param estimator: one of ESTIMATORS
+    :param cache: CovarianceCache to use, None for no caching
+    :return: Moments
+    """
+    columns = {}
+    for symbol in symbols:
+        col = snapshot.column(symbol)
+        if col is not None:
+            columns.setdefault(symbol, col)
+    if len(columns) < 2:
+        raise ValueError("at least 2 known symbols are needed")
+    first = snapshot.dates[0] if start is None else np.datetime64(start, 'D')
+    last = snapshot.dates[-1] if end is None else np.datetime64(end, 'D')
+    row_start = int(np.searchsorted(snapshot.dates, first, side='left'))
+    row_end = int(np.searchsorted(snapshot.dates, last, side='right'))
+
+    def compute():
+        # Only the window's rows of the requested columns are read from the memory map
+        prices = np.column_stack([snapshot.prices[row_start:row_end, col] for col in columns.values()])
+        returns = daily_returns(prices)
+        # A symbol with no prices in the window would get a NaN mean, and NaN weights with it
+        usable = np.isfinite(returns).sum(axis=0) >= MIN_RETURNS
+        if usable.sum() < 2:
+            raise ValueError(f"at least 2 symbols with {MIN_RETURNS} or more returns in the window are needed")
+        symbols = np.array(list(columns), dtype=object)
+        mean, matrix, shrinkage = covariance(returns[:, usable], estimator)
+        return Moments(symbols[usable].tolist(), mean, matrix, shrinkage, estimator, dropped=symbols[~usable].tolist())
+
+    if cache is None:
+        return compute()
+    key = (snapshot.version, tuple(columns), row_start, row_end, estimator)
+    return cache.get(key, compute)
+
+#=========================================================================================
+
+def _project_simplex(points):
+    """ Euclidean projection of each row onto {w >= 0, sum(w) = 1} (Duchi et al., 2008) """
+    points = np.atleast_2d(points)
+    ordered = -np.sort(-points, axis=1)
+    cumulative = np.cumsum(ordered, axis=1) - 1.0
+    index = np.arange(1, points.shape[1] + 1)
+    rho = (ordered - cumulative / index > 0).sum(axis=1)
+    theta = cumulative[np.arange(len(points)), rho - 1] / rho
+    return np.maximum(points - theta[:, None], 0.0)
+
+
+def long_only_weights(moments, risk_aversion, max_iterations=500, tolerance=1e-7):
+    """ maximize mu'w / risk_aversion - w'Sw over long-only fully invested weights, by accelerated projected gradient
+    :param moments: Moments
+    :param risk_aversion: array of risk aversions, one portfolio each - numpy.inf for the minimum variance portfolio
+    :param max_iterations: most gradient steps
+    :param tolerance: stop once no weight moves by more than this in a step
+    :return: len(risk_aversion) x symbols array of weights
+    """
+    tilt = 1.0 / np.atleast_1d(np.asarray(risk_aversion, dtype=np.float64))
+    n_symbols = len(moments.symbols)
+    # Step size from the largest eigenvalue of the covariance, by a few power iterations
+    vector = np.ones(n_symbols) / np.sqrt(n_symbols)
+    for _ in range(50):
+        vector = moments.covariance @ vector
+        vector /= np.linalg.norm(vector)
+    step = 1.0 / (2.0 * float(vector @ moments.covariance @ vector))
+
+    weights = np.full((len(tilt), n_symbols), 1.0 / n_symbols)
+    momentum, t = weights.copy(), 1.0
+    for _ in range(max_iterations):
+        gradient = 2.0 * (momentum @ moments.covariance) - tilt[:, None] * moments.mean
+        new_weights = _project_simplex(momentum - step * gradient)
+        t_next = (1.0 + np.sqrt(1.0 + 4.0 * t * t)) / 2.0
+        momentum = new_weights + ((t - 1.0) / t_next) * (new_weights - weights)
+        converged = np.abs(new_weights - weights).max() < tolerance
+        weights, t = new_weights, t_next
+        if converged:
+            break
+    return weights
+
+
+def efficient_frontier(moments, n_points=50, risk_free=0.0, long_only=False):
+    """ compute the efficient frontier, the minimum variance and the maximum Sharpe portfolios
+    :param moments: Moments, as returned by estimate_moments
+    :param n_points: number of frontier portfolios
+    :param risk_free: annual risk-free rate
+    :param long_only: forbid short sales (weights >= 0)
+    :return: dictionary with symbols, the frontier (expected returns and volatilities), and the
+             min_variance and max_sharpe Portfolios
+    """
+    if not long_only:
+        inv_ones, inv_mean = moments.solves()
+        a, b, c = inv_ones.sum(), inv_mean.sum(), moments.mean @ inv_mean
+        d = a * c - b * b
+        min_variance = moments.portfolio(inv_ones / a, risk_free)
+        excess = inv_mean - risk_free * inv_ones
+        max_sharpe = moments.portfolio(excess / excess.sum(), risk_free) if excess.sum() > 0 else None
+
+        # Two-fund theorem: the variance of the frontier portfolio of return r is (a r^2 - 2 b r + c) / d
+        highest = max(moments.mean.max(), max_sharpe.expected_return if max_sharpe else min_variance.expected_return)
+        targets = np.linspace(min_variance.expected_return, highest, n_points)
+        volatilities = np.sqrt(np.maximum((a * targets * targets - 2 * b * targets + c) / d, 0.0))
+        frontier_returns = targets
+    else:
+        # Sweep the risk aversion from infinite (minimum variance) down to low (highest return)
+        risk_aversion = np.concatenate([[np.inf], np.geomspace(1e3, 1e-2, n_points - 1)])
+        weights = long_only_weights(moments, risk_aversion)
+        portfolios = [moments.portfolio(w, risk_free) for w in weights]
+        min_variance = min(portfolios, key=lambda p: p.volatility)
+        max_sharpe = max(portfolios, key=lambda p: -np.inf if np.isnan(p.sharpe) else p.sharpe)
+        frontier_returns = np.array([p.expected_return for p in portfolios])
+        volatilities = np.array([p.volatility for p in portfolios])
+
+    return {
+          'symbols'       : moments.symbols
+        , 'estimator'     : moments.estimator
+        , 'shrinkage'     : moments.shrinkage
+        , 'returns'       : frontier_returns
+        , 'volatilities'  : volatilities
+        , 'min_variance'  : min_variance
+        , 'max_sharpe'    : max_sharpe
+    }
+
+#=========================================================================================
+
+def frontier_page(snapshot, symbols, start=None, end=None, estimator=None, points=None, risk_free=None, long_only=None):
+    """ the /api/frontier query: the efficient frontier of a set of symbols over a window, for jsonify
+    :param snapshot: Snapshot to read from
+    :param symbols: comma-separated symbols
+    :param start: first date of the window, YYYY-MM-DD, None for the first date held
+    :param end: last date of the window, YYYY-MM-DD, None for the last date held
+    :param estimator: one of ESTIMATORS, ledoit_wolf if None
+    :param points: number of frontier portfolios, 50 if None (at most 200)
+    :param risk_free: annual risk-free rate, 0 if None
+    :param long_only: "1" or "true" to forbid short sales
+    :return: dictionary with the frontier, and the weights of the min_variance and max_sharpe portfolios
+    """
+    list_symbols = [s.strip() for s in (symbols or '').split(',') if s.strip()]
+    try:
+        n_points = min(int(points or 50), 200)
+        risk_free = float(risk_free or 0.0)
+    except ValueError:
+        raise ValueError("points must be a whole number and risk_free a number")
+    long_only = (long_only or '').lower() in ('1', 'true', 'yes')
+
+    moments = estimate_moments(snapshot, list_symbols, start or None, end or None, estimator or 'ledoit_wolf')
+    result = efficient_frontier(moments, max(n_points, 2), risk_free, long_only)
+
+    def describe(portfolio):
+        if portfolio is None:
+            return None
+        return {
+              'expected_return' : portfolio.expected_return
+            , 'volatility'      : portfolio.volatility
+            , 'sharpe'          : None if np.isnan(portfolio.sharpe) else portfolio.sharpe
+            , 'weights'         : dict(zip(moments.symbols, np.round(portfolio.weights, 6).tolist()))
+        }
+
+    return {
+          'version'       : snapshot.version
+        , 'symbols'       : moments.symbols
+        , 'unknown'       : [s for s in list_symbols if s not in set(moments.symbols) and s not in set(moments.dropped)]
+        , 'no_data'       : moments.dropped
+        , 'estimator'     : result['estimator']
+        , 'shrinkage'     : result['shrinkage']
+        , 'long_only'     : long_only
+        , 'returns'       : result['returns'].tolist()
+        , 'volatilities'  : result['volatilities'].tolist()
+        , 'min_variance'  : describe(result['min_variance'])
+        , 'max_sharpe'    : describe(result['max_sharpe'])
+    }
@@ -0,0 +1,134 @@
+""" price_api.py - Slices of the price history for the Flask JSON API
+
+The prices are served from the memory-mapped snapshot published by the update
+scripts (pipeline/snapshot.py). A request names a few symbols and a date range;
+the date range is found with a binary search on the sorted date index, and only
+the requested columns are read from the matrix, so the cost of a request
+follows the size of its slice, not the size of the universe. Long ranges are
+returned a page of dates at a time, with a cursor pointing at the next page.
+
+The snapshot is held in a DatasetCache, keyed on the version named in the
+snapshot's CURRENT file: a new snapshot is picked up without a restart."""
+import math
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+
+from pipeline.snapshot import CURRENT_FILE, DEFAULT_SNAPSHOT_DIR, current_version, open_snapshot
+from wrangling_scripts.dataset_cache import DatasetCache
+
+#=========================================================================================
+
+MAX_SYMBOLS = 100
+DEFAULT_PAGE_SIZE = 250
+MAX_PAGE_SIZE = 5000
+
+#=========================================================================================
+
+def snapshot_marker(snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+    """ version marker of the price snapshot: the current version, published at the time CURRENT was written
+    :param snapshot_dir: directory the snapshots are published in
+    :return: (version, last_modified) - raises FileNotFoundError if no snapshot was published yet
+    """
+    version = current_version(snapshot_dir)
+    if version is None:
+        raise FileNotFoundError(f"No snapshot has been published in {snapshot_dir}")
+    published = os.stat(os.path.join(snapshot_dir, CURRENT_FILE)).st_mtime
+    return version, datetime.fromtimestamp(published, timezone.utc)
+
+
+# Opening a snapshot only maps it, so the "reload" is cheap - the pages are read on demand
+snapshot_cache = DatasetCache(lambda version: open_snapshot(version=version), snapshot_marker)
+
+
+def _parse_date(text, name):
+    try:
+        return np.datetime64(text, 'D')
+    except ValueError:
+        raise ValueError(f"{name} must be a date as YYYY-MM-DD, not {text!r}")
+
+
+def _parse_limit(text, default, maximum):
+    if text is None or text == '':
+        return default
+    try:
+        limit = int(text)
+    except ValueError:
+        raise ValueError(f"limit must be a number, not {text!r}")
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+    return min(limit, maximum)
+
+
+def _price_list(values):
+    """ JSON has no NaN: missing prices are returned as null; the float32 prices are rounded
+        to 6 decimals so they are not sent with float64 noise digits """
+    return [None if math.isnan(value) else value for value in np.round(values.astype(np.float64), 6).tolist()]
+
+#=========================================================================================
+
+def price_page(snapshot, symbols, start=None, end=None, cursor=None, limit=None):
+    """ get one page of prices for a few symbols over a date range
+    :param snapshot: Snapshot to read from
+    :param symbols: comma-separated symbols (at most MAX_SYMBOLS)
+    :param start: first date wanted, YYYY-MM-DD, None for the first date held
+    :param end: last date wanted, YYYY-MM-DD, None for the last date held
+    :param cursor: next_cursor of the previous page, None for the first page
+    :param limit: number of dates per page, DEFAULT_PAGE_SIZE if None, at most MAX_PAGE_SIZE
+    :return: dictionary ready for jsonify - dates, prices per symbol (column oriented), unknown symbols and next_cursor
+    """
+    list_symbols = [s.strip() for s in (symbols or '').split(',') if s.strip()]
+    if len(list_symbols) == 0:
+        raise ValueError("symbols is required, as a comma-separated list")
+    if len(list_symbols) > MAX_SYMBOLS:
+        raise ValueError(f"at most {MAX_SYMBOLS} symbols can be requested at once")
+    limit = _parse_limit(limit, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+
+    # The cursor is the first date of the next page, so it stays valid across snapshot versions
+    first = snapshot.dates[0] if start in (None, '') else _parse_date(start, 'start')
+    if cursor not in (None, ''):
+        first = max(first, _parse_date(cursor, 'cursor'))
+    last = snapshot.dates[-1] if end in (None, '') else _parse_date(end, 'end')
+
+    row_start = int(np.searchsorted(snapshot.dates, first, side='left'))
+    row_end = int(np.searchsorted(snapshot.dates, last, side='right'))
+    row_stop = min(row_end, row_start + limit)
+
+    columns, unknown = {}, []
+    for symbol in list_symbols:
+        col = snapshot.column(symbol)
+        if col is None:
+            unknown.append(symbol)
+        elif symbol not in columns:
+            columns[symbol] = col
+
+    return {
+          'version'     : snapshot.version
+        , 'dates'       : [str(d) for d in snapshot.dates[row_start:row_stop]]
+        , 'prices'      : {symbol: _price_list(snapshot.prices[row_start:row_stop, col]) for symbol, col in columns.items()}
+        , 'unknown'     : unknown
+        , 'next_cursor' : str(snapshot.dates[row_stop]) if row_stop < row_end else None
+    }
+
+
+def symbol_page(snapshot, prefix=None, cursor=None, limit=None):
+    """ get one page of the symbols held, alphabetically
+    :param snapshot: Snapshot to read from
+    :param prefix: only return the symbols starting with this
+    :param cursor: next_cursor of the previous page, None for the first page
+    :param limit: number of symbols per page, DEFAULT_PAGE_SIZE if None, at most MAX_PAGE_SIZE
+    :return: dictionary ready for jsonify - symbols and next_cursor
+    """
+    limit = _parse_limit(limit, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    prefix = prefix or ''
+    first = max(prefix, cursor or '')
+    row_start = int(np.searchsorted(snapshot.symbols, first, side='left'))
+    # Every symbol starting with the prefix sorts before the prefix followed by the highest code point
+    row_end = int(np.searchsorted(snapshot.symbols, prefix + '\U0010ffff', side='left')) if prefix else len(snapshot.symbols)
+    row_stop = min(row_end, row_start + limit)
+    return {
+          'version'     : snapshot.version
+        , 'symbols'     : snapshot.symbols[row_start:row_stop].tolist()
+        , 'next_cursor' : str(snapshot.symbols[row_stop]) if row_stop < row_end else None
+    }
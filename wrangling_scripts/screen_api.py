@@ -0,0 +1,71 @@
+""" screen_api.py - Screens of the symbol registry for the Flask JSON API
+
+A screen names sectors, exchanges, a market cap band, an IPO date range or how
+stale the prices may be, and gets the matching symbols back. The filters are
+pushed down to SQLite as one parameterized query on the indexed yahoo_links
+columns (pipeline/registry.py), and the answers are cached until the registry
+is next written to: the dashboard never loads the registry into pandas."""
+from datetime import datetime, timedelta
+
+from pipeline.registry import RegistryQueries
+from wrangling_scripts.price_api import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, _parse_date, _parse_limit
+
+#=========================================================================================
+
+# Columns returned for each symbol of a screen
+SCREEN_COLUMNS = ['Yahoo_Symbol', 'Description', 'Exchange_ID', 'GICS_Sector', 'Market_Cap', 'IPO_Date', 'last_update']
+
+registry_queries = RegistryQueries()
+
+#=========================================================================================
+
+def _list(text):
+    values = [value.strip() for value in (text or '').split(',') if value.strip()]
+    return values or None
+
+
+def _number(text, name):
+    if text is None or text == '':
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        raise ValueError(f"{name} must be a number, not {text!r}")
+
+
+def _day(text, name):
+    return None if text in (None, '') else str(_parse_date(text, name))
+
+
+def screen_page(sectors=None, exchanges=None, min_market_cap=None, max_market_cap=None, ipo_after=None,
+                ipo_before=None, stale_hours=None, limit=None, queries=registry_queries):
+    """ get the symbols of the registry matching a screen
+    :param sectors: comma-separated GICS sectors
+    :param exchanges: comma-separated Exchange_IDs
+    :param min_market_cap: smallest market cap
+    :param max_market_cap: largest market cap
+    :param ipo_after: first IPO date, YYYY-MM-DD
+    :param ipo_before: IPO dates before this one, YYYY-MM-DD
+    :param stale_hours: only the symbols not updated for this many hours
+    :param limit: most symbols returned (the first ones alphabetically), DEFAULT_PAGE_SIZE if None, at most MAX_PAGE_SIZE
+    :param queries: RegistryQueries to answer from
+    :return: dictionary ready for jsonify - columns and rows
+    """
+    stale_hours = _number(stale_hours, 'stale_hours')
+    updated_before = None
+    if stale_hours is not None:
+        # Rounded down to the minute, so that repeated screens hit the cache
+        updated_before = (datetime.utcnow() - timedelta(hours=stale_hours)).replace(second=0, microsecond=0)
+        updated_before = updated_before.isoformat(sep=" ", timespec="seconds")
+    columns, rows = queries.query(
+          columns=SCREEN_COLUMNS
+        , sectors=_list(sectors)
+        , exchanges=_list(exchanges)
+        , min_market_cap=_number(min_market_cap, 'min_market_cap')
+        , max_market_cap=_number(max_market_cap, 'max_market_cap')
+        , ipo_after=_day(ipo_after, 'ipo_after')
+        , ipo_before=_day(ipo_before, 'ipo_before')
+        , updated_before=updated_before
+        , limit=_parse_limit(limit, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    )
+    return {'columns': columns, 'rows': rows}
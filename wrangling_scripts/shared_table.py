@@ -0,0 +1,105 @@
+""" shared_table.py - The index table as a memory map shared by all the server's workers
+
+Each worker process of the app used to parse the table's CSV and keep it as
+Python lists (df.values.tolist()): dozens of bytes per cell, once per worker.
+Here the table is converted once into a numpy structured array - one fixed
+width text field per column - and saved next to the CSV as
+
+    output/shared/<csv name>.<version>.header.npy
+    output/shared/<csv name>.<version>.table.npy
+
+where <version> is the CSV's modification time and size. Workers open it with
+numpy.load(mmap_mode='r'): no parsing at all, and since the pages come from
+the page cache and are never written, every worker shares the same memory.
+Only the rows of the page being rendered become Python objects.
+
+The gunicorn master publishes it before starting the workers (see
+gunicorn.conf.py); a worker that finds no table for the current version of the
+CSV publishes it itself - the files are written under temporary names and
+renamed into place, so concurrent workers cannot see a partial table."""
+import glob
+import os
+import tempfile
+
+import numpy as np
+
+from wrangling_scripts.dataset_cache import file_marker
+from wrangling_scripts.example_wrangler import TEMPLATES_FILE, data_wrangling_frame
+
+#=========================================================================================
+
+DEFAULT_SHARED_DIR = "output/shared"
+
+#=========================================================================================
+
+def _table_files(csv_file, version, shared_dir):
+    stem = os.path.join(shared_dir, f"{os.path.basename(csv_file)}.{version}")
+    return f"{stem}.header.npy", f"{stem}.table.npy"
+
+
+def _save_atomic(file_name, array):
+    handle, temp_file = tempfile.mkstemp(prefix=".shared_", suffix=".npy", dir=os.path.dirname(file_name))
+    try:
+        with os.fdopen(handle, 'wb') as filehandle:
+            np.save(filehandle, array)
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, file_name)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+
+
+def publish_table(csv_file=TEMPLATES_FILE, shared_dir=DEFAULT_SHARED_DIR):
+    """ convert the table's CSV into the shared structured array, unless it already is for this version
+    :param csv_file: the CSV file the index table is read from
+    :param shared_dir: directory the shared arrays are written to
+    :return: version published
+    """
+    version, _ = file_marker(csv_file)
+    header_file, table_file = _table_files(csv_file, version, shared_dir)
+    if os.path.exists(table_file):
+        return version
+
+    os.makedirs(shared_dir, exist_ok=True)
+    df = data_wrangling_frame(csv_file)
+    columns = []
+    for i in range(df.shape[1]):
+        # Cells as they were rendered from df.values.tolist() - str() of each value
+        values = np.array([str(value) for value in df.iloc[:, i].tolist()], dtype=str)
+        columns.append(values if len(values) else np.array([], dtype='U1'))
+    table = np.empty(df.shape[0], dtype=[(f"f{i}", values.dtype) for i, values in enumerate(columns)])
+    for i, values in enumerate(columns):
+        table[f"f{i}"] = values
+
+    # The table file is written last: its presence means the version is complete
+    _save_atomic(header_file, np.array([str(c) for c in df.columns], dtype=str))
+    _save_atomic(table_file, table)
+
+    for old_file in glob.glob(os.path.join(shared_dir, f"{glob.escape(os.path.basename(csv_file))}.*.npy")):
+        if old_file not in (header_file, table_file):
+            os.unlink(old_file) # workers still mapping it keep their pages
+    return version
+
+
+def attach_table(version, csv_file=TEMPLATES_FILE, shared_dir=DEFAULT_SHARED_DIR):
+    """ map the shared table of a version of the CSV, publishing it first if needed
+    :param version: version of the CSV, as returned by file_marker
+    :param csv_file: the CSV file the index table is read from
+    :param shared_dir: directory the shared arrays are written to
+    :return: (header, table) - list of column names, read-only structured array with one row per table row
+    """
+    header_file, table_file = _table_files(csv_file, version, shared_dir)
+    if not os.path.exists(table_file):
+        version = publish_table(csv_file, shared_dir)
+        header_file, table_file = _table_files(csv_file, version, shared_dir)
+    return np.load(header_file).tolist(), np.load(table_file, mmap_mode='r')
+
+
+def table_rows(table, start, stop):
+    """ get rows of a shared table as lists, the shape the index template renders
+    :param table: structured array returned by attach_table
+    :param start: first row
+    :param stop: row after the last one
+    :return: list of lists of strings
+    """
+    return [list(row) for row in table[start:stop].tolist()]